@@ -8,6 +8,7 @@ import app_config
 import exts.path2
 import exts.fs
 
+import yalibrary.store.eviction as eviction
 import yalibrary.upload.consts as upload_consts
 from core.yarg.groups import (
     OPERATIONAL_CONTROL_GROUP,
@@ -908,6 +909,8 @@ class ExecutorOptions(Options):
         self.use_clonefile = True
         self.runner_dir_outputs = True
         self.dir_outputs_test_mode = False
+        self.critical_path_priority = True
+        self.script_workers = False
 
     @staticmethod
     def consumer():
@@ -973,6 +976,26 @@ class ExecutorOptions(Options):
                 visible=HelpLevel.ADVANCED,
             ),
             EnvConsumer('YA_NO_CLONEFILE', hook=SetValueHook('use_clonefile', False)),
+            ArgConsumer(
+                ['--no-critical-path-priority'],
+                help='Schedule nodes by graph depth instead of the estimated critical path',
+                hook=SetConstValueHook('critical_path_priority', False),
+                group=FEATURES_GROUP,
+                visible=HelpLevel.EXPERT,
+            ),
+            ConfigConsumer('critical_path_priority'),
+            EnvConsumer(
+                'YA_CRITICAL_PATH_PRIORITY', hook=SetValueHook('critical_path_priority', return_true_if_enabled)
+            ),
+            ArgConsumer(
+                ['--script-workers'],
+                help='Run build scripts in persistent python workers instead of new interpreters',
+                hook=SetConstValueHook('script_workers', True),
+                group=FEATURES_GROUP,
+                visible=HelpLevel.EXPERT,
+            ),
+            ConfigConsumer('script_workers'),
+            EnvConsumer('YA_SCRIPT_WORKERS', hook=SetValueHook('script_workers', return_true_if_enabled)),
         ]
 
     def postprocess2(self, params):
@@ -2227,6 +2250,8 @@ class LocalCacheOptions(ToolsOptions):
         self.new_store = True
         self.new_runner = True
         self.new_store_ttl = 3 * 24 * 60 * 60  # 3 days
+        self.new_store_chunked_min_size = None
+        self.new_store_eviction_policy = eviction.DEFAULT_POLICY
         self.cache_size = 300 * 1024 * 1024 * 1024
         self.auto_clean_results_cache = True
 
@@ -2318,6 +2343,32 @@ class LocalCacheOptions(ToolsOptions):
             ConfigConsumer('new_store'),
             ConfigConsumer('new_runner'),
             ConfigConsumer('new_store_ttl', help='Cache TTL in seconds', group=DEVELOPERS_OPT_GROUP),
+            ArgConsumer(
+                ['--cache-chunked-min-size'],
+                help='Store cached files of at least this size as deduplicated chunks',
+                hook=SetValueHook('new_store_chunked_min_size'),
+                group=CACHE_CONTROL_GROUP,
+                visible=HelpLevel.INTERNAL,
+            ),
+            ConfigConsumer(
+                'new_store_chunked_min_size',
+                help='Store cached files of at least this size as deduplicated chunks',
+                group=DEVELOPERS_OPT_GROUP,
+            ),
+            ArgConsumer(
+                ['--cache-eviction-policy'],
+                help='Cache eviction policy when the cache exceeds its size: {}'.format(
+                    ', '.join(sorted(eviction.POLICIES))
+                ),
+                hook=SetValueHook('new_store_eviction_policy'),
+                group=CACHE_CONTROL_GROUP,
+                visible=HelpLevel.ADVANCED,
+            ),
+            ConfigConsumer(
+                'new_store_eviction_policy',
+                help='Cache eviction policy when the cache exceeds its size',
+                group=DEVELOPERS_OPT_GROUP,
+            ),
             ConfigConsumer('symlinks_ttl', help='Results cache TTL in seconds', group=DEVELOPERS_OPT_GROUP),
             ConfigConsumer('cache_codec', help='Use specific codec for cache', group=DEVELOPERS_OPT_GROUP),
             ConfigConsumer('cache_size'),
@@ -2329,6 +2380,8 @@ class LocalCacheOptions(ToolsOptions):
     def postprocess(self):
         super(LocalCacheOptions, self).postprocess()
         self._set_cache_size()
+        self._set_chunked_min_size()
+        self._check_eviction_policy()
         self._set_ttl('new_store_ttl', 3 * 24 * 60 * 60)
         self._set_ttl('symlinks_ttl', 7 * 24 * 60 * 60)
 
@@ -2338,6 +2391,24 @@ class LocalCacheOptions(ToolsOptions):
         except (ValueError, InvalidSize):
             raise ArgsValidatingException("cache_size ({}) is not convertible to long".format(self.cache_size))
 
+    def _set_chunked_min_size(self):
+        if self.new_store_chunked_min_size is None:
+            return
+        try:
+            self.new_store_chunked_min_size = parse_size_arg(self.new_store_chunked_min_size)
+        except (ValueError, InvalidSize):
+            raise ArgsValidatingException(
+                "new_store_chunked_min_size ({}) is not convertible to long".format(self.new_store_chunked_min_size)
+            )
+
+    def _check_eviction_policy(self):
+        if self.new_store_eviction_policy not in eviction.POLICIES:
+            raise ArgsValidatingException(
+                "Unknown cache eviction policy {}, expected one of: {}".format(
+                    self.new_store_eviction_policy, ', '.join(sorted(eviction.POLICIES))
+                )
+            )
+
     def _set_ttl(self, attr, default):
         attr_val = getattr(self, attr)
         if attr_val is None:
@@ -2492,6 +2563,8 @@ class DistCacheOptions(DistCacheSetupOptions):
         self.dist_cache_evict_cached = False
         self.dist_cache_max_file_size = 0
         self.dist_store_threads = min(get_cpu_count() * 2, get_cpu_count() + 12)
+        self.dist_store_write_behind_queue = 0
+        self.dist_store_flush_timeout = 600
         self.yt_store = True
         self.yt_create_tables = False
         self.yt_cache_filter = None
@@ -2538,6 +2611,22 @@ class DistCacheOptions(DistCacheSetupOptions):
                     group=YT_CACHE_CONTROL_GROUP,
                     visible=HelpLevel.ADVANCED,
                 ),
+                ArgConsumer(
+                    ['--dist-store-write-behind-queue'],
+                    help='Max number of uploads to the dist cache waiting in background. Uploads are synchronous by default (0)',
+                    hook=SetValueHook('dist_store_write_behind_queue', transform=int),
+                    group=YT_CACHE_CONTROL_GROUP,
+                    visible=HelpLevel.EXPERT,
+                ),
+                ConfigConsumer('dist_store_write_behind_queue'),
+                ArgConsumer(
+                    ['--dist-store-flush-timeout'],
+                    help='Time in seconds to wait for background uploads to the dist cache at the end of the build',
+                    hook=SetValueHook('dist_store_flush_timeout', transform=float),
+                    group=YT_CACHE_CONTROL_GROUP,
+                    visible=HelpLevel.EXPERT,
+                ),
+                ConfigConsumer('dist_store_flush_timeout'),
                 ArgConsumer(
                     ['--dist-cache-max-file-size'],
                     help='Sets the maximum size in bytes of a single file stored in the dist cache. Use 0 for no limit',
@@ -3033,6 +3122,35 @@ class CompressYmakeOutputOptions(Options):
         ]
 
 
+class IncrementalGraphCacheOptions(Options):
+    def __init__(self):
+        self.incremental_graph_cache = False
+
+    @staticmethod
+    def consumer():
+        return [
+            ArgConsumer(
+                ['--incremental-graph-cache'],
+                help='Reuse graphs of previous runs, regenerate only targets with changed sources',
+                hook=SetConstValueHook('incremental_graph_cache', True),
+                group=GRAPH_GENERATION_GROUP,
+                visible=HelpLevel.EXPERT,
+            ),
+            ArgConsumer(
+                ['--no-incremental-graph-cache'],
+                help='Always generate graphs from scratch',
+                hook=SetConstValueHook('incremental_graph_cache', False),
+                group=GRAPH_GENERATION_GROUP,
+                visible=HelpLevel.EXPERT,
+            ),
+            ConfigConsumer('incremental_graph_cache'),
+            EnvConsumer(
+                'YA_INCREMENTAL_GRAPH_CACHE',
+                hook=SetValueHook('incremental_graph_cache', return_true_if_enabled),
+            ),
+        ]
+
+
 def ya_make_options(  # compat
     free_build_targets=False,
     use_distbuild=False,
@@ -3128,6 +3246,7 @@ def ya_make_options(  # compat
             DumpDebugOptions(),
             AuthOptions(),
             CompressYmakeOutputOptions(),
+            IncrementalGraphCacheOptions(),
             YaBin3Options(),
         ]
         + distbs_options(use_distbuild=use_distbuild)
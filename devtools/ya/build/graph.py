@@ -45,6 +45,7 @@ import yalibrary.vcs.vcsversion as vcsversion
 import yalibrary.debug_store
 from yalibrary.monitoring import YaMonEvent
 
+import build.graph_cache as graph_cache
 import build.makelist as bml
 import build.gen_plan as gen_plan
 import build.ymake2 as ymake2
@@ -1200,6 +1201,13 @@ class _GraphMaker(object):
         self._exit_stack = exit_stack
         self._print_status = print_status
         self._heater = self._opts.build_graph_cache_heater
+        self._graph_cache = None
+        if getattr(self._opts, 'incremental_graph_cache', False) and not self._heater:
+            import core.config
+
+            self._graph_cache = graph_cache.GraphCache(
+                os.path.join(core.config.misc_root(), 'graph_cache'), self._src_dir, imprint
+            )
 
     def make_graphs(
         self,
@@ -1489,8 +1497,14 @@ class _GraphMaker(object):
         make_files_dart_path = os.path.join(tmp_dir, 'makefiles.dart')
 
         current_ev_listener = self._event_queue
+        events_recorder = None
+        if self._graph_cache:
+            events_recorder = graph_cache.YmakeEventsRecorder(current_ev_listener, tool_targets_queue_putter)
+            current_ev_listener = events_recorder.on_event
+            if tool_targets_queue_putter is not None:
+                tool_targets_queue_putter = events_recorder.put_tool_targets
         if tool_targets_queue_putter is not None:
-            current_ev_listener = _ToolEventListener(self._event_queue, tool_targets_queue_putter)
+            current_ev_listener = _ToolEventListener(current_ev_listener, tool_targets_queue_putter)
             enabled_events += YmakeEvents.TOOLS.value
 
         with stager.scope("gen-graph-gen-opts-{}".format(_shorten_debug_id(debug_id))):
@@ -1511,9 +1525,21 @@ class _GraphMaker(object):
                 no_ymake_retry=no_ymake_retry,
             )
 
+        cache_plan = None
+        if self._graph_cache:
+            with stager.scope("gen-graph-cache-plan-{}".format(_shorten_debug_id(debug_id))):
+                cache_plan = self._graph_cache.plan(ymake_opts, events_recorder)
+
         # return res, tc_tests, java_darts, make_files_map
         with stager.scope("gen-graph-json-{}".format(_shorten_debug_id(debug_id))):
-            graph = self._gen_graph_json(ymake_opts, purpose=debug_id)
+            if cache_plan and cache_plan.hit:
+                graph = cache_plan.restore(test_dart_path, java_dart_path, make_files_dart_path)
+            else:
+                if cache_plan and cache_plan.dirty_targets:
+                    ymake_opts = dict(ymake_opts, abs_targets=cache_plan.dirty_targets)
+                graph = self._gen_graph_json(ymake_opts, purpose=debug_id)
+                if cache_plan:
+                    graph = cache_plan.store(graph, test_dart_path, java_dart_path, make_files_dart_path)
 
         if should_run_tc_tests:
             with stager.scope("gen-tests-{}".format(_shorten_debug_id(debug_id))):
@@ -2167,12 +2193,14 @@ def _should_run_tests(opts, target_tc):
 
 
 def _enable_imprint_fs_cache(opts):
-    if opts.cache_fs_read or opts.cache_fs_write:
+    # Incremental graph cache hashes graph sources on every run, only changed files should be rehashed
+    incremental_graph_cache = getattr(opts, 'incremental_graph_cache', False)
+    if opts.cache_fs_read or opts.cache_fs_write or incremental_graph_cache:
         imprint_enable_fs_cache_stage = stager.start('imprint_enable_fs_cache')
         try:
             imprint.enable_fs(
-                read=opts.cache_fs_read,
-                write=opts.cache_fs_write,
+                read=opts.cache_fs_read or incremental_graph_cache,
+                write=opts.cache_fs_write or incremental_graph_cache,
                 cache_source_path=bg_cache.configure_build_graph_cache_dir(opts),
                 process_arcadia_clash=False,
                 quiet=True,
@@ -0,0 +1,451 @@
+"""
+Incremental cache of ymake graphs.
+
+An entry is keyed by ymake options, generated configuration and targets. It keeps the graph, the darts
+and shallow imprints (see core.imprint) of the source directories the graph was built from: directories
+of node inputs, include search directories of commands, module directories and directories of the ya.make
+files read by ymake. Directories of ya.make files with globs are imprinted with their subdirectories,
+graphs with globs outside of the ya.make directory are not cached.
+On the next run the imprints are recomputed, which is cheap with the imprint fs cache and a change list. Then
+  - nothing has changed: the cached graph is used and ymake is not run;
+  - changes touch some of the targets only: ymake runs for them and their subgraphs are spliced into the cached graph;
+  - otherwise the graph is regenerated.
+"""
+
+import logging
+import os
+import random
+import re
+import threading
+import time
+
+import six
+
+import exts.fs
+import exts.hashing as hashing
+import exts.yjson as json
+
+import build.makelist as bml
+import devtools.ya.build.ccgraph as ccgraph
+
+logger = logging.getLogger(__name__)
+
+VERSION = 2
+MAX_ENTRIES = 16
+SOURCE_ROOT_PREFIX = '$(SOURCE_ROOT)/'
+MAKE_FILE_PREFIX = '$S/'
+DART_SEPARATOR = b'\n' + b'=' * 61 + b'\n'
+# Configuration and plugins, any change there invalidates the whole graph
+CONF_DIRS = ('build',)
+# Include search directory flags, the directory is either glued or the next argument
+INCLUDE_FLAGS = ('-I', '-isystem', '-iquote', '-idirafter')
+# Macros listing files by masks and their arguments
+GLOB_MACRO_RE = re.compile(r'\b(?:\w*GLOB\w*|ALL_\w*SRCS|ALL_RESOURCE_FILES\w*)\s*\(([^)]*)\)')
+
+# Volatile or per-process ymake options which don't affect the graph
+_KEY_IGNORED_OPTS = frozenset(
+    (
+        'abs_targets',
+        'custom_build_directory',
+        'custom_conf',
+        'dump_file',
+        'dump_java',
+        'dump_make_files',
+        'dump_tests',
+        'enabled_events',
+        'ev_listener',
+        'no_caches_on_retry',
+        'no_ymake_retry',
+        'patch_path',
+    )
+)
+
+
+class YmakeEventsRecorder(object):
+    """Remembers what a cached graph can't reproduce: tool targets and configure errors"""
+
+    def __init__(self, ev_listener, queue_putter=None):
+        self._ev_listener = ev_listener
+        self._queue_putter = queue_putter
+        self.tool_targets = set()
+        # Tool targets of the spliced part of the cached graph
+        self.extra_tool_targets = set()
+        self.has_errors = False
+
+    def on_event(self, event):
+        if event['_typename'] == 'NEvent.TDisplayMessage' and event.get('Type') == 'Error':
+            self.has_errors = True
+        self._ev_listener(event)
+
+    def put_tool_targets(self, tool_targets):
+        self.tool_targets = set(tool_targets) | self.extra_tool_targets
+        if self._queue_putter:
+            self._queue_putter(self.tool_targets)
+
+
+def _rel_dir(path):
+    return os.path.dirname(path[len(SOURCE_ROOT_PREFIX) :])
+
+
+def _is_under(path, rel_dir):
+    return not rel_dir or path == rel_dir or path.startswith(rel_dir + '/')
+
+
+def _module_dir(node):
+    return node.get('target_properties', {}).get('module_dir')
+
+
+def _include_dirs(node):
+    for cmd in node.get('cmds', []):
+        args = cmd.get('cmd_args', [])
+        for i, arg in enumerate(args):
+            for flag in INCLUDE_FLAGS:
+                if arg.startswith(flag):
+                    path = arg[len(flag) :] or (args[i + 1] if i + 1 < len(args) else '')
+                    if path == SOURCE_ROOT_PREFIX[:-1]:
+                        yield ''
+                    elif path.startswith(SOURCE_ROOT_PREFIX):
+                        yield path[len(SOURCE_ROOT_PREFIX) :].rstrip('/')
+                    break
+
+
+def _source_dirs(node):
+    """Source directories a node depends on: of its inputs, include search and module directories"""
+    for path in node.get('inputs', []):
+        if path.startswith(SOURCE_ROOT_PREFIX):
+            yield _rel_dir(path)
+    for path in _include_dirs(node):
+        yield path
+    if _module_dir(node) is not None:
+        yield _module_dir(node)
+
+
+def _globs(make_file_content):
+    """Whether ya.make lists files by masks and whether the masks stay inside of its directory"""
+    args = GLOB_MACRO_RE.findall(make_file_content)
+    local = all('..' not in x and '${' not in x.replace('${CURDIR}', '') for x in args)
+    return bool(args), local
+
+
+def _closure(by_uid, uids):
+    seen = {}
+    stack = list(uids)
+    while stack:
+        uid = stack.pop()
+        if uid in seen or uid not in by_uid:
+            continue
+        node = by_uid[uid]
+        seen[uid] = node
+        stack.extend(node.get('deps', []))
+    return seen
+
+
+def _to_ccgraph(graph_json):
+    output = ccgraph.CppStringWrapper()
+    output.append(graph_json)
+    return ccgraph.Graph(ymake_output=output)
+
+
+def _read(path):
+    if path and os.path.exists(path):
+        return exts.fs.read_file(path)
+    return None
+
+
+def _write(path, data):
+    if path and data is not None:
+        exts.fs.write_file(path, data)
+
+
+def _attribute(graph, make_files, rel_targets):
+    """Source directories of the graph: per target and not attributable to any target"""
+    by_uid = {node['uid']: node for node in graph['graph']}
+    target_dirs = {}
+    target_results = {}
+    splittable = True
+
+    for result in graph.get('result', []):
+        module_dir = _module_dir(by_uid.get(result, {}))
+        owners = [t for t in rel_targets if module_dir is not None and _is_under(module_dir, t)]
+        if not owners:
+            splittable = False
+        for target in owners:
+            target_results.setdefault(target, []).append(result)
+
+    all_dirs = set()
+    for node in graph['graph']:
+        all_dirs.update(_source_dirs(node))
+    for entry in make_files:
+        path = entry.get('PATH', '')
+        if path.startswith(MAKE_FILE_PREFIX):
+            all_dirs.add(os.path.dirname(path[len(MAKE_FILE_PREFIX) :]))
+
+    attributed = set()
+    for target in rel_targets:
+        dirs = {target}
+        for node in six.itervalues(_closure(by_uid, target_results.get(target, []))):
+            dirs.update(_source_dirs(node))
+        target_dirs[target] = sorted(dirs)
+        attributed |= dirs
+    all_dirs |= attributed
+
+    return {
+        'dirs': sorted(all_dirs),
+        'target_dirs': target_dirs,
+        'target_results': target_results,
+        'unattributed': sorted(all_dirs - attributed),
+        'splittable': splittable,
+    }
+
+
+def _splice(base, new, clean_results):
+    """Cached subgraphs of clean results plus the regenerated graph. Nodes are shared by uid"""
+    kept = _closure({node['uid']: node for node in base['graph']}, clean_results)
+    nodes = list(new['graph'])
+    seen = set(node['uid'] for node in nodes)
+    for node in base['graph']:
+        if node['uid'] in kept and node['uid'] not in seen:
+            nodes.append(node)
+
+    merged = dict(new)
+    merged['graph'] = nodes
+    merged['result'] = sorted(set(new.get('result', [])) | set(clean_results))
+    if isinstance(base.get('inputs'), dict) and isinstance(new.get('inputs'), dict):
+        inputs = dict(base['inputs'])
+        inputs.update(new['inputs'])
+        merged['inputs'] = inputs
+    return merged
+
+
+class Plan(object):
+    """What to do with a ymake run: reuse the cached graph, regenerate some targets or everything"""
+
+    def __init__(self, cache, key, abs_targets, recorder, manifest=None, dirty_targets=None):
+        self._cache = cache
+        self._key = key
+        self._abs_targets = abs_targets
+        self._recorder = recorder
+        self._manifest = manifest
+        # Targets for ymake when the graph is spliced
+        self.dirty_targets = dirty_targets
+
+    @property
+    def hit(self):
+        return self._manifest is not None and not self.dirty_targets
+
+    def restore(self, test_dart_path, java_dart_path, make_files_dart_path):
+        """Cached graph as a ccgraph, darts are written to the given paths"""
+        entry = self._cache.entry_dir(self._key)
+        # Entries are evicted by mtime
+        os.utime(entry, None)
+        _write(test_dart_path, _read(os.path.join(entry, 'test.dart')))
+        _write(java_dart_path, _read(os.path.join(entry, 'java.dart')))
+        _write(make_files_dart_path, _read(os.path.join(entry, 'makefiles.dart')) or b'')
+        if self._recorder:
+            self._recorder.put_tool_targets(self._manifest['tool_targets'])
+        return _to_ccgraph(exts.fs.read_file(os.path.join(entry, 'graph.json')))
+
+    def store(self, graph, test_dart_path, java_dart_path, make_files_dart_path):
+        """Saves the graph made by ymake, returns the graph to use: spliced into the cached one if needed"""
+        if self._recorder and self._recorder.has_errors:
+            logger.debug('Graph %s is not cached due to configure errors', self._key)
+            return graph
+
+        graph_dict = graph.get()
+        make_files_dart = _read(make_files_dart_path) or b''
+        if self.dirty_targets:
+            entry = self._cache.entry_dir(self._key)
+            base = json.loads(exts.fs.read_file(os.path.join(entry, 'graph.json')))
+            dirty = set(self._cache.rel_path(t) for t in self.dirty_targets)
+            clean_results = set()
+            for target, results in six.iteritems(self._manifest['target_results']):
+                if target not in dirty:
+                    clean_results.update(results)
+            graph_dict = _splice(base, graph_dict, sorted(clean_results))
+            base_make_files_dart = _read(os.path.join(entry, 'makefiles.dart')) or b''
+            make_files_dart = base_make_files_dart + DART_SEPARATOR + make_files_dart
+            _write(make_files_dart_path, make_files_dart)
+            logger.debug('Spliced %d regenerated targets into cached graph %s', len(dirty), self._key)
+
+        graph_json = six.ensure_binary(json.dumps(graph_dict))
+        try:
+            self._cache.save(
+                self._key,
+                graph_dict,
+                graph_json,
+                self._abs_targets,
+                make_files_dart,
+                _read(test_dart_path),
+                _read(java_dart_path),
+                sorted(self._recorder.tool_targets) if self._recorder else [],
+            )
+        except Exception:
+            logger.exception('Cannot save graph %s into the cache', self._key)
+
+        if self.dirty_targets:
+            return _to_ccgraph(graph_json)
+        return graph
+
+
+class GraphCache(object):
+    def __init__(self, cache_root, src_dir, imprint):
+        self._cache_root = cache_root
+        self._src_dir = src_dir
+        self._imprint = imprint
+        # Imprint caches are not thread-safe, graphs for platforms are made in parallel
+        self._lock = threading.Lock()
+
+    def rel_path(self, abs_path):
+        rel_path = os.path.relpath(abs_path, self._src_dir).replace(os.sep, '/')
+        return '' if rel_path == '.' else rel_path
+
+    def entry_dir(self, key):
+        return os.path.join(self._cache_root, key)
+
+    def _key(self, ymake_opts):
+        opts = {k: v for k, v in six.iteritems(ymake_opts) if k not in _KEY_IGNORED_OPTS}
+        opts['conf'] = hashing.md5_file(ymake_opts['custom_conf'])
+        opts['darts'] = sorted(k for k in ('dump_tests', 'dump_java') if ymake_opts.get(k))
+        opts['targets'] = sorted(self.rel_path(t) for t in ymake_opts['abs_targets'])
+        opts['version'] = VERSION
+        return hashing.md5_value(json.dumps(opts, sort_keys=True, default=str))
+
+    def _abs_dirs(self, rel_dirs):
+        return {os.path.join(self._src_dir, d) if d else self._src_dir: d for d in rel_dirs}
+
+    def _imprints(self, rel_dirs):
+        abs_dirs = self._abs_dirs(rel_dirs)
+        if not abs_dirs:
+            return {}
+        with self._lock:
+            imprints = self._imprint.shallow_dir_imprints(*abs_dirs)
+        return {abs_dirs[d]: v for d, v in six.iteritems(imprints)}
+
+    def _deep_imprints(self, rel_dirs):
+        """Imprints of directories with subdirectories, a missing directory has None"""
+        abs_dirs = {d: rel for d, rel in six.iteritems(self._abs_dirs(rel_dirs)) if os.path.isdir(d)}
+        imprints = dict.fromkeys(rel_dirs)
+        if abs_dirs:
+            with self._lock:
+                imprints.update({abs_dirs[d]: v for d, v in six.iteritems(self._imprint(*abs_dirs))})
+        return imprints
+
+    def _glob_dirs(self, make_files):
+        """Directories of ya.make files with globs, None if a glob goes outside of its directory"""
+        dirs = set()
+        for entry in make_files:
+            path = entry.get('PATH', '')
+            if not path.startswith(MAKE_FILE_PREFIX):
+                continue
+            try:
+                content = six.ensure_str(exts.fs.read_file(os.path.join(self._src_dir, path[len(MAKE_FILE_PREFIX) :])))
+            except (IOError, OSError):
+                continue
+            has_globs, local = _globs(content)
+            if not local:
+                logger.debug('Globs of %s are not bound to its directory', path)
+                return None
+            if has_globs:
+                dirs.add(os.path.dirname(path[len(MAKE_FILE_PREFIX) :]))
+        return sorted(dirs)
+
+    def _conf_imprint(self):
+        paths = [os.path.join(self._src_dir, d) for d in CONF_DIRS]
+        paths = [p for p in paths if os.path.isdir(p)]
+        if not paths:
+            return None
+        with self._lock:
+            return self._imprint.generate_path_imprint(paths)
+
+    def _load_manifest(self, key):
+        try:
+            with open(os.path.join(self.entry_dir(key), 'manifest.json')) as f:
+                manifest = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        return manifest if manifest.get('version') == VERSION else None
+
+    def plan(self, ymake_opts, recorder=None):
+        abs_targets = list(ymake_opts['abs_targets'])
+        key = self._key(ymake_opts)
+        manifest = self._load_manifest(key)
+        if manifest is None:
+            logger.debug('Graph %s is not cached', key)
+            return Plan(self, key, abs_targets, recorder)
+
+        if manifest['conf_imprint'] != self._conf_imprint():
+            logger.debug('Configuration has changed since graph %s was cached', key)
+            return Plan(self, key, abs_targets, recorder)
+
+        imprints = self._imprints(manifest['dirs'])
+        changed = set(d for d in manifest['dirs'] if manifest['imprints'].get(d) != imprints.get(d))
+        deep_imprints = self._deep_imprints(manifest['glob_dirs'])
+        changed.update(d for d in manifest['glob_dirs'] if manifest['deep_imprints'].get(d) != deep_imprints.get(d))
+        if not changed:
+            logger.debug('Graph %s is up to date', key)
+            return Plan(self, key, abs_targets, recorder, manifest)
+
+        logger.debug('%d directories have changed since graph %s was cached', len(changed), key)
+        can_splice = (
+            manifest['splittable']
+            and not changed.intersection(manifest['unattributed'])
+            # Darts are not split by targets
+            and not ymake_opts.get('dump_tests')
+            and not ymake_opts.get('dump_java')
+        )
+        if not can_splice:
+            return Plan(self, key, abs_targets, recorder)
+
+        dirty_targets = [t for t in abs_targets if changed.intersection(manifest['target_dirs'][self.rel_path(t)])]
+        if len(dirty_targets) == len(abs_targets):
+            return Plan(self, key, abs_targets, recorder)
+
+        logger.debug('Regenerating %d of %d targets of graph %s', len(dirty_targets), len(abs_targets), key)
+        if recorder:
+            recorder.extra_tool_targets = set(manifest['tool_targets'])
+        return Plan(self, key, abs_targets, recorder, manifest, dirty_targets)
+
+    def save(self, key, graph, graph_json, abs_targets, make_files_dart, test_dart, java_dart, tool_targets):
+        rel_targets = [self.rel_path(t) for t in abs_targets]
+        make_files = bml.parse_make_files_dart(six.ensure_str(make_files_dart).split('\n'))
+        glob_dirs = self._glob_dirs(make_files)
+        if glob_dirs is None:
+            # Imprints can't tell if files matching the globs are added
+            logger.debug('Graph %s is not cached due to globs outside of module directories', key)
+            return
+        manifest = _attribute(graph, make_files, rel_targets)
+        imprints = self._imprints(manifest['dirs'])
+        manifest.update(
+            {
+                'version': VERSION,
+                'conf_imprint': self._conf_imprint(),
+                'imprints': imprints,
+                'glob_dirs': glob_dirs,
+                'deep_imprints': self._deep_imprints(glob_dirs),
+                'tool_targets': tool_targets,
+            }
+        )
+
+        tmp_dir = self.entry_dir(key) + '.tmp.' + str(random.random())
+        exts.fs.ensure_dir(tmp_dir)
+        _write(os.path.join(tmp_dir, 'graph.json'), graph_json)
+        _write(os.path.join(tmp_dir, 'makefiles.dart'), make_files_dart)
+        _write(os.path.join(tmp_dir, 'test.dart'), test_dart)
+        _write(os.path.join(tmp_dir, 'java.dart'), java_dart)
+        _write(os.path.join(tmp_dir, 'manifest.json'), json.dumps(manifest))
+        exts.fs.replace(tmp_dir, self.entry_dir(key))
+        logger.debug('Graph %s is cached with %d source directories', key, len(manifest['dirs']))
+        self._cleanup()
+
+    def _cleanup(self):
+        entries = []
+        for name in os.listdir(self._cache_root):
+            path = os.path.join(self._cache_root, name)
+            if '.tmp.' in name:
+                # Leftovers of interrupted runs
+                if time.time() - os.path.getmtime(path) > 60 * 60:
+                    exts.fs.remove_tree_safe(path)
+            else:
+                entries.append((os.path.getmtime(path), path))
+        for _, path in sorted(entries, reverse=True)[MAX_ENTRIES:]:
+            exts.fs.remove_tree_safe(path)
@@ -0,0 +1,441 @@
+"""
+Compact binary build graph, loadable without parsing via mmap.
+
+Layout: header, section table and sections, all little-endian and 8-byte aligned.
+  strings            - interned strings: offsets (Q, count + 1) and utf-8 blob
+  uids               - string id of every node uid (I)
+  columns            - per-node bit mask of the present deps, inputs and outputs keys (B)
+  deps               - CSR: per-node row offsets (Q, nodes + 1) and dependency node ids (I)
+  inputs, outputs    - CSR of string ids
+  extra              - per-node JSON of the remaining node keys (cmds, kv, ...): offsets (Q) and blob
+  top                - JSON of the top level keys except 'graph' (conf, result, inputs, ...)
+
+load() returns PackedGraph, a dict whose 'graph' is a lazy sequence of dict-like node views,
+so code reading graph['graph'] works unchanged. Node keys are decoded on access and kept by the view,
+so in-place changes of deps, inputs and outputs lists stick. A node is copied when its keys are modified. to_dict() materializes the plain JSON-like graph for code which needs it.
+"""
+
+from __future__ import print_function
+import mmap
+import os
+import struct
+
+import six
+from six.moves import collections_abc
+
+import exts.yjson as json
+
+MAGIC = b'YAGRAPH2'
+HEADER_FMT = '<8sIII'  # magic, nodes, strings, sections
+SECTIONS = (
+    'string_offsets',
+    'string_blob',
+    'uids',
+    'columns',
+    'deps_offsets',
+    'deps_ids',
+    'inputs_offsets',
+    'inputs_ids',
+    'outputs_offsets',
+    'outputs_ids',
+    'extra_offsets',
+    'extra_blob',
+    'top',
+)
+SECTION_FMT = '<QQ'  # offset, length
+COLUMNS = ('uid', 'deps', 'inputs', 'outputs')
+# Columns which nodes may lack, bit i of the columns section is set if OPTIONAL_COLUMNS[i] is present
+OPTIONAL_COLUMNS = COLUMNS[1:]
+
+
+class PackedGraphError(Exception):
+    pass
+
+
+def is_packed(path):
+    """True for a packed graph of any version, loading of other versions fails with PackedGraphError"""
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(MAGIC))[:-1] == MAGIC[:-1]
+    except (IOError, OSError):
+        return False
+
+
+class _Strings(object):
+    def __init__(self):
+        self._ids = {}
+        self.items = []
+
+    def id(self, s):
+        try:
+            return self._ids[s]
+        except KeyError:
+            self._ids[s] = len(self.items)
+            self.items.append(s)
+            return self._ids[s]
+
+
+def _pack_array(fmt, values):
+    return struct.pack('<{}{}'.format(len(values), fmt), *values)
+
+
+def _pack_csr(rows):
+    offsets = [0]
+    ids = []
+    for row in rows:
+        ids.extend(row)
+        offsets.append(len(ids))
+    return _pack_array('Q', offsets), _pack_array('I', ids)
+
+
+def _pack_blobs(blobs):
+    offsets = [0]
+    for blob in blobs:
+        offsets.append(offsets[-1] + len(blob))
+    return _pack_array('Q', offsets), b''.join(blobs)
+
+
+def dump(graph, fp):
+    """Writes graph (JSON-like dict or PackedGraph) into binary file object fp"""
+    nodes = graph['graph']
+    strings = _Strings()
+    node_ids = {}
+    for i, node in enumerate(nodes):
+        node_ids[node['uid']] = i
+
+    uids = []
+    columns = []
+    deps = []
+    inputs = []
+    outputs = []
+    extra = []
+    for node in nodes:
+        uids.append(strings.id(node['uid']))
+        columns.append(sum(1 << i for i, key in enumerate(OPTIONAL_COLUMNS) if key in node))
+        try:
+            deps.append([node_ids[dep] for dep in node.get('deps', [])])
+        except KeyError as e:
+            raise PackedGraphError('Node {} depends on unknown node {}'.format(node['uid'], e))
+        inputs.append([strings.id(x) for x in node.get('inputs', [])])
+        outputs.append([strings.id(x) for x in node.get('outputs', [])])
+        rest = dict((k, v) for k, v in six.iteritems(node) if k not in COLUMNS)
+        extra.append(six.ensure_binary(json.dumps(rest, sort_keys=True)))
+
+    sections = {}
+    sections['string_offsets'], sections['string_blob'] = _pack_blobs([six.ensure_binary(s) for s in strings.items])
+    sections['uids'] = _pack_array('I', uids)
+    sections['columns'] = _pack_array('B', columns)
+    sections['deps_offsets'], sections['deps_ids'] = _pack_csr(deps)
+    sections['inputs_offsets'], sections['inputs_ids'] = _pack_csr(inputs)
+    sections['outputs_offsets'], sections['outputs_ids'] = _pack_csr(outputs)
+    sections['extra_offsets'], sections['extra_blob'] = _pack_blobs(extra)
+    top = dict((k, v) for k, v in six.iteritems(graph) if k != 'graph')
+    sections['top'] = six.ensure_binary(json.dumps(top, sort_keys=True))
+
+    offset = struct.calcsize(HEADER_FMT) + len(SECTIONS) * struct.calcsize(SECTION_FMT)
+    table = []
+    for name in SECTIONS:
+        offset = (offset + 7) & ~7
+        table.append((offset, len(sections[name])))
+        offset += len(sections[name])
+
+    fp.write(struct.pack(HEADER_FMT, MAGIC, len(uids), len(strings.items), len(SECTIONS)))
+    for entry in table:
+        fp.write(struct.pack(SECTION_FMT, *entry))
+    pos = struct.calcsize(HEADER_FMT) + len(SECTIONS) * struct.calcsize(SECTION_FMT)
+    for name, (offset, length) in zip(SECTIONS, table):
+        fp.write(b'\0' * (offset - pos))
+        fp.write(sections[name])
+        pos = offset + length
+
+
+class _Data(object):
+    """Sections of an mmap'd packed graph"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.nodes, self.strings, sections = struct.unpack_from(HEADER_FMT, self._mm, 0)
+        if magic[:-1] == MAGIC[:-1] and magic != MAGIC:
+            raise PackedGraphError('{} is packed by another version, repack it'.format(path))
+        if magic != MAGIC or sections != len(SECTIONS):
+            raise PackedGraphError('{} is not a packed graph'.format(path))
+        pos = struct.calcsize(HEADER_FMT)
+        self._sections = {}
+        for name in SECTIONS:
+            self._sections[name] = struct.unpack_from(SECTION_FMT, self._mm, pos)
+            pos += struct.calcsize(SECTION_FMT)
+        self._string_cache = [None] * self.strings
+
+    def close(self):
+        self._mm.close()
+
+    def _item(self, section, fmt, i):
+        return struct.unpack_from('<' + fmt, self._mm, self._sections[section][0] + i * struct.calcsize(fmt))[0]
+
+    def _items(self, section, fmt, start, end):
+        return struct.unpack_from(
+            '<{}{}'.format(end - start, fmt), self._mm, self._sections[section][0] + start * struct.calcsize(fmt)
+        )
+
+    def _blob(self, name, i):
+        start, end = self._items(name + '_offsets', 'Q', i, i + 2)
+        offset = self._sections[name + '_blob'][0]
+        return self._mm[offset + start : offset + end]
+
+    def string(self, i):
+        s = self._string_cache[i]
+        if s is None:
+            s = six.ensure_str(self._blob('string', i))
+            self._string_cache[i] = s
+        return s
+
+    def row(self, name, i):
+        start, end = self._items(name + '_offsets', 'Q', i, i + 2)
+        return self._items(name + '_ids', 'I', start, end)
+
+    def uid(self, i):
+        return self.string(self._item('uids', 'I', i))
+
+    def columns(self, i):
+        """Present node keys of COLUMNS"""
+        mask = self._item('columns', 'B', i)
+        return ('uid',) + tuple(key for bit, key in enumerate(OPTIONAL_COLUMNS) if mask & (1 << bit))
+
+    def deps(self, i):
+        """Dependencies as node ids"""
+        return self.row('deps', i)
+
+    def strings_row(self, name, i):
+        return [self.string(x) for x in self.row(name, i)]
+
+    def extra(self, i):
+        return json.loads(six.ensure_str(self._blob('extra', i)))
+
+    def top(self):
+        offset, length = self._sections['top']
+        return json.loads(six.ensure_str(self._mm[offset : offset + length]))
+
+
+class NodeView(collections_abc.MutableMapping):
+    """
+    Node of a packed graph, behaves as the node dict.
+    Decoded lists are kept, so they can be changed in place. Modification of keys turns the view into a plain copy.
+    """
+
+    __slots__ = ('_data', '_id', '_keys', '_columns', '_extra', '_dict')
+
+    def __init__(self, data, node_id):
+        self._data = data
+        self._id = node_id
+        self._keys = None
+        self._columns = {}
+        self._extra = None
+        self._dict = None
+
+    @property
+    def node_id(self):
+        return self._id
+
+    def dep_ids(self):
+        """Dependencies as node ids, without decoding their uids. Changes of node['deps'] are not reflected"""
+        return self._data.deps(self._id)
+
+    def _get_extra(self):
+        if self._extra is None:
+            self._extra = self._data.extra(self._id)
+        return self._extra
+
+    def _get_keys(self):
+        if self._keys is None:
+            self._keys = self._data.columns(self._id)
+        return self._keys
+
+    def _column(self, key):
+        if key == 'uid':
+            return self._data.uid(self._id)
+        value = self._columns.get(key)
+        if value is None:
+            if key == 'deps':
+                value = [self._data.uid(x) for x in self._data.deps(self._id)]
+            else:
+                value = self._data.strings_row(key, self._id)
+            self._columns[key] = value
+        return value
+
+    def __getitem__(self, key):
+        if self._dict is not None:
+            return self._dict[key]
+        if key in COLUMNS:
+            if key not in self._get_keys():
+                raise KeyError(key)
+            return self._column(key)
+        return self._get_extra()[key]
+
+    def __contains__(self, key):
+        if self._dict is not None:
+            return key in self._dict
+        if key in COLUMNS:
+            return key in self._get_keys()
+        return key in self._get_extra()
+
+    def __iter__(self):
+        if self._dict is not None:
+            return iter(self._dict)
+        return iter(self._get_keys() + tuple(self._get_extra()))
+
+    def __len__(self):
+        if self._dict is not None:
+            return len(self._dict)
+        return len(self._get_keys()) + len(self._get_extra())
+
+    def to_dict(self):
+        if self._dict is not None:
+            return self._dict
+        d = dict((key, self._column(key)) for key in self._get_keys())
+        d.update(self._get_extra())
+        return d
+
+    def _materialize(self):
+        if self._dict is None:
+            self._dict = self.to_dict()
+            self._keys = None
+            self._columns = {}
+            self._extra = None
+
+    def __setitem__(self, key, value):
+        self._materialize()
+        self._dict[key] = value
+
+    def __delitem__(self, key):
+        self._materialize()
+        del self._dict[key]
+
+    def __repr__(self):
+        return 'NodeView({})'.format(self['uid'])
+
+
+class NodeList(collections_abc.MutableSequence):
+    """graph['graph'] of a packed graph. Node views are created on access and kept, appended nodes are plain dicts"""
+
+    def __init__(self, data):
+        self._data = data
+        self._nodes = [None] * data.nodes
+        self._uid_index = None
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def _node(self, i):
+        node = self._nodes[i]
+        if node is None:
+            node = self._nodes[i] = NodeView(self._data, i)
+        return node
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._node(x) for x in six.moves.xrange(*i.indices(len(self._nodes)))]
+        if i < 0:
+            i += len(self._nodes)
+        if not 0 <= i < len(self._nodes):
+            raise IndexError(i)
+        return self._node(i)
+
+    def __iter__(self):
+        for i in six.moves.xrange(len(self._nodes)):
+            yield self._node(i)
+
+    def __setitem__(self, i, node):
+        self._nodes[i] = node
+        self._uid_index = None
+
+    def __delitem__(self, i):
+        # Materialize views, since they are addressed by position
+        for x in six.moves.xrange(len(self._nodes)):
+            self._node(x)
+        del self._nodes[i]
+        self._uid_index = None
+
+    def insert(self, i, node):
+        for x in six.moves.xrange(len(self._nodes)):
+            self._node(x)
+        self._nodes.insert(i, node)
+        self._uid_index = None
+
+    def append(self, node):
+        self._nodes.append(node)
+        self._uid_index = None
+
+    def find(self, uid):
+        """Node by uid or None, the index is built on the first call"""
+        if self._uid_index is None:
+            self._uid_index = {}
+            for i in six.moves.xrange(len(self._nodes)):
+                node = self._nodes[i]
+                key = node['uid'] if node is not None else self._data.uid(i)
+                self._uid_index[key] = i
+        i = self._uid_index.get(uid)
+        return None if i is None else self._node(i)
+
+
+class PackedGraph(dict):
+    """Top level graph dict, 'graph' is a NodeList over the mmap'd file"""
+
+    def __init__(self, path):
+        self._data = _Data(path)
+        super(PackedGraph, self).__init__(self._data.top())
+        self['graph'] = NodeList(self._data)
+
+    def close(self):
+        """Views of the graph nodes are unusable after close"""
+        self._data.close()
+
+    def to_dict(self):
+        graph = dict(self)
+        graph['graph'] = [node.to_dict() if isinstance(node, NodeView) else node for node in self['graph']]
+        return graph
+
+
+def load(path):
+    return PackedGraph(path)
+
+
+def pack_file(json_path, packed_path):
+    with open(json_path) as f:
+        graph = json.load(f)
+    tmp_path = packed_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        dump(graph, f)
+    os.rename(tmp_path, packed_path)
+
+
+if __name__ == '__main__':
+    import resource
+    import sys
+    import time
+
+    # python packed_graph.py graph.json graph.packed - converts the graph and compares loading
+    json_path, packed_path = sys.argv[1:3]
+    t1 = time.time()
+    pack_file(json_path, packed_path)
+    t2 = time.time()
+    print('pack (s)', t2 - t1)
+    print('json size (bytes)', os.path.getsize(json_path))
+    print('packed size (bytes)', os.path.getsize(packed_path))
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t1 = time.time()
+    g = load(packed_path)
+    deps = sum(len(node.dep_ids()) for node in g['graph'])
+    t2 = time.time()
+    print('packed load and deps walk (s)', t2 - t1, 'edges', deps)
+    print('packed max rss growth (KiB)', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss)
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t1 = time.time()
+    with open(json_path) as f:
+        j = json.load(f)
+    deps = sum(len(node.get('deps', [])) for node in j['graph'])
+    t2 = time.time()
+    print('json load and deps walk (s)', t2 - t1, 'edges', deps)
+    print('json max rss growth (KiB)', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss)
@@ -69,6 +69,7 @@ import build.build_result as br
 import build.gen_plan as gp
 import build.graph as lg
 import build.makefile as mk
+import build.packed_graph as packed_graph
 import build.owners as ow
 import build.stat.graph_metrics as st
 import build.stat.statistics as bs
@@ -373,7 +374,11 @@ def make_cache(opts, garbage_dir):
         from yalibrary.store import new_store
 
         # FIXME: This suspected to have some race condition in current content_uids implementation (see YMAKE-701)
-        store = new_store.NewStore(os.path.join(garbage_dir, 'cache', '6'))
+        store = new_store.NewStore(
+            os.path.join(garbage_dir, 'cache', new_store.GENERATION),
+            chunked_min_size=getattr(opts, 'new_store_chunked_min_size', None),
+            eviction_policy=getattr(opts, 'new_store_eviction_policy', None),
+        )
         return store
     else:
         return ring_store.RingStore(os.path.join(garbage_dir, 'cache', CACHE_GENERATION))
@@ -605,6 +610,21 @@ def get_suites_exit_code(suites, test_fail_exit_code=const.TestRunExitCode.Faile
 
 
 # TODO: Merge to Context
+def _load_custom_graph(opts):
+    if not packed_graph.is_packed(opts.custom_json):
+        with udopen(opts.custom_json) as custom_json_file:
+            return json.load(custom_json_file)
+
+    graph = packed_graph.load(opts.custom_json)
+    # Nodes are lazy views over the mmap'd file, serialized graphs (distbuild, dumps, saved context) must be plain
+    serialized = opts.use_distbuild or opts.dump_graph or getattr(opts, 'save_context_to', None)
+    if serialized or opts.use_lite_graph:
+        plain = graph.to_dict()
+        graph.close()
+        return plain
+    return graph
+
+
 class BuildContext(object):
     @classmethod
     def load(cls, params, app_ctx, data):
@@ -847,9 +867,8 @@ class Context(object):
             self.configure_errors = load_configure_errors(configure_errors)
             self.make_files = make_files or []
         elif opts.custom_json is not None and opts.custom_json:
-            with udopen(opts.custom_json) as custom_json_file:
-                self.graph = json.load(custom_json_file)
-                lg.finalize_graph(self.graph, opts)
+            self.graph = _load_custom_graph(opts)
+            lg.finalize_graph(self.graph, opts)
             self.tests = []
             self.stripped_tests = []
             self.make_files = []
@@ -1693,6 +1712,9 @@ class YaMake(object):
                         last_failed.cache_test_statuses(
                             res, self.ctx.tests, self.ctx.garbage_dir, self.opts.last_failed_tests
                         )
+                    if getattr(self.opts, 'balance_test_chunks', False):
+                        with stager.scope('cache_test_durations'):
+                            last_failed.cache_test_durations(res, self.ctx.tests, self.ctx.garbage_dir)
 
             if self.opts.print_test_console_report:
                 self._test_console_report()
@@ -427,6 +427,7 @@ class LogFileOptions(Options):
 class EventLogFileOptions(Options):
     def __init__(self):
         self.evlog_file = None
+        self.evlog_indexed = False
         self.no_evlogs = False
         self.dump_platform_to_evlog = False
         self.dump_failed_node_info_to_evlog = False
@@ -445,6 +446,15 @@ class EventLogFileOptions(Options):
             EnvConsumer(
                 name='YA_EVLOG_FILE', help='Dump event log into specified file', hook=SetValueHook('evlog_file')
             ),
+            ArgConsumer(
+                ['--evlog-indexed'],
+                help='Write event logs in indexed format (".evlog.zblk") which is faster to analyze',
+                hook=SetConstValueHook('evlog_indexed', True),
+                group=PRINT_CONTROL_GROUP,
+                visible=HelpLevel.INTERNAL,
+            ),
+            EnvConsumer('YA_EVLOG_INDEXED', hook=SetValueHook('evlog_indexed', return_true_if_enabled)),
+            ConfigConsumer('evlog_indexed'),
             ArgConsumer(
                 ['--no-evlogs'],
                 help='Disable standard evlogs in YA_CACHE_DIR',
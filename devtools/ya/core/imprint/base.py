@@ -1,6 +1,7 @@
 import logging
 import os
 import tempfile
+import threading
 
 from six import iteritems
 
@@ -32,29 +33,34 @@ class SimpleMapper(BaseMapper):
 
 
 class ThreadPoolMapper(SimpleMapper):
+    """Maps big batches (cold trees) in a thread pool shared by all mappers, small ones in place"""
+
     class _FakePool(object):
         @staticmethod
-        def map(*args, **kwargs):
-            return list(map(*args, **kwargs))
+        def map(f, items, chunksize=None):
+            return list(map(f, items))
 
     pool = None
+    _pool_lock = threading.Lock()
+    MIN_PARALLEL_ITEMS = 64
 
     @classmethod
     def _init_pool(cls):
-        try:
-            if cls.pool is None:
-                cls.pool = ThreadPool(cpu_count())
-        except RuntimeError:
-            logging.exception("Can't create thread pool for ThreadPoolMapper; Using FakePool")
-            cls.pool = cls._FakePool()
-
-    def __init__(self, f):
-        super(ThreadPoolMapper, self).__init__(f)
-        self.pool = ThreadPool(cpu_count())
+        with cls._pool_lock:
+            try:
+                if ThreadPoolMapper.pool is None:
+                    ThreadPoolMapper.pool = ThreadPool(cpu_count())
+            except RuntimeError:
+                logging.exception("Can't create thread pool for ThreadPoolMapper; Using FakePool")
+                ThreadPoolMapper.pool = cls._FakePool()
+        return ThreadPoolMapper.pool
 
     def __call__(self, *items):
+        if len(items) < self.MIN_PARALLEL_ITEMS:
+            return super(ThreadPoolMapper, self).__call__(*items)
         # TODO: yieldable map?
-        return dict(zip(items, self.pool.map(self.f, items)))
+        pool = self._init_pool()
+        return dict(zip(items, pool.map(self.f, items, chunksize=16)))
 
 
 class Stats:
@@ -0,0 +1,141 @@
+import logging
+import os
+import tempfile
+
+import six
+
+logger = logging.getLogger(__name__)
+
+
+def stat_key(path):
+    """(dev, inode, size, mtime_ns) of the file, content is assumed to be the same while they are"""
+    st = os.stat(path)
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1000000000)
+    return st.st_dev, st.st_ino, st.st_size, mtime_ns
+
+
+class ContentHashIndex(object):
+    """
+    Persistent path -> content hash index.
+    The file is a log of text records: new entries are appended by store(), the last record of a path wins.
+    A torn record at the end (interrupted write) is skipped. The log is rewritten when it contains
+    too many superseded records.
+    """
+
+    VERSION = 1
+    HEADER = 'content-hash-index {}\n'.format(VERSION)
+    # Rewrite the log when it is that much larger than the index
+    COMPACT_FACTOR = 2
+    COMPACT_MIN_RECORDS = 10000
+
+    def __init__(self, path, read=True):
+        self._path = path
+        # path -> (stat key, hash)
+        self._entries = {}
+        self._pending = {}
+        self._records = 0
+        self._loaded = not read
+        self._needs_rewrite = False
+
+    def __len__(self):
+        self._load()
+        return len(self._entries)
+
+    @staticmethod
+    def _parse(line):
+        parts = line.split('\t')
+        if len(parts) != 6:
+            return None
+        try:
+            return parts[0], (tuple(int(x) for x in parts[1:5]), parts[5])
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _format(path, key, value):
+        return '{}\t{}\t{}\t{}\t{}\t{}\n'.format(path, key[0], key[1], key[2], key[3], value)
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            with open(self._path, 'rb') as f:
+                data = six.ensure_str(f.read())
+        except (IOError, OSError):
+            return
+        if not data.startswith(self.HEADER):
+            logger.debug('Ignore content hash index %s of unknown version', self._path)
+            self._needs_rewrite = True
+            return
+
+        lines = data[len(self.HEADER) :].split('\n')
+        # The last line is either empty or torn
+        for line in lines[:-1]:
+            parsed = self._parse(line)
+            if parsed:
+                self._entries[parsed[0]] = parsed[1]
+        self._records = len(lines) - 1
+        logger.debug('Loaded %d entries of content hash index %s', len(self._entries), self._path)
+
+    def get(self, path, key=None):
+        """Hash of the path, None if unknown or key (see stat_key) doesn't match. key=None skips validation"""
+        self._load()
+        entry = self._entries.get(path)
+        if entry is None or key is not None and entry[0] != key:
+            return None
+        return entry[1]
+
+    def set(self, path, key, value):
+        if '\t' in path or '\n' in path or self.get(path, key) == value:
+            return
+        self._entries[path] = (key, value)
+        self._pending[path] = (key, value)
+
+    def discard(self, path):
+        self._load()
+        self._entries.pop(path, None)
+        self._pending.pop(path, None)
+
+    def discard_tree(self, path):
+        self._load()
+        prefix = os.path.join(path, '')
+        for item in [p for p in self._entries if p == path or p.startswith(prefix)]:
+            self.discard(item)
+
+    def store(self):
+        if not self._pending:
+            return
+        records = self._records + len(self._pending)
+        if self._needs_rewrite or records > max(self.COMPACT_FACTOR * len(self._entries), self.COMPACT_MIN_RECORDS):
+            self._rewrite()
+        else:
+            self._append()
+        self._pending = {}
+
+    def _append(self):
+        data = ''.join(self._format(path, key, value) for path, (key, value) in six.iteritems(self._pending))
+        fd = os.open(self._path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size == 0:
+                data = self.HEADER + data
+            # A single write, so records of concurrent processes don't interleave
+            data = six.ensure_binary(data)
+            while data:
+                data = data[os.write(fd, data) :]
+        finally:
+            os.close(fd)
+        self._records += len(self._pending)
+
+    def _rewrite(self):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self._path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(six.ensure_binary(self.HEADER))
+            for path, (key, value) in six.iteritems(self._entries):
+                f.write(six.ensure_binary(self._format(path, key, value)))
+        os.rename(tmp_path, self._path)
+        self._records = len(self._entries)
+        self._needs_rewrite = False
+        logger.debug('Rewrote content hash index %s with %d entries', self._path, self._records)
@@ -3,13 +3,14 @@ import logging
 
 import six
 
-from exts import func, os2, hashing
+from exts import fs, func, os2, hashing
 from core.config import misc_root, find_root
 
 # from yalibrary.monitoring import YaMonEvent
 
-from .base import SimpleMapper, BaseCache, BaseFileCache
+from .base import SimpleMapper, ThreadPoolMapper, BaseCache
 from .change_list import ChangeList
+from .content_index import ContentHashIndex, stat_key
 
 
 class ArcPath:
@@ -52,118 +53,94 @@ class ArcPath:
         return path
 
 
-class YaStoredCache(BaseFileCache):
-    CACHE_PATH_DEFAULT = "{misc_root}/conf/cache/"
-    CACHE_FILE_DEFAULT = "fs.cache.{version}"
-    CACHE_VERSION = 1
-
-    def __init__(self, name, f, read=True, write=True, cache_source_path=None, process_arcadia_clash=True):
-        self.cache_source_path = cache_source_path
-        self.process_arcadia_clash = process_arcadia_clash
-
-        super(YaStoredCache, self).__init__(name, f, check=self._mtime_files_check, read=read, write=write)
-
-    def _generate_cache_path_parts(self):
-        if self.cache_source_path:
-            folder_format = self.cache_source_path
-        else:
-            folder_format = self.CACHE_PATH_DEFAULT
+CACHE_PATH_DEFAULT = "{misc_root}/conf/cache/"
 
-        file_format = self.CACHE_FILE_DEFAULT
 
-        if self.process_arcadia_clash:
-            file_format += "-{arcadia_hash}"
+def _cache_path_parts(cache_source_path, file_format, process_arcadia_clash, version):
+    folder_format = cache_source_path or CACHE_PATH_DEFAULT
 
-        fmt_keys = dict(misc_root=misc_root(), arcadia_hash=hashing.fast_hash(find_root()), version=self.CACHE_VERSION)
+    if process_arcadia_clash:
+        file_format += "-{arcadia_hash}"
 
-        path_name = folder_format.format(**fmt_keys)
-        file_name = file_format.format(**fmt_keys)
+    fmt_keys = dict(misc_root=misc_root(), arcadia_hash=hashing.fast_hash(find_root()), version=version)
 
-        return path_name, file_name
+    return folder_format.format(**fmt_keys), file_format.format(**fmt_keys)
 
-    def _generate_source_path(self):
-        path_name, file_name = self._generate_cache_path_parts()
 
-        self._create_dirs(path_name)
+class YaContentHashCache(BaseCache):
+    """
+    Content hashes of files persisted in ContentHashIndex.
+    An entry is valid while (dev, inode, size, mtime_ns) of the file are the same, only new hashes are written on store.
+    """
 
-        return os.path.join(path_name, file_name)
+    CACHE_FILE_DEFAULT = "content_hash.index.{version}"
+    CACHE_VERSION = 1
 
-    @staticmethod
-    def _mtime_files_check(abs_path, result):
-        return os.stat(abs_path).st_mtime != result['check']
+    def __init__(self, name, f, read=True, write=True, cache_source_path=None, process_arcadia_clash=True):
+        super(YaContentHashCache, self).__init__(name, f)
+        self.read = read
+        self.write = write
 
-    def _update_cache(self, abs_path, result):
-        return super(YaStoredCache, self)._update_cache(
-            abs_path, {'value': result, 'check': os.stat(abs_path).st_mtime}
+        path_name, file_name = _cache_path_parts(
+            cache_source_path, self.CACHE_FILE_DEFAULT, process_arcadia_clash, self.CACHE_VERSION
         )
+        if not os.path.exists(path_name):
+            fs.ensure_dir(path_name)
+        self._cache_path = os.path.join(path_name, file_name)
+        self._index = ContentHashIndex(self._cache_path, read=self.read)
+
+    def _apply(self, _items):
+        items = set(item for item in _items if item not in self._cache)
+        results = {}
+        to_calculate = {}
+        for abs_path in items:
+            try:
+                key = stat_key(abs_path)
+            except OSError:
+                # Let the hash function report it
+                key = None
+            value = self._index.get(abs_path, key) if key else None
+            if value is None:
+                to_calculate[abs_path] = key
+            else:
+                results[abs_path] = value
 
-    def _do_calcs(self, abs_paths):
-        for abs_path, result in super(YaStoredCache, self)._do_calcs(abs_paths):
-            yield abs_path, result['value']
-
-    def __getitem__(self, item):
-        return super(YaStoredCache, self).__getitem__(item)['value']
-
-    def _load_processor(self, data):
-        for rel_path, result in six.iteritems(data):
-            arc_path = ArcPath.to_abs(rel_path)
-            if arc_path:
-                yield arc_path, result
-
-    def _store_processor(self, data):
-        for abs_path, result in six.iteritems(data):
-            yield ArcPath.to_rel(abs_path), result
-
-    def _with_parents(self):
-        root = find_root()
-
-        results = set()
-
-        for path in self._cache.keys():
-            parent = path
-            while parent and (parent != "/") and (parent != root) and (parent not in results):
-                results.add(parent)
-                parent = os.path.dirname(parent)
+        self.stats.hit += len(items) - len(to_calculate)
+        self.stats.miss += len(to_calculate)
 
+        if to_calculate:
+            calculated = self.f(*to_calculate)
+            for abs_path, value in six.iteritems(calculated):
+                if to_calculate.get(abs_path):
+                    self._index.set(abs_path, to_calculate[abs_path], value)
+            results.update(calculated)
         return results
 
-    def _invalidate(self, rel_paths):
-        self.logger.debug("Start invalidation")
-        abs_paths = map(ArcPath.to_abs, rel_paths)
-
-        self.logger.debug("Create sorted list of files (%s)", len(self._cache.keys()))
-        sorted_items = tuple(sorted(self._with_parents()))
-
-        self.logger.debug("Create index map for files")
-        items_indexes = {item: index for index, item in enumerate(sorted_items)}
+    def use_change_list(self, items):
+        # Entries are validated by stat, so the change list is not trusted blindly and the check stays enabled
+        self._invalidate(items)
 
-        self.logger.debug("Calculate paths for invalidate")
-        to_invalidate = set()
-
-        for abs_path in abs_paths:
-            # clean child files
-            index = items_indexes.get(abs_path, None)
-            if index:
-                to_invalidate.add(abs_path)
-                index += 1
-
-                abs_folder_path = os.path.join(abs_path, "")  # Add separator
-
-                while index < len(sorted_items) and sorted_items[index].startswith(abs_folder_path):
-                    to_invalidate.add(sorted_items[index])
-                    index += 1
-
-        # Remove items
-        for item in to_invalidate:
-            if item in self._cache:
-                del self._cache[item]
+    def _invalidate(self, *args):
+        super(YaContentHashCache, self)._invalidate(*args)
+        if isinstance(self.f, BaseCache):
+            self.f._invalidate(*args)
 
-        # Clean sub-cache
-        # TODO: Duplicated part of code from super()
+    def clear(self):
+        super(YaContentHashCache, self).clear()
         if isinstance(self.f, BaseCache):
-            self.f._invalidate(rel_paths)
+            self.f.clear()
 
-        self.logger.debug("Invalidated %d items", len(to_invalidate))
+    def load(self):
+        self._index = ContentHashIndex(self._cache_path, read=self.read)
+
+    def store(self):
+        if not self.write:
+            self.logger.debug("cache write disabled, skip")
+            return
+        try:
+            self._index.store()
+        except (IOError, OSError):
+            self.logger.exception("can't save cache file into: %s", self._cache_path)
 
 
 class ImprintException(Exception):
@@ -187,11 +164,11 @@ class Imprint:
 
     @staticmethod
     def _new_content_hash():
-        return BaseCache("content_hash", SimpleMapper(hashing.fast_filehash))
+        return BaseCache("content_hash", ThreadPoolMapper(hashing.fast_filehash))
 
     def enable_fs(self, read=True, write=True, cache_source_path=None, process_arcadia_clash=True, quiet=False):
         # TODO: Check -xx
-        if isinstance(self._content_hash, YaStoredCache):
+        if isinstance(self._content_hash, YaContentHashCache):
             self.logger.warning("FS MD5 cache already enabled")
             if quiet:
                 return
@@ -201,7 +178,7 @@ class Imprint:
 
         self._content_hash.clear()
 
-        self._content_hash = YaStoredCache(
+        self._content_hash = YaContentHashCache(
             'content_hash_fs',
             self._content_hash,
             read=read,
@@ -212,7 +189,7 @@ class Imprint:
 
     def disable_fs(self):
         self.logger.debug("Disabling MD5 FS cache")
-        if isinstance(self._content_hash, YaStoredCache):
+        if isinstance(self._content_hash, YaContentHashCache):
             del self._content_hash
             self._content_hash = self._new_content_hash()
 
@@ -379,6 +356,29 @@ class Imprint:
 
             self._change_list_applied = True
 
+    def shallow_dir_imprints(self, *abs_paths):
+        """
+        Imprints of directories without their subdirectories: names and contents of the files right inside.
+        A missing directory gets an imprint of its path only.
+        """
+        self._check_args(abs_paths)
+        files = {}
+        for abs_path in abs_paths:
+            if self._is_build_dir(abs_path):
+                files[abs_path] = sorted(self._do_iter_files(abs_path, do_recursively=False))
+            else:
+                files[abs_path] = []
+
+        all_files = sum(six.itervalues(files), [])
+        self._rel_path.warm_up(*all_files)
+        self._rel_path.warm_up(*abs_paths)
+        self._content_hash.warm_up(*all_files)
+
+        return {
+            abs_path: self.combine_imprints(self._rel_path[abs_path], *(self._do_file(f) for f in files[abs_path]))
+            for abs_path in abs_paths
+        }
+
     # backward compatibility
 
     # DEPRECATED
@@ -16,6 +16,7 @@ from core.common_opts import CustomBuildRootOptions
 from build.build_opts import LocalCacheOptions, DistCacheSetupOptions, parse_size_arg, parse_timespan_arg
 from exts.windows import on_win
 from yalibrary.runner import result_store
+from yalibrary.store import eviction
 import yalibrary.toolscache as tc
 
 if six.PY3:
@@ -294,7 +295,11 @@ def _do_collect_cache(cache, build_root, opts):
 
     if opts.cache_size is not None and opts.object_size_limit is None and opts.age_limit is None:
         logger.debug('Cleaning for total size %s', opts.cache_size)
-        if hasattr(cache, 'strip'):
+        policy = getattr(opts, 'new_store_eviction_policy', None)
+        if policy and policy != eviction.DEFAULT_POLICY and hasattr(cache, 'evict'):
+            cache.clear_tray()
+            cache.evict(opts.cache_size)
+        elif hasattr(cache, 'strip'):
             cache.strip(FilterBySize(opts.cache_size))
         elif hasattr(cache, 'strip_total_size'):
             cache.strip_total_size(opts.cache_size)
@@ -271,6 +271,8 @@ def _do_build(build_info, params, arcadia_root, app_ctx, parsed_package, formatt
         "link_threads",
         "local_executor",
         "new_store",
+        "new_store_chunked_min_size",
+        "new_store_eviction_policy",
         "new_store_ttl",
         "pytest_args",
         "strip_cache",
@@ -103,6 +103,7 @@ class RunTestOptions(core.yarg.Options):
         self.fail_fast = False
         self.test_threads = 0
         self.testing_split_factor = 0
+        self.balance_test_chunks = True
         self.test_prepare = False
         self._is_ya_test = is_ya_test
 
@@ -156,6 +157,14 @@ class RunTestOptions(core.yarg.Options):
                 subgroup=RUN_TEST_SUBGROUP,
                 visible=help_level.HelpLevel.EXPERT,
             ),
+            TestArgConsumer(
+                ['--no-balance-test-chunks'],
+                help="Don't balance chunks of listed tests by durations from previous runs",
+                hook=core.yarg.SetConstValueHook('balance_test_chunks', False),
+                subgroup=RUN_TEST_SUBGROUP,
+                visible=help_level.HelpLevel.EXPERT,
+            ),
+            core.yarg.ConfigConsumer('balance_test_chunks'),
             TestArgConsumer(
                 ['--test-prepare'],
                 help='Don\'t run tests, just prepare tests\' dependencies and environment',
@@ -10,6 +10,30 @@ import ujson as json
 
 logger = logging.getLogger(__name__)
 
+# granular format: start line, start shift, end line, end shift, is covered
+START_LINE = 0
+START_SHIFT = 1
+END_LINE = 2
+END_SHIFT = 3
+IS_COVERED = 4
+
+# unified format: start, missing branch flag, end, 0, counter
+START_POS = 0
+# line coverage doesn't use segment line pos - use it to store missing brach flag
+MISSING_BRANCH = 1
+END_POS = 2
+COUNTER = 4
+
+# clang's segment format: Line, Col, Count, HasCount, IsRegionEntry, IsGapRegion
+LINE_FIELD = 0
+COL_FIELD = 1
+COUNTER_FIELD = 2
+HASCOUNT_FIELD = 3
+ISREGIONENTRY_FIELD = 4
+ISGAPREGION_FIELD = 5
+# Too big counter cannot be serialized to json by ujson module
+COUNTER_LIMIT = 1 << 62
+
 
 def merge_raw_sancov(files, dst):
     import sancov
@@ -84,141 +108,94 @@ def merge_resolved_sancov(cov_files, test_mode):
     }
 
 
-def merge_granular_coverage_segments(record, segments):
-    if not record:
-        return segments
-    start_line = 0
-    start_shift = 1
-    end_line = 2
-    end_shift = 3
-    is_covered = 4
-
-    # invariant: l_seg start <= r_seg start
-    def compare_segments(l_seg, r_seg):
-        if l_seg is None:
-            return True
-        elif l_seg[start_line] != r_seg[start_line]:
-            return l_seg[start_line] < r_seg[start_line]
-        elif l_seg[start_shift] != r_seg[start_shift]:
-            return l_seg[start_shift] < r_seg[start_shift]
-        elif l_seg[end_line] != r_seg[end_line]:
-            return l_seg[end_line] < r_seg[end_line]
-        elif l_seg[end_shift] != r_seg[end_shift]:
-            return l_seg[end_shift] < r_seg[end_shift]
+def _merge_sorted_granular(left, right):
+    # Segments are ordered by (start line, start shift, end line, end shift), right goes first on ties
+    result = []
+    left_len = len(left)
+    right_len = len(right)
+    left_pos = 0
+    right_pos = 0
+    while left_pos < left_len and right_pos < right_len:
+        if left[left_pos][:IS_COVERED] < right[right_pos][:IS_COVERED]:
+            result.append(list(left[left_pos]))
+            left_pos += 1
         else:
-            return False
-
-    # invariant: l_seg start <= r_seg start
-    def is_equal_starts(l_seg, r_seg):
-        return l_seg[start_line] == r_seg[start_line] and l_seg[start_shift] == r_seg[start_shift]
-
-    # invariant: l_seg start <= r_seg start
-    def is_equal_ends(l_seg, r_seg):
-        return l_seg[end_line] == r_seg[end_line] and l_seg[end_shift] == r_seg[end_shift]
+            result.append(list(right[right_pos]))
+            right_pos += 1
+    result.extend(list(seg) for seg in left[left_pos:])
+    result.extend(list(seg) for seg in right[right_pos:])
+    return result
 
-    # invariant: l_seg start <= r_seg start
-    def is_equal_ranges(l_seg, r_seg):
-        return is_equal_starts(l_seg, r_seg) and is_equal_ends(l_seg, r_seg)
 
-    # invariant: l_seg start <= r_seg start
-    def compare_ends(l_seg, r_seg):
-        if l_seg[end_line] != r_seg[end_line]:
-            return l_seg[end_line] < r_seg[end_line]
-        else:
-            return l_seg[end_shift] < r_seg[end_shift]
-
-    # invariant: l_seg start <= r_seg start
-    def can_be_merged(l_seg, r_seg):
-        """compare left end with right start. if (left end >= right start) => segments can be merged"""
-        if l_seg[end_line] + 1 >= r_seg[start_line]:
-            return True
-        else:
-            return False
-
-    def segments_iterator(left_seg, right_seg):
-        left_len = len(left_seg)
-        right_len = len(right_seg)
-        left_pos = 0
-        right_pos = 0
-        while left_pos < left_len or right_pos < right_len:
-            if left_pos == left_len:
-                yield right_seg[right_pos]
-                right_pos += 1
-                continue
-            elif right_pos == right_len:
-                yield left_seg[left_pos]
-                left_pos += 1
-                continue
-            if compare_segments(left_seg[left_pos], right_seg[right_pos]):
-                yield left_seg[left_pos]
-                left_pos += 1
-            else:
-                yield right_seg[right_pos]
-                right_pos += 1
+def merge_granular_coverage_segments(record, segments):
+    """
+    Segments are [start line, start shift, end line, end shift, is covered].
+    The result consists of non-intersecting segments, adjacent ones with the same state are joined.
+    """
+    if not record:
+        return segments
 
-    def check_inter(left, right):
-        if left[end_line] != right[start_line]:
-            return left[end_line] > right[start_line]
-        else:
-            return left[end_shift] >= right[start_shift]
-
-    def merge():
-        uni_res = []
-        sorted_segments = segments_iterator(record, segments)
-        cur_seg = None
-        for seg in sorted_segments:
-            seg = list(seg)
-            if cur_seg is None:
-                cur_seg = seg
-            elif check_inter(cur_seg, seg):
-                if not is_equal_starts(cur_seg, seg):
-                    # |-----------|
-                    #     |-------|
-                    uni_res.append(
-                        [cur_seg[start_line], cur_seg[start_shift], seg[start_line], seg[start_shift], cur_seg[4]]
-                    )
-                    cur_seg[start_line] = seg[start_line]
-                    cur_seg[start_shift] = seg[start_shift]
-                if compare_ends(cur_seg, seg):
-                    cur_seg, seg = seg, cur_seg
+    uni_res = []
+    cur_seg = None
+    for seg in _merge_sorted_granular(record, segments):
+        if cur_seg is None:
+            cur_seg = seg
+        # segments intersect: current end >= next start
+        elif cur_seg[END_LINE] > seg[START_LINE] or (
+            cur_seg[END_LINE] == seg[START_LINE] and cur_seg[END_SHIFT] >= seg[START_SHIFT]
+        ):
+            if cur_seg[START_LINE] != seg[START_LINE] or cur_seg[START_SHIFT] != seg[START_SHIFT]:
+                # |-----------|
+                #     |-------|
                 uni_res.append(
-                    [
-                        seg[start_line],
-                        seg[start_shift],
-                        seg[end_line],
-                        seg[end_shift],
-                        seg[is_covered] | cur_seg[is_covered],
-                    ]
+                    [cur_seg[START_LINE], cur_seg[START_SHIFT], seg[START_LINE], seg[START_SHIFT], cur_seg[IS_COVERED]]
                 )
-                if not is_equal_ranges(cur_seg, seg):
-                    cur_seg[start_line] = seg[end_line]
-                    cur_seg[start_shift] = seg[end_shift]
-                else:
-                    cur_seg = None
+                cur_seg[START_LINE] = seg[START_LINE]
+                cur_seg[START_SHIFT] = seg[START_SHIFT]
+            if cur_seg[END_LINE] < seg[END_LINE] or (
+                cur_seg[END_LINE] == seg[END_LINE] and cur_seg[END_SHIFT] < seg[END_SHIFT]
+            ):
+                cur_seg, seg = seg, cur_seg
+            uni_res.append(
+                [
+                    seg[START_LINE],
+                    seg[START_SHIFT],
+                    seg[END_LINE],
+                    seg[END_SHIFT],
+                    seg[IS_COVERED] | cur_seg[IS_COVERED],
+                ]
+            )
+            if (
+                cur_seg[START_LINE] != seg[START_LINE]
+                or cur_seg[START_SHIFT] != seg[START_SHIFT]
+                or cur_seg[END_LINE] != seg[END_LINE]
+                or cur_seg[END_SHIFT] != seg[END_SHIFT]
+            ):
+                cur_seg[START_LINE] = seg[END_LINE]
+                cur_seg[START_SHIFT] = seg[END_SHIFT]
             else:
-                uni_res.append(cur_seg)
-                cur_seg = seg
-        if cur_seg is not None:
+                cur_seg = None
+        else:
             uni_res.append(cur_seg)
-        return uni_res
+            cur_seg = seg
+    if cur_seg is not None:
+        uni_res.append(cur_seg)
 
-    def compact_flatten_segments(merged_segments):
-        if len(merged_segments) < 2:
-            return merged_segments
-        result = []
-        prev_seg = merged_segments[0]
-        for seg in merged_segments[1:]:
-            if can_be_merged(prev_seg, seg) and prev_seg[is_covered] == seg[is_covered]:
-                prev_seg[end_line] = seg[end_line]
-                prev_seg[end_shift] = seg[end_shift]
-            else:
-                result.append(prev_seg)
-                prev_seg = seg
-        if prev_seg:
+    if len(uni_res) < 2:
+        return uni_res
+    result = []
+    prev_seg = uni_res[0]
+    for seg in uni_res[1:]:
+        # left end >= right start
+        if prev_seg[END_LINE] + 1 >= seg[START_LINE] and prev_seg[IS_COVERED] == seg[IS_COVERED]:
+            prev_seg[END_LINE] = seg[END_LINE]
+            prev_seg[END_SHIFT] = seg[END_SHIFT]
+        else:
             result.append(prev_seg)
-        return result
-
-    return compact_flatten_segments(merge())
+            prev_seg = seg
+    if prev_seg:
+        result.append(prev_seg)
+    return result
 
 
 def merge_functions_inplace(result, record):
@@ -235,145 +212,130 @@ def merge_functions_inplace(result, record):
                 target[funcname] += count
 
 
+def _unified_segments(record):
+    # Empty segments (aka java-missed-branch-in-line-indicator) are skipped, the flag of the next segment is set instead.
+    # Line coverage doesn't use segment line pos - it's used to store the flag
+    result = []
+    missed_branch = False
+    for useg in record:
+        if useg[START_POS] == useg[END_POS]:
+            missed_branch = True
+            continue
+        segment = list(useg)
+        assert not segment[MISSING_BRANCH], segment
+        segment[MISSING_BRANCH] = missed_branch
+        result.append(segment)
+        missed_branch = False
+    return result
+
+
 def merge_segments(record1, record2):
+    """
+    Merges segments of the unified format: [start, missing branch flag, end, 0, counter].
+    Both records are walked at once by indices, the shorter segment of the overlapping ones is split off.
+    """
     if not record1:
         return record2
 
-    # unified format
-    start_pos = 0
-    end_pos = 2
-    counter = 4
-    # line coverage doesn't use segment line pos - use it to store missing brach flag
-    missing_branch = 1
-
-    def next_segment(seq):
-        def tip_iter():
-            try:
-                it = iter(seq)
-                while True:
-                    missed_branch = False
-                    useg = next(it)
-                    # Skip all empty segments (aka java-missed-branch-in-line-indicator) and put this knowledge into the flag
-                    while useg[start_pos] == useg[end_pos]:
-                        missed_branch = True
-                        useg = next(it)
-
-                    segment = list(useg)
-                    assert not segment[missing_branch], segment
-                    segment[missing_branch] = missed_branch
-                    yield segment
-            except StopIteration:
-                return
-
-        it = tip_iter()
-
-        def next_item():
-            try:
-                return next(it)
-            except StopIteration:
-                return None
-
-        return next_item
-
-    def merge():
-        next_left = next_segment(record1)
-        next_right = next_segment(record2)
-        left = next_left()
-        right = next_right()
-
-        while left and right:
-            start_diff = left[start_pos] - right[start_pos]
-            # Most common case - segment ranges are equal
-            if start_diff == 0:
-                end_diff = left[end_pos] - right[end_pos]
-                if end_diff < 0:
-                    left, right = right, left
-                    next_right, next_left = next_left, next_right
-                head = list(left)
-
-                if head[missing_branch] and right[missing_branch] and end_diff:
-                    head[missing_branch] = False
-                    head[counter] += right[counter]
-                    yield head
-                    # skip uncovered segment - it's not a part of head (which is covered)
-                    if end_diff:
-                        next_right()
-                    right = next_right()
-                    left = next_left()
-                    continue
+    left_seq = _unified_segments(record1)
+    right_seq = _unified_segments(record2)
+    left_pos = 1
+    right_pos = 1
+    left = left_seq[0] if left_seq else None
+    right = right_seq[0] if right_seq else None
+
+    merged = []
+    while left and right:
+        start_diff = left[START_POS] - right[START_POS]
+        # Most common case - segment ranges are equal
+        if start_diff == 0:
+            end_diff = left[END_POS] - right[END_POS]
+            if end_diff < 0:
+                left, right = right, left
+                left_seq, right_seq = right_seq, left_seq
+                left_pos, right_pos = right_pos, left_pos
+            head = list(left)
+
+            if head[MISSING_BRANCH] and right[MISSING_BRANCH] and end_diff:
+                head[MISSING_BRANCH] = False
+                head[COUNTER] += right[COUNTER]
+                merged.append(head)
+                # skip uncovered segment - it's not a part of head (which is covered)
+                right_pos += 1
+                right = right_seq[right_pos] if right_pos < len(right_seq) else None
+                right_pos += 1
+                left = left_seq[left_pos] if left_pos < len(left_seq) else None
+                left_pos += 1
+                continue
 
-                head[end_pos] = right[end_pos]
-                if head[missing_branch] == right[missing_branch]:
-                    head[counter] += right[counter]
-                else:
-                    # Don't store missing branch flag if it's merged with covered segment
-                    head[missing_branch] = not (head[counter] and right[counter])
-                    head[counter] = max(head[counter], right[counter])
-                yield head
-
-                if end_diff == 0:
-                    right = next_right()
-                    left = next_left()
-                # Overlapped
-                else:
-                    left[start_pos] = right[end_pos]
-                    right = next_right()
+            head[END_POS] = right[END_POS]
+            if head[MISSING_BRANCH] == right[MISSING_BRANCH]:
+                head[COUNTER] += right[COUNTER]
             else:
-                if start_diff > 0:
-                    left, right = right, left
-                    next_right, next_left = next_left, next_right
-                # Overlapped
-                if left[end_pos] > right[start_pos]:
-                    head = list(left)
-                    head[end_pos] = right[start_pos]
-                    yield head
-                    left[start_pos] = right[start_pos]
-                else:
-                    yield left
-                    left = next_left()
-
-        while left:
-            yield left
-            left = next_left()
-        while right:
-            yield right
-            right = next_right()
-
-    def unify(s):
-        s[missing_branch] = 0
-        return s
-
-    def flatten():
-        curr = None
-        for segment in merge():
-            # process missed-branch-in-line-indicator (mbili)
-            if segment[missing_branch]:
-                if curr:
-                    # previous segment
-                    yield curr
-                # gen mbili
-                yield [segment[start_pos], 0, segment[start_pos], 0, 0]
-                yield unify(segment)
-                curr = None
-                continue
+                # Don't store missing branch flag if it's merged with covered segment
+                head[MISSING_BRANCH] = not (head[COUNTER] and right[COUNTER])
+                head[COUNTER] = max(head[COUNTER], right[COUNTER])
+            merged.append(head)
 
-            # Direct flatten (no mbili here)
-            if not curr:
-                curr = unify(segment)
-            elif (
-                curr[end_pos] >= segment[start_pos]
-                and bool(curr[counter]) == bool(segment[counter])
-                and curr[missing_branch] == curr[missing_branch]
-            ):
-                curr[end_pos] = segment[end_pos]
+            if end_diff == 0:
+                left = left_seq[left_pos] if left_pos < len(left_seq) else None
+                left_pos += 1
+            # Overlapped
             else:
-                yield curr
-                curr = unify(segment)
+                left[START_POS] = right[END_POS]
+            right = right_seq[right_pos] if right_pos < len(right_seq) else None
+            right_pos += 1
+        else:
+            if start_diff > 0:
+                left, right = right, left
+                left_seq, right_seq = right_seq, left_seq
+                left_pos, right_pos = right_pos, left_pos
+            # Overlapped
+            if left[END_POS] > right[START_POS]:
+                head = list(left)
+                head[END_POS] = right[START_POS]
+                merged.append(head)
+                left[START_POS] = right[START_POS]
+            else:
+                merged.append(left)
+                left = left_seq[left_pos] if left_pos < len(left_seq) else None
+                left_pos += 1
 
-        if curr:
-            yield curr
+    if left:
+        merged.append(left)
+        merged.extend(left_seq[left_pos:])
+    if right:
+        merged.append(right)
+        merged.extend(right_seq[right_pos:])
+
+    result = []
+    curr = None
+    for segment in merged:
+        # process missed-branch-in-line-indicator (mbili)
+        if segment[MISSING_BRANCH]:
+            if curr:
+                # previous segment
+                result.append(curr)
+            # gen mbili
+            result.append([segment[START_POS], 0, segment[START_POS], 0, 0])
+            segment[MISSING_BRANCH] = 0
+            result.append(segment)
+            curr = None
+            continue
+
+        segment[MISSING_BRANCH] = 0
+        # Direct flatten (no mbili here)
+        if not curr:
+            curr = segment
+        elif curr[END_POS] >= segment[START_POS] and bool(curr[COUNTER]) == bool(segment[COUNTER]):
+            curr[END_POS] = segment[END_POS]
+        else:
+            result.append(curr)
+            curr = segment
 
-    return list(flatten())
+    if curr:
+        result.append(curr)
+    return result
 
 
 def merge_clang_segments(segments):
@@ -385,52 +347,41 @@ def merge_clang_segments(segments):
         return left
     # there is at least one item in both
 
-    # clang's segment format: Line, Col, Count, HasCount, IsRegionEntry, IsGapRegion
-    COUNTER_FIELD = 2
-    HASCOUNT_FIELD = 3
-    ISREGIONENTRY_FIELD = 4
-    ISGAPREGION_FIELD = 5
-
-    # Too big counter cannot be serialized to json by ujson module
-    COUNTER_LIMIT = 1 << 62
-
     def update_by(seg_to_update, seg):
         seg_to_update[COUNTER_FIELD] = min(seg_to_update[COUNTER_FIELD] + seg[COUNTER_FIELD], COUNTER_LIMIT)
         seg_to_update[HASCOUNT_FIELD] = seg_to_update[HASCOUNT_FIELD] or seg[HASCOUNT_FIELD]
         seg_to_update[ISREGIONENTRY_FIELD] = seg_to_update[ISREGIONENTRY_FIELD] or seg[ISREGIONENTRY_FIELD]
         seg_to_update[ISGAPREGION_FIELD] = seg_to_update[ISGAPREGION_FIELD] and seg[ISGAPREGION_FIELD]
+        return seg_to_update
 
     left = sorted(left)
     right = sorted(right)
+    left_len = len(left)
+    right_len = len(right)
 
     result = []  # type: list[list[int|bool]]
+    append = result.append
     l_idx = 0
     r_idx = 0
-    while l_idx < len(left) or r_idx < len(right):
-        if l_idx >= len(left):
-            result.append(list(right[r_idx]))
-            # update by last left not needed. Last left is always (*, *, 0, false, false, false)
-            r_idx += 1
-        elif r_idx >= len(right):
-            result.append(list(left[l_idx]))
-            # update by last right not needed. Last right is always (*, *, 0, false, false, false)
-            l_idx += 1
-        elif left[l_idx][:COUNTER_FIELD] == right[r_idx][:COUNTER_FIELD]:
-            result.append(list(left[l_idx]))
-            update_by(result[-1], right[r_idx])
+    while l_idx < left_len and r_idx < right_len:
+        l_seg = left[l_idx]
+        r_seg = right[r_idx]
+        l_line = l_seg[LINE_FIELD]
+        r_line = r_seg[LINE_FIELD]
+        if l_line == r_line and l_seg[COL_FIELD] == r_seg[COL_FIELD]:
+            append(update_by(list(l_seg), r_seg))
             l_idx += 1
             r_idx += 1
-        elif left[l_idx][:2] < right[r_idx][:2]:
-            result.append(list(left[l_idx]))
-            if r_idx > 0:
-                update_by(result[-1], right[r_idx - 1])
+        elif l_line < r_line or l_line == r_line and l_seg[COL_FIELD] < r_seg[COL_FIELD]:
+            append(update_by(list(l_seg), right[r_idx - 1]) if r_idx else list(l_seg))
             l_idx += 1
         else:
-            result.append(list(right[r_idx]))
-            if l_idx > 0:
-                update_by(result[-1], left[l_idx - 1])
+            append(update_by(list(r_seg), left[l_idx - 1]) if l_idx else list(r_seg))
             r_idx += 1
 
+    # update by the last segment of the other side is not needed, it's always (*, *, 0, false, false, false)
+    result.extend(list(seg) for seg in left[l_idx:])
+    result.extend(list(seg) for seg in right[r_idx:])
     return result
 
 
@@ -469,3 +420,64 @@ def compact_segments(segments):
         prev_ln = sln
 
     yield (start_ln, 0, eln, 0, start_state)
+
+
+if __name__ == '__main__':
+    import random
+    import time
+
+    # python merge.py [files] [chunks] - folds chunks of coverage of every synthetic file, as merge_coverage_inplace does
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    chunks = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    rnd = random.Random(0)
+
+    def gen_granular():
+        segments = []
+        line = 1
+        for _ in range(rnd.randint(50, 400)):
+            end_line = line + rnd.randint(0, 3)
+            segments.append([line, rnd.randint(0, 40), end_line, rnd.randint(41, 80), rnd.randint(0, 1)])
+            line = end_line + rnd.randint(0, 2)
+        return segments
+
+    def gen_unified():
+        segments = []
+        line = 1
+        for _ in range(rnd.randint(50, 400)):
+            if rnd.random() < 0.05:
+                segments.append([line, 0, line, 0, 0])
+            end = line + rnd.randint(1, 5)
+            segments.append([line, 0, end, 0, rnd.choice([0, 0, 1, rnd.randint(2, 1000)])])
+            line = end + rnd.randint(0, 1)
+        return segments
+
+    def gen_clang():
+        segments = []
+        line = 1
+        for _ in range(rnd.randint(50, 400)):
+            line += rnd.randint(0, 3)
+            segments.append([line, rnd.randint(1, 80), rnd.randint(0, 1000), True, rnd.random() < 0.5, False])
+        segments.sort()
+        segments.append([line + 1, 1, 0, False, False, False])
+        return segments
+
+    for name, gen, merge in [
+        ('merge_granular_coverage_segments', gen_granular, merge_granular_coverage_segments),
+        ('merge_segments', gen_unified, merge_segments),
+        ('merge_clang_segments', gen_clang, lambda record, segments: merge_clang_segments([record, segments])),
+    ]:
+        corpus = [[gen() for _ in range(chunks)] for _ in range(files)]
+        merges = 0
+
+        t1 = time.time()
+
+        for records in corpus:
+            result = None
+            for record in records:
+                result = merge(result, record)
+                merges += 1
+
+        t2 = time.time()
+
+        print('{} per file (ms)'.format(name), 1000.0 * (t2 - t1) / files)
+        print('{} per one merge (ms)'.format(name), 1000.0 * (t2 - t1) / merges)
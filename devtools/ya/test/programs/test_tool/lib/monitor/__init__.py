@@ -1,3 +1,4 @@
+from .memcgroup import CgroupMemoryMonitor, create_memory_monitor  # noqa
 from .memproctree import MemProcessTreeMonitor  # noqa
 from .pollmon import PollMonitor  # noqa
 from .stat_tmpfs import TmpfsUsageMonitor, is_stat_tmpfs_supported  # noqa
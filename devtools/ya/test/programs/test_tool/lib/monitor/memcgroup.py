@@ -0,0 +1,161 @@
+import logging
+import os
+
+import psutil
+
+from devtools.ya.test.programs.test_tool.lib.monitor import memproctree, pollmon, series
+
+logger = logging.getLogger(__name__)
+
+
+def get_cgroup2_mount():
+    try:
+        with open('/proc/self/mountinfo') as afile:
+            for line in afile:
+                # <id> <parent> <major:minor> <root> <mount point> <options> [optional fields] - <fs type> ...
+                left, _, right = line.partition(' - ')
+                if right.split(' ', 1)[0] == 'cgroup2':
+                    return left.split()[4]
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def get_cgroup2_path(pid):
+    """Path of the unified hierarchy cgroup of the process, None if cgroup v2 isn't available"""
+    mount = get_cgroup2_mount()
+    if not mount:
+        return None
+    try:
+        with open('/proc/{}/cgroup'.format(pid)) as afile:
+            for line in afile:
+                hierarchy, _, path = line.rstrip('\n').split(':', 2)
+                if hierarchy == '0':
+                    path = os.path.join(mount, path.lstrip('/'))
+                    if os.path.exists(os.path.join(path, 'memory.current')):
+                        return path
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def get_cgroup_pids(path):
+    pids = set()
+    for root, _, files in os.walk(path):
+        if 'cgroup.procs' in files:
+            with open(os.path.join(root, 'cgroup.procs')) as afile:
+                pids.update(int(x) for x in afile.read().split())
+    return pids
+
+
+def is_dedicated_cgroup(path, target_pid):
+    """Checks that the cgroup contains nothing but the target process tree"""
+    try:
+        pids = get_cgroup_pids(path)
+        proc = psutil.Process(target_pid)
+        tree = set([target_pid] + [p.pid for p in proc.children(recursive=True)])
+    except (IOError, OSError, ValueError, psutil.Error):
+        return False
+    return target_pid in pids and pids.issubset(tree)
+
+
+def read_memory_stat(path):
+    stat = {}
+    with open(os.path.join(path, 'memory.stat')) as afile:
+        for line in afile:
+            key, _, value = line.partition(' ')
+            stat[key] = int(value)
+    return stat
+
+
+class CgroupMemoryMonitor(pollmon.PollMonitor):
+    """
+    Memory of the target process tree accounted by its cgroup (v2).
+    A single file read per poll, so polls are cheap and the interval gets short while the usage grows.
+    Page cache (including tmpfs, which is monitored separately) is not counted as used.
+    """
+
+    MIN_DELAY = 0.1
+
+    def __init__(self, target_pid, cgroup_path, delay=1, caption="", cmdline_limit=None):
+        super(CgroupMemoryMonitor, self).__init__(delay)
+        self.cgroup_path = cgroup_path
+        self.adaptive_delay = series.AdaptiveDelay(self.MIN_DELAY, delay)
+        self.series = series.UsageSeries()
+        self.max_used = 0
+        self.peak = None
+        # Process tree is only walked when a new maximum is reached
+        self.tree_monitor = memproctree.MemProcessTreeMonitor(
+            target_pid, delay=delay, caption=caption, cmdline_limit=cmdline_limit
+        )
+        self._tree_max_used = 0
+
+    def setup_monitor(self):
+        self.max_used = 0
+        self._tree_max_used = 0
+        # Available since linux 5.19, writable (resets the value) since 6.12
+        try:
+            with open(os.path.join(self.cgroup_path, 'memory.peak'), 'w') as afile:
+                afile.write('0')
+        except (IOError, OSError):
+            pass
+
+    def teardown_monitor(self):
+        try:
+            with open(os.path.join(self.cgroup_path, 'memory.peak')) as afile:
+                self.peak = int(afile.read())
+        except (IOError, OSError, ValueError):
+            pass
+
+    def _read_used(self):
+        with open(os.path.join(self.cgroup_path, 'memory.current')) as afile:
+            current = int(afile.read())
+        return max(current - read_memory_stat(self.cgroup_path).get('file', 0), 0)
+
+    def poll(self):
+        try:
+            used = self._read_used()
+        except (IOError, OSError, ValueError) as e:
+            logger.debug("Failed to read memory usage of %s: %s", self.cgroup_path, e)
+            return self
+        self.series.add(used // 1024)
+        self.delay = self.adaptive_delay.update(used)
+        if used > self.max_used:
+            self.max_used = used
+            # Snapshots are expensive, take them on a noticeable growth only
+            if used > self._tree_max_used * (1 + series.AdaptiveDelay.GROWTH):
+                self._tree_max_used = used
+                self.tree_monitor.snapshot()
+        return self
+
+    def snapshot(self):
+        self.tree_monitor.snapshot()
+        return self
+
+    def get_max_mem_used(self):
+        # returns kilobytes
+        return self.max_used // 1024
+
+    def get_metrics(self):
+        metrics = self.series.to_metrics('cgroup_memory_kb')
+        if self.peak is not None:
+            # Includes page cache, so it's an upper bound of the used memory
+            metrics['max_cgroup_memory_peak_kb'] = self.peak // 1024
+        return metrics
+
+    def dumps_process_tree(self):
+        return self.tree_monitor.dumps_process_tree()
+
+
+def create_memory_monitor(target_pid, precise_limit=0, delay=1, caption="", cmdline_limit=None):
+    """
+    Cgroup based monitor if the target process tree has a dedicated cgroup v2,
+    process tree walking one otherwise.
+    """
+    path = get_cgroup2_path(target_pid)
+    if path and is_dedicated_cgroup(path, target_pid):
+        logger.debug("Memory of %d is monitored using cgroup %s", target_pid, path)
+        return CgroupMemoryMonitor(target_pid, path, delay=delay, caption=caption, cmdline_limit=cmdline_limit)
+    return memproctree.MemProcessTreeMonitor(
+        target_pid, precise_limit=precise_limit, delay=delay, caption=caption, cmdline_limit=cmdline_limit
+    )
@@ -4,9 +4,23 @@ import os
 
 import psutil
 
-from devtools.ya.test.programs.test_tool.lib.monitor import pollmon
+from devtools.ya.test.programs.test_tool.lib.monitor import pollmon, series
 from yalibrary import formatter
 
+SMAPS_ROLLUP_SUPPORTED = os.path.exists('/proc/self/smaps_rollup')
+
+
+def read_smaps_rollup(pid):
+    """(referenced, private dirty) bytes of the process, one small file instead of all the mappings"""
+    ref, private_dirty = 0, 0
+    with open('/proc/{}/smaps_rollup'.format(pid), 'rb') as afile:
+        for line in afile:
+            if line.startswith(b'Referenced:'):
+                ref = int(line.split()[1]) * 1024
+            elif line.startswith(b'Private_Dirty:'):
+                private_dirty = int(line.split()[1]) * 1024
+    return ref, private_dirty
+
 
 class ProcInfo(object):
     def __init__(self, pid, command, rss, ref, private_dirty, proc):
@@ -19,8 +33,15 @@ class ProcInfo(object):
 
 
 class MemProcessTreeMonitor(pollmon.PollMonitor):
+    # Walking the process tree isn't cheap, don't poll more often
+    MIN_DELAY = 0.5
+
     def __init__(self, target_pid, precise_limit=0, delay=1, caption="", cmdline_limit=None):
         super(MemProcessTreeMonitor, self).__init__(delay)
+        self.adaptive_delay = series.AdaptiveDelay(self.MIN_DELAY, delay)
+        self.series = series.UsageSeries()
+        # (pid, create time) -> command
+        self._commands = {}
         self.process = psutil.Process(target_pid)
         self.precise_limit = precise_limit
         self.maxrss = 0
@@ -29,16 +50,24 @@ class MemProcessTreeMonitor(pollmon.PollMonitor):
         self.cmdline_limit = cmdline_limit
         self.precise_tree = False
         self.proc_tree = {}
-        self.refine_available = hasattr(psutil.Process(target_pid), 'memory_maps')
+        self.refine_available = SMAPS_ROLLUP_SUPPORTED or hasattr(psutil.Process(target_pid), 'memory_maps')
 
     def setup_monitor(self):
         self.maxrss = 0
         self.proc_tree = {}
 
+    def _get_command(self, proc):
+        key = (proc.pid, proc.create_time())
+        cmd_line = self._commands.get(key)
+        if cmd_line is None:
+            cmd_line = " ".join([os.path.basename(proc.exe())] + proc.cmdline()[1:])
+            if self.cmdline_limit:
+                cmd_line = cmd_line[: self.cmdline_limit].strip()
+            self._commands[key] = cmd_line
+        return cmd_line
+
     def _create_proc_info(self, proc):
-        cmd_line = " ".join([os.path.basename(proc.exe())] + proc.cmdline()[1:])
-        if self.cmdline_limit:
-            cmd_line = cmd_line[: self.cmdline_limit].strip()
+        cmd_line = self._get_command(proc)
         return ProcInfo(
             pid=proc.pid,
             command=cmd_line,
@@ -52,6 +81,9 @@ class MemProcessTreeMonitor(pollmon.PollMonitor):
         for procs in tree.values():
             for pi in procs:
                 try:
+                    if SMAPS_ROLLUP_SUPPORTED:
+                        pi.ref, pi.private_dirty = read_smaps_rollup(pi.pid)
+                        continue
                     mem_map = pi.proc.memory_maps(grouped=True)
                     ref, private_dirty = 0, 0
                     for e in mem_map:
@@ -59,12 +91,16 @@ class MemProcessTreeMonitor(pollmon.PollMonitor):
                         private_dirty += e.private_dirty
                     pi.ref = ref
                     pi.private_dirty = private_dirty
-                except (OSError, psutil.Error):
+                except (OSError, ValueError, psutil.Error):
                     pass
 
     def poll(self):
         tree = self._get_process_tree()
+        pids = set(pi.pid for procs in tree.values() for pi in procs)
+        self._commands = {key: cmd for key, cmd in self._commands.items() if key[0] in pids}
         rss = sum(pi.rss for procs in tree.values() for pi in procs)
+        self.series.add(rss // 1024)
+        self.delay = self.adaptive_delay.update(rss)
         if rss > self.maxrss:
             self.maxrss = rss
             self.proc_tree = tree
@@ -97,6 +133,11 @@ class MemProcessTreeMonitor(pollmon.PollMonitor):
             pass
         return tree
 
+    def snapshot(self):
+        """Stores the current process tree to be dumped"""
+        self.proc_tree = self._get_process_tree()
+        return self
+
     def get_max_mem_used(self):
         # returns kilobytes
         if self.precise_tree:
@@ -104,6 +145,9 @@ class MemProcessTreeMonitor(pollmon.PollMonitor):
         else:
             return self.maxrss // 1024
 
+    def get_metrics(self):
+        return self.series.to_metrics('proc_tree_rss_kb')
+
     def dumps_process_tree(self):
         if not self.proc_tree:
             return "No process tree available"
@@ -0,0 +1,66 @@
+import time
+
+
+class UsageSeries(object):
+    """
+    Fixed size time series of maximum values.
+    When all buckets are used, adjacent ones are joined and the bucket span doubles.
+    """
+
+    def __init__(self, max_buckets=16, span=1.0):
+        assert max_buckets > 1 and max_buckets % 2 == 0, max_buckets
+        self.max_buckets = max_buckets
+        self.span = span
+        self.buckets = []
+        self.samples = 0
+        self.started = None
+
+    def add(self, value, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        if self.started is None:
+            self.started = timestamp
+        index = int((timestamp - self.started) // self.span)
+        while index >= self.max_buckets:
+            self._shrink()
+            index = int((timestamp - self.started) // self.span)
+
+        if index >= len(self.buckets):
+            last = self.buckets[-1] if self.buckets else 0
+            # Buckets without samples keep the previous value
+            self.buckets.extend([last] * (index - len(self.buckets)) + [value])
+        else:
+            self.buckets[index] = max(self.buckets[index], value)
+        self.samples += 1
+
+    def _shrink(self):
+        buckets = self.buckets + [self.buckets[-1]] * (len(self.buckets) % 2)
+        self.buckets = [max(buckets[i], buckets[i + 1]) for i in range(0, len(buckets), 2)]
+        self.span *= 2
+
+    def to_metrics(self, prefix):
+        metrics = {'{}_{:02d}'.format(prefix, i): value for i, value in enumerate(self.buckets)}
+        if self.buckets:
+            metrics['{}_span_secs'.format(prefix)] = self.span
+            metrics['{}_samples'.format(prefix)] = self.samples
+        return metrics
+
+
+class AdaptiveDelay(object):
+    """Polls faster while the value is growing and slows down when it's stable"""
+
+    # Relative change which is considered as growth
+    GROWTH = 0.05
+
+    def __init__(self, min_delay, max_delay):
+        self.min_delay = min(min_delay, max_delay)
+        self.max_delay = max_delay
+        self.delay = max_delay
+        self._last = None
+
+    def update(self, value):
+        if self._last is not None and value > self._last * (1 + self.GROWTH):
+            self.delay = self.min_delay
+        else:
+            self.delay = min(self.delay * 1.5, self.max_delay)
+        self._last = value
+        return self.delay
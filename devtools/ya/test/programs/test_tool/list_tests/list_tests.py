@@ -50,6 +50,12 @@ def get_options():
     )
     parser.add_option("--test-info-path", dest="test_info_path", help="path to test info", default=None)
     parser.add_option("--test-list-path", dest="test_list_path", help="path to test list", default=None)
+    parser.add_option(
+        "--test-durations-path",
+        dest="test_durations_path",
+        help="path to durations of the tests from previous runs to balance chunks by",
+        default=None,
+    )
     parser.add_option(
         "--test-tags", dest="test_tags", action='append', help="tags of the running test suite", default=[]
     )
@@ -235,10 +241,20 @@ def main():
             test_classes[test_class].append(test_name)
         tests_chunks = []
         modulo = int(options.modulo)
-        for i in range(modulo):
-            chunk = test_splitter.filter_tests_by_modulo(
-                test_classes, modulo, i, bool(options.split_by_tests), options.partition_mode
+        chunks = None
+        if modulo > 1 and options.test_durations_path:
+            chunks = test_splitter.split_tests_by_durations(
+                test_classes, modulo, bool(options.split_by_tests), load_durations(options.test_durations_path)
             )
+            logger.debug("tests are balanced by durations: %s", chunks is not None)
+        if chunks is None:
+            chunks = [
+                test_splitter.filter_tests_by_modulo(
+                    test_classes, modulo, i, bool(options.split_by_tests), options.partition_mode
+                )
+                for i in range(modulo)
+            ]
+        for i, chunk in enumerate(chunks):
             tests_chunks.append([])
             for cls, tsts in chunk.items():
                 tests_chunks[i].extend(cls + '::' + t for t in tsts)
@@ -251,6 +267,15 @@ def main():
         dump_tests(options, [t.to_json() for t in tests], error)
 
 
+def load_durations(path):
+    try:
+        with open(path) as afile:
+            return json.load(afile)
+    except (IOError, OSError, ValueError) as e:
+        logger.debug("Failed to load test durations from %s: %s", path, e)
+        return {}
+
+
 def dump_tests(options, tests, error=None):
     with open(options.test_info_path, "w") as res_file:
         json.dump(
@@ -11,11 +11,14 @@ import shutil
 import logging
 import argparse
 import collections
+import multiprocessing
 from datetime import datetime
 
 import exts.archive
+import exts.asyncthread
 import exts.fs
 import exts.uniq_id
+import exts.windows
 import exts.tmp as yatemp
 import test.const
 from test.util import shared
@@ -28,6 +31,13 @@ logger = logging.getLogger(__name__)
 
 MAX_FILE_SIZE = 10 * (1024**2)  # 10MiB
 MAX_SUITE_CHUNKS = 3
+# Accumulator node can't require more cpu from distbuild
+MAX_MERGE_PROCESSES = 4
+TRACE_FILE_NAME = "ytest.report.trace"
+TRACE_BLOCK_SIZE = 4 * (1024**2)  # 4MiB
+
+# Pool of the top level merge, it's also used by the main process for the merges it runs itself
+_pool = None
 
 
 def get_options():
@@ -59,6 +69,12 @@ def get_options():
     parser.add_argument("--fast-clang-coverage-merge", help="Use fast cov merge and specify path to the log file")
     parser.add_argument("--gdb-path")
     parser.add_argument("--keep-temps", default=False, action="store_true")
+    parser.add_argument(
+        "--merge-processes",
+        help="Number of processes to merge outputs, by default up to {}".format(MAX_MERGE_PROCESSES),
+        type=int,
+        default=None,
+    )
 
     return parser.parse_args()
 
@@ -67,18 +83,79 @@ def get_options():
 def merge_dirs(args, dirs, dst, truncate, skip_files=None, skip_dirs=None, level=0):
     logger.debug("Merging content to '%s'", dst)
     files_map = get_output_files(dirs, set(skip_files or []), set(skip_dirs or []))
-    for rel_filename, files in six.iteritems(files_map):
-        logger.debug("Merging '%s' presented in: %s entries", rel_filename, len(files))
-        merge_files(args, rel_filename, files, os.path.join(dst, rel_filename), truncate, level=level + 1)
+    jobs = [
+        (args, rel_filename, files, os.path.join(dst, rel_filename), truncate, level + 1)
+        for rel_filename, files in six.iteritems(files_map)
+    ]
+    processes = get_merge_processes(args) if level == 0 else 1
+    if processes > 1 and len(jobs) > 1:
+        merge_in_pool(jobs, processes)
+    else:
+        for job in jobs:
+            logger.debug("Merging '%s' presented in: %s entries", job[1], len(job[2]))
+            merge_files(*job)
 
-    if not getattr(args, 'keep_paths', False) or 'ytest.report.trace' not in files_map:
+    if not getattr(args, 'keep_paths', False) or TRACE_FILE_NAME not in files_map:
         return
 
     for rel_filename, files in six.iteritems(files_map):
         if rel_filename != 'run_test.log':
             continue
 
-        merge_in_trace(os.path.join(dst, 'ytest.report.trace'), files, os.path.join(dst, rel_filename))
+        merge_in_trace(os.path.join(dst, TRACE_FILE_NAME), files, os.path.join(dst, rel_filename))
+
+
+def get_merge_processes(args):
+    if getattr(args, 'merge_processes', None):
+        return args.merge_processes
+    if exts.windows.on_win():
+        return 1
+    return min(multiprocessing.cpu_count(), MAX_MERGE_PROCESSES)
+
+
+def _get_job_size(job):
+    return sum(os.path.getsize(f) for f in job[2] if os.path.isfile(f))
+
+
+def _merge_files_job(job):
+    shared.timeit.stat.clear()
+    logger.debug("Merging '%s' presented in: %s entries", job[1], len(job[2]))
+    merge_files(*job)
+    return dict(shared.timeit.stat)
+
+
+def _par_map(func, items):
+    if _pool is None:
+        return [func(x) for x in items]
+    return _pool.map(func, items, chunksize=1)
+
+
+@shared.timeit
+def merge_in_pool(jobs, processes):
+    global _pool
+
+    # The trace is merged by the main process, which hands parsing of chunk traces to the pool,
+    # the largest of the other outputs go first
+    local_jobs = [job for job in jobs if job[1] == TRACE_FILE_NAME]
+    pool_jobs = sorted([job for job in jobs if job[1] != TRACE_FILE_NAME], key=_get_job_size, reverse=True)
+    logger.debug("Merging %d outputs using %d processes", len(pool_jobs), processes)
+
+    _pool = multiprocessing.Pool(processes)
+    try:
+        results = _pool.map_async(_merge_files_job, pool_jobs, chunksize=1)
+        for job in local_jobs:
+            logger.debug("Merging '%s' presented in: %s entries", job[1], len(job[2]))
+            merge_files(*job)
+        for stat in results.get():
+            for name, duration in six.iteritems(stat):
+                shared.timeit.stat[name] += duration
+        _pool.close()
+    except BaseException:
+        _pool.terminate()
+        raise
+    finally:
+        _pool.join()
+        _pool = None
 
 
 @shared.timeit
@@ -91,14 +168,15 @@ def merge_files(args, filename, files, dst, truncate, level=0):
     # Direct node outputs has level == 1 (don't try to merge files with special names in test's output)
     if level == 1 and base_filename == "meta.json":
         merge_meta_jsons(args, files, dst)
-    elif level == 1 and filename == "ytest.report.trace":
+    elif level == 1 and filename == TRACE_FILE_NAME:
         concatenate_traces(args, files, dst)
     elif level == 1 and base_filename == 'coverage.tar' and args.fast_clang_coverage_merge:
         merge_clang_coverage_archives_using_vfs(args, files, dst, logfile=args.fast_clang_coverage_merge)
     elif level == 1 and base_filename == "coverage_merge.log":
         merge_coverage_merge_logs(files, dst)
     elif args and base_filename in getattr(args, 'concatenate_binaries', []):
-        concatenate_binaries(files, dst)
+        if not link_single_file(files, dst):
+            concatenate_binaries(files, dst)
     elif filetype in ('tar', 'tgz') or base_filename.endswith('.tar.gz') or base_filename.endswith('.tar.zstd'):
         merge_archives(args, files, dst, truncate, level=level)
     elif filetype == 'sancov':
@@ -107,11 +185,21 @@ def merge_files(args, filename, files, dst, truncate, level=0):
         merge_clang_raw_profiles(files, dst)
     elif base_filename == 'run_test.log':
         shared.concatenate_files(files, dst, MAX_FILE_SIZE, before_callback=dump_header_separator)
-    else:
+    elif not link_single_file(files, dst, MAX_FILE_SIZE if truncate else 0):
         # remove method after DEVTOOLS-3250
         shared.concatenate_files(files, dst, MAX_FILE_SIZE if truncate else 0)
 
 
+def link_single_file(files, dst, max_file_size=0):
+    """Hardlinks the only file instead of copying, if the result of concatenation would be the same"""
+    if len(files) != 1 or not os.path.isfile(files[0]) or os.path.islink(files[0]):
+        return False
+    if max_file_size and os.path.getsize(files[0]) // 2 > max_file_size // 2:
+        return False
+    exts.fs.hardlink_or_copy(files[0], dst)
+    return True
+
+
 def dump_header_separator(filename, dstfile):
     nice_tail = b"#" * 80 + b"\n"
     dstfile.write(nice_tail)
@@ -135,17 +223,19 @@ def merge_archives(args, archives, dst, truncate, level=0):
     archive_postprocess = None if args.keep_temps else shared.archive_postprocess_unlink_files
 
     with yatemp.temp_dir() as tempdir:
-        target_dirs = []
-        for filename in archives:
-            dirname = os.path.join(tempdir, exts.uniq_id.gen8())
-            target_dirs.append(dirname)
-            try:
-                exts.archive.extract_from_tar(filename, dirname)
-            except Exception:
-                logger.exception("Exception during merge of %s", archives)
-                for i, a in enumerate(archives):
-                    exts.fs.move(a, dst + ".{}".format(i))
-                return
+        target_dirs = [os.path.join(tempdir, exts.uniq_id.gen8()) for _ in archives]
+        try:
+            # Decompression mostly releases the GIL
+            exts.asyncthread.par_map(
+                lambda x: exts.archive.extract_from_tar(*x),
+                list(zip(archives, target_dirs)),
+                min(len(archives), MAX_MERGE_PROCESSES),
+            )
+        except Exception:
+            logger.exception("Exception during merge of %s", archives)
+            for i, a in enumerate(archives):
+                exts.fs.move(a, dst + ".{}".format(i))
+            return
 
         resultdir = os.path.join(tempdir, exts.uniq_id.gen8())
         exts.fs.create_dirs(resultdir)
@@ -307,15 +397,54 @@ def _cut_common_prefix(chunk_ids):
         chunk_ids[chunk] = chunk_ids[chunk][prefix_len:]
 
 
+def _replace_all(data, replacements):
+    for old, new in replacements:
+        data = data.replace(old, new)
+    return data
+
+
+def copy_traces(files, dst, replacements):
+    """
+    Concatenates traces replacing paths, so the result is never loaded into memory.
+    Traces are processed by blocks of whole lines, replaced paths don't span lines.
+    """
+    with open(dst, "wb") as dstfile:
+        for filename in files:
+            if not os.path.isfile(filename):
+                logger.warning('%s is not a regular file', filename)
+                continue
+            with open(filename, "rb") as afile:
+                if not replacements:
+                    shutil.copyfileobj(afile, dstfile)
+                    continue
+                tail = b''
+                while True:
+                    data = afile.read(TRACE_BLOCK_SIZE)
+                    if not data:
+                        break
+                    data = tail + data
+                    end = data.rfind(b'\n') + 1
+                    tail = data[end:]
+                    if end:
+                        dstfile.write(_replace_all(data[:end], replacements))
+                dstfile.write(_replace_all(tail, replacements))
+
+
+def _load_chunk_results(chunk):
+    suite = common.PerformedTestSuite(None, None)
+    suite.set_work_dir(os.getcwd())
+    suite.load_run_results(os.path.join(chunk, TRACE_FILE_NAME))
+    return suite.get_status(), suite.logs
+
+
 @shared.timeit
 def concatenate_traces(args, files, dst):
     # We need to replace after the concatenation all paths in the trace file that point to
     # modulo** dirs to ones that point to the merged dir
     build_root = os.path.realpath(os.getcwd())
-    shared.concatenate_files(files, dst)
-    trace_content = exts.fs.read_file_unicode(dst, binary=False)
     dst_build_rel_path = os.path.relpath(os.path.realpath(args.accumulator_path), build_root)
-    chunk_ids = {}
+    chunk_ids = collections.OrderedDict()
+    replacements = []
 
     for o in args.outputs:
         o = os.path.realpath(o)
@@ -325,11 +454,15 @@ def concatenate_traces(args, files, dst):
             assert relative[0] != os.pardir
             chunk_ids[o] = relative
         else:
-            trace_content = trace_content.replace(output_build_rel_path + os.path.sep, dst_build_rel_path + os.path.sep)
+            replacements.append(
+                (
+                    six.ensure_binary(output_build_rel_path + os.path.sep),
+                    six.ensure_binary(dst_build_rel_path + os.path.sep),
+                )
+            )
 
+    copy_traces(files, dst, replacements)
     if not args.keep_paths:
-        with open(dst, "w") as dstfile:
-            dstfile.write(trace_content)
         return
 
     _cut_common_prefix(chunk_ids)
@@ -337,34 +470,26 @@ def concatenate_traces(args, files, dst):
     statuses = dict()
     errors = []
 
-    for chunk in chunk_ids:
-        trace = os.path.join(chunk, "ytest.report.trace")
-        assert os.path.isfile(trace)
-
-        suite = common.PerformedTestSuite(None, None)
-        suite.set_work_dir(os.getcwd())
-        suite.load_run_results(trace)
-
-        chunk_suffix = '_'.join(chunk_ids[chunk])
-        chunk_suffix = '_' + chunk_suffix if chunk_suffix else chunk_suffix
-        suite.chunk_suffix = chunk_suffix
-        suite.chunk_name = ' '.join(chunk_ids[chunk])
-        status = suite.get_status()
+    chunks = list(chunk_ids)
+    for chunk in chunks:
+        assert os.path.isfile(os.path.join(chunk, TRACE_FILE_NAME))
 
+    for chunk, (status, logs) in zip(chunks, _par_map(_load_chunk_results, chunks)):
         if status not in statuses and status != const.Status.GOOD:
-            statuses[status] = suite
+            chunk_suffix = '_'.join(chunk_ids[chunk])
+            chunk_suffix = '_' + chunk_suffix if chunk_suffix else chunk_suffix
+            statuses[status] = (chunk_suffix, logs)
 
     chunk_logs = {}
     invalid_logs = set()
     keylist = sorted(statuses.keys())
     for st in keylist[:MAX_SUITE_CHUNKS]:
-        suite = statuses[st]
-        chunk_suffix = suite.chunk_suffix
-        for log in suite.logs.keys():
+        chunk_suffix, logs = statuses[st]
+        for log in logs.keys():
             if log == 'log':  # merged by results accumulator
                 continue
             invalid_logs.add(log)
-            chunk_logs[log + chunk_suffix] = suite.logs[log]
+            chunk_logs[log + chunk_suffix] = logs[log]
 
     suite = common.PerformedTestSuite(None, None)
     suite.set_work_dir(os.getcwd())
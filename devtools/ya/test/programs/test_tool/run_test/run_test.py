@@ -571,92 +571,76 @@ class StdErrWatcher(object):
             sys.stderr.flush()
 
 
+class _TraceProgressReporter(test.reports.DryReporter):
+    def __init__(self, watcher, stderr_reporter):
+        super(_TraceProgressReporter, self).__init__()
+        self._watcher = watcher
+        self._stderr_reporter = stderr_reporter
+
+    def on_test_case_started(self, test_name):
+        self._watcher.display_test(test_name)
+        if self._stderr_reporter:
+            self._stderr_reporter.on_test_case_started(test_name)
+
+    def on_test_case_finished(self, testcase):
+        if testcase.status != test.common.Status.DESELECTED:
+            self._watcher.display_test(testcase.name)
+        if self._stderr_reporter:
+            self._stderr_reporter.on_test_case_finished(testcase)
+
+    def on_message(self, message):
+        if self._stderr_reporter:
+            self._stderr_reporter.on_message(message)
+
+
 class TraceFileWatcher(object):
+    """
+    Tails the trace file and displays running tests.
+    The trace file is parsed incrementally, the parser is handed over to the final loading of the results.
+    """
+
     def __init__(self, trace_report, test_cwd, output_style, test_stderr):
-        self._trace_report = trace_report
         self._test_cwd = test_cwd
         self.pid = None
-        self._file = None
-        self._buffer = []
-        self._chunk_size = 8192
         self._output_style = output_style
-        self._test_stderr = test_stderr
+        self._displayed_tests = set()
+        reporter = _TraceProgressReporter(self, test.reports.StdErrReporter() if test_stderr else None)
+        self.parser = tracefile.IncrementalTraceParser(trace_report, reporter=reporter, relaxed=True)
 
     def open(self, command, process, out_file, err_file):
-        self._displayed_tests = set()
+        pass
 
     def close(self):
-        if self._file:
-            self._proceed()
-            self._file.close()
-        self._buffer = []
+        self._proceed()
 
     def __call__(self):
         self._proceed()
 
-    def _proceed(self):
+    def display_test(self, name):
         # noinspection PyUnresolvedReferences
         import app_ctx
 
-        trace_report = self._trace_report
-        if not os.path.exists(trace_report):
+        if name in self._displayed_tests:
             return
+        self._displayed_tests.add(name)
 
-        if not self._file:
-            self._file = io.open(trace_report, errors='ignore', encoding='utf-8')
-
-        # try to accumulate some data before parsing
-        # and avoid buffer oversaturation
-        for _ in range(10):
-            data = self._file.read(self._chunk_size)
-            if data:
-                self._buffer.append(data)
-            if len(data) < self._chunk_size:
-                break
+        msg = ">> " + name
+        if self.pid:
+            msg += " (pid: {})".format(self.pid)
+        if self._test_cwd:
+            msg += " in {}".format(self._test_cwd)
 
-        if not self._buffer:
-            return
+        if self._output_style == 'make':
+            app_ctx.display.emit_message("##" + msg + "\n")
+        app_ctx.display.emit_status(msg + "\n")
 
-        # there are no compete line
-        if not any(['\n' in d for d in self._buffer]):
+    def _proceed(self):
+        if self.parser.broken:
             return
-
-        data = ''.join(self._buffer)
-        full, tail = data.rsplit('\n', 1)
-
-        if tail:
-            self._buffer = [tail]
-        else:
-            self._buffer = []
-
-        if full:
-            try:
-                if self._test_stderr:
-                    reporter = test.reports.StdErrReporter()
-                else:
-                    reporter = None
-
-                result = tracefile.TestTraceParser.parse_from_string(full, reporter=reporter, relaxed=True)
-                for testcase in result.tests:
-                    if (
-                        testcase.status not in [test.common.Status.NOT_LAUNCHED, test.common.Status.DESELECTED]
-                        and testcase not in self._displayed_tests
-                    ):
-                        msg = ">> " + testcase.name
-                        if self.pid:
-                            msg += " (pid: {})".format(self.pid)
-                        if self._test_cwd:
-                            msg += " in {}".format(self._test_cwd)
-                        status_msg = msg + "\n"
-
-                        if self._output_style == 'make':
-                            app_ctx.display.emit_message("##" + msg + "\n")
-
-                        app_ctx.display.emit_status(status_msg)
-
-                        self._displayed_tests.add(testcase)
-            except Exception:
-                logger.warning("Error while processing chunk of the trace file: %s", traceback.format_exc())
+        try:
+            self.parser.poll()
+        except Exception:
+            logger.warning("Error while processing chunk of the trace file: %s", traceback.format_exc())
 
 
 class CompositeProcessWatcher(object):
@@ -1334,7 +1318,7 @@ def main():
             if options.local_ram_drive_size:
                 precise_limit -= options.local_ram_drive_size * 1024**3
             precise_limit = max([0, precise_limit])
-            mem_monitor = monitor.MemProcessTreeMonitor(
+            mem_monitor = monitor.create_memory_monitor(
                 target_pid, precise_limit=precise_limit, delay=2, cmdline_limit=pstree_cmdline_limit(options)
             )
             mem_monitor.start()
@@ -1515,6 +1499,7 @@ def main():
         run_timeout = test_timeout
         test_run_dirs = []
         timeout_callback = None
+        trace_watcher = None
 
         if options.smooth_shutdown_signals and not exts.windows.on_win():
             logger.debug("Wrapper supports %s smooth shutdown signals", options.smooth_shutdown_signals)
@@ -1826,7 +1811,7 @@ def main():
                 shutil.copyfileobj(src, dst)
 
         stages.stage("load_results")
-        suite.load_run_results(trace_report)
+        suite.load_run_results(trace_report, trace_parser=trace_watcher.parser if trace_watcher else None)
         if suite.get_status == const.Status.GOOD and not suite.tests:
             logger.debug("Test wrapper didn't execute any test")
 
@@ -2070,6 +2055,8 @@ def stop_monitors(mem_monitor, ram_limit_gb, tmpfs_monitor, suite, autocheck_mod
     if mem_monitor and mem_monitor.is_alive():
         mem_monitor.stop()
         procmem = mem_monitor.get_max_mem_used()
+        for name, value in sorted(mem_monitor.get_metrics().items()):
+            stages.set(name, value)
 
     if tmpfs_monitor and tmpfs_monitor.is_alive():
         tmpfs_monitor.stop()
@@ -2394,6 +2394,27 @@ def wrap_cmd(cmd, cwd=None):
     }
 
 
+def dump_test_durations(suite, opts):
+    """
+    Dumps durations of the suite's tests from previous local runs for the list node to balance chunks by.
+    Returns path to the file or None if there is no history.
+    """
+    if not getattr(opts, 'balance_test_chunks', False) or opts.use_distbuild or not getattr(opts, 'bld_dir', None):
+        return None
+    try:
+        durations = last_failed.get_test_durations(opts.bld_dir, suite)
+        if not durations:
+            return None
+        filename = os.path.join(
+            last_failed.get_tests_durations_cache_dir(opts.bld_dir), 'lists', suite.get_state_hash() + '.json'
+        )
+        exts.fs.write_file(filename, json.dumps(durations))
+        return filename
+    except Exception as e:
+        logger.debug("Failed to dump test durations of %s: %s", suite, e)
+        return None
+
+
 def inject_test_list_node(arc_root, graph, suite, opts, custom_deps, platform_descriptor, random_uid=True, modulo=1):
     if random_uid:
         uid = uid_gen.get_random_uid("list-node")
@@ -2430,6 +2451,9 @@ def inject_test_list_node(arc_root, graph, suite, opts, custom_deps, platform_de
     if add_list_node(opts, suite):
         list_cmd += ["--test-list-path", test_list_file]
         output.append(test_list_file)
+        durations_file = dump_test_durations(suite, opts) if modulo > 1 else None
+        if durations_file:
+            list_cmd += ["--test-durations-path", durations_file]
     else:
         output.append(list_out_dir)
 
@@ -549,11 +549,16 @@ class AbstractTestSuite(facility.Suite):
         if python_lib:
             env["YA_PYTHON_LIB"] = python_lib
 
-    def load_run_results(self, trace_file_path, resolver=None, relaxed=True):
+    def load_run_results(self, trace_file_path, resolver=None, relaxed=True, trace_parser=None):
+        """trace_parser is an IncrementalTraceParser which has already consumed a part of the trace file"""
         if self.is_skipped():
+            if trace_parser:
+                trace_parser.close()
             return
 
-        if trace_file_path and os.path.exists(trace_file_path):
+        if trace_parser and trace_parser.filename == trace_file_path:
+            trace_parser.finish(self)
+        elif trace_file_path and os.path.exists(trace_file_path):
             tracefile.TestTraceParser.parse_from_file(trace_file_path, suite=self, relaxed=relaxed)
 
         if resolver:
@@ -257,14 +257,18 @@ class TestTraceParser(object):
         event_parser.finalize()
 
         if error:
-            event_parser.suite.chunk.add_error(
-                "[[bad]]Test run information is incomplete. Did you run out of space? Unable to load line b64: '{}'".format(
-                    error
-                )
-            )
+            TestTraceParser.add_incomplete_error(event_parser.suite, error)
 
         return event_parser.suite
 
+    @staticmethod
+    def add_incomplete_error(suite, error):
+        suite.chunk.add_error(
+            "[[bad]]Test run information is incomplete. Did you run out of space? Unable to load line b64: '{}'".format(
+                error
+            )
+        )
+
     @staticmethod
     def process_event(event_parser, line, relaxed=False):
         if line:
@@ -292,3 +296,95 @@ class TestTraceParser(object):
             except Exception:
                 logger.error('Failed to process event, b64:"%s"', base64.b64encode(six.ensure_binary(line)))
                 raise
+
+
+class IncrementalTraceParser(object):
+    """
+    Parses a trace file while it's being written: every poll() processes only the data appended since the last one.
+    finish() processes the rest of the file and loads the result into the suite, so the file is parsed once.
+    Suite level events are collected aside and replayed into the suite by finish(), because the parser
+    of a retried run is dropped.
+    """
+
+    def __init__(self, filename, reporter=None, relaxed=True):
+        self.filename = filename
+        self._relaxed = relaxed
+        self._event_parser = TestEventParser(None, reporter)
+        self._file = None
+        self._tail = b''
+        self._error = None
+        self._broken = False
+
+    @property
+    def broken(self):
+        return self._broken
+
+    def poll(self):
+        if self._broken or self._error is not None:
+            return
+        if self._file is None:
+            try:
+                self._file = open(self.filename, 'rb')
+            except (IOError, OSError):
+                return
+
+        data = self._file.read()
+        if not data:
+            return
+        data = self._tail + data
+        end = data.rfind(b'\n') + 1
+        self._tail = data[end:]
+        if end:
+            self._process(data[:end].splitlines(True))
+
+    def _process(self, lines):
+        try:
+            for line in lines:
+                TestTraceParser.process_event(self._event_parser, line.decode('utf-8', 'ignore'), self._relaxed)
+        except ParsingError as e:
+            self._error = e.data
+        except Exception:
+            # finish() falls back to the full parsing, which reports the error the usual way
+            self._broken = True
+            raise
+
+    def _is_same_file(self):
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return False
+        fst = os.fstat(self._file.fileno())
+        return (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino) and st.st_size >= self._file.tell()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+    def finish(self, suite):
+        event_parser = self._event_parser
+        event_parser.reporter = None
+        if self._file is None or self._broken or not self._is_same_file():
+            self.close()
+            return TestTraceParser.parse_from_file(self.filename, suite=suite, relaxed=self._relaxed)
+
+        try:
+            self.poll()
+            if self._tail and self._error is None:
+                self._process([self._tail])
+                self._tail = b''
+        except Exception:
+            self.close()
+            return TestTraceParser.parse_from_file(self.filename, suite=suite, relaxed=self._relaxed)
+        self.close()
+
+        collected = event_parser.suite
+        suite._errors.extend(collected._errors)
+        suite.logs.update(collected.logs)
+        suite.metrics.update(collected.metrics)
+        event_parser.suite = suite
+        event_parser.finalize()
+
+        if self._error:
+            TestTraceParser.add_incomplete_error(suite, self._error)
+
+        return suite
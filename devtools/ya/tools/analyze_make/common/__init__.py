@@ -28,7 +28,7 @@ class Node(object):
 
 def get_cmd_from_evlog(filename: str) -> str:
     reader = yalibrary.evlog.EvlogReader(filename)
-    for node in reader:
+    for node in reader.query(events=['init']):
         if node['event'] == 'init':
             return ' '.join(node['value']['args'])
 
@@ -96,7 +96,8 @@ def load_from_evlog(evlog_reader, detailed=False):
     opened_ymake_stages = {}
     ymake_nodes = []
 
-    for v in evlog_reader:
+    events = events_to_check + ['critical_path', ymake_stage_started, ymake_stage_finished]
+    for v in evlog_reader.query(events=events):
         if v['event'] in events_to_check:
             tm = v['value']['time']
             if tm:
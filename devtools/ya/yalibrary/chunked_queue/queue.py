@@ -7,7 +7,7 @@ from exts import uniq_id
 from exts import filelock
 
 
-__all__ = ['Queue']
+__all__ = ['Queue', 'RecordQueue']
 
 
 DATE_FMT = '%Y_%m_%d_%H_%M_%S'
@@ -26,6 +26,9 @@ def unpack_date(uniq_id):
 
 
 class Chunk(object):
+    # Text lines by default, see RecordChunk
+    BINARY = False
+
     def __init__(self, data_dir, tag):
         self._data_dir = data_dir
         self._tag = tag
@@ -41,11 +44,20 @@ class Chunk(object):
     def stamp(self):
         return unpack_date(self._tag)
 
+    def _mode(self, mode):
+        return mode + 'b' if self.BINARY else mode
+
+    def _items(self, f):
+        return f
+
+    def _pack(self, value):
+        return value + '\n'
+
     def open(self):
         with self._lock:
             if self._stream is not None:
                 raise RuntimeError('Already opened')
-            self._stream = open(self._data_path, 'w+')
+            self._stream = open(self._data_path, self._mode('w+'))
 
     def close(self):
         with self._lock:
@@ -56,14 +68,14 @@ class Chunk(object):
     def consume(self, action):
         with self._lock:
             if self._stream is None:
-                with open(self._data_path, 'r') as f:
-                    for line in f:
+                with open(self._data_path, self._mode('r')) as f:
+                    for line in self._items(f):
                         for x in action(line):
                             yield x
                 fs.remove_file(self._data_path)
             else:
                 self._stream.seek(0)
-                for line in self._stream:
+                for line in self._items(self._stream):
                     for x in action(line):
                         yield x
                 self._stream.seek(0)
@@ -73,8 +85,8 @@ class Chunk(object):
     def analyze(self, analyzer):
         self.flush()
         with self._lock:
-            with open(self._data_path, 'r') as f:
-                for line in f:
+            with open(self._data_path, self._mode('r')) as f:
+                for line in self._items(f):
                     for x in analyzer(line):
                         yield x
 
@@ -90,15 +102,15 @@ class Chunk(object):
 
                 def __exit__(rself, type, value, traceback):
                     if rself._opened:
-                        self._stream = open(self._data_path, 'a')
+                        self._stream = open(self._data_path, self._mode('a'))
                     return isinstance(value, OSError)
 
             with reopener():
-                with open(self._data_path, 'r+') as f:
-                    left_over = [x for line in f for x in lines_filter(line)]
+                with open(self._data_path, self._mode('r+')) as f:
+                    left_over = [x for line in self._items(f) for x in lines_filter(line)]
                     if left_over:
                         f.seek(0)
-                        data = ''.join(left_over)
+                        data = (b'' if self.BINARY else '').join(left_over)
                         f.write(data)
                         f.truncate()
 
@@ -109,7 +121,7 @@ class Chunk(object):
         with self._lock:
             if self._stream is None:
                 raise RuntimeError('Chunk is not opened')
-            self._stream.write(value + '\n')
+            self._stream.write(self._pack(value))
 
     def flush(self):
         with self._lock:
@@ -121,59 +133,105 @@ class Chunk(object):
         return Chunk(data_dir, uniq_name())
 
 
+class RecordChunk(Chunk):
+    """Chunk of fixed size binary records. A torn record at the end (crash during write) is skipped"""
+
+    BINARY = True
+
+    def __init__(self, data_dir, tag, record_size):
+        super(RecordChunk, self).__init__(data_dir, tag)
+        self._record_size = record_size
+
+    def _items(self, f):
+        while True:
+            record = f.read(self._record_size)
+            if len(record) < self._record_size:
+                return
+            yield record
+
+    def _pack(self, value):
+        if len(value) != self._record_size:
+            raise ValueError('Record of {} bytes, expected {}'.format(len(value), self._record_size))
+        return value
+
+
 class NoChunkError(Exception):
     pass
 
 
 class Queue(object):
-    def __init__(self, store_dir):
+    def __init__(self, store_dir, shards=1):
+        """Every shard has its own active chunk, so pushes into different shards don't contend"""
         fs.create_dirs(store_dir)
 
         self._data_dir = os.path.join(store_dir, 'data')
         self._consume_lock = filelock.FileLock(os.path.join(store_dir, 'consume.lock'))
         fs.create_dirs(self._data_dir)
-        self._active_chunk = Chunk.create_new(self._data_dir)
-        self._active_chunk.open()
+        self._active_chunks = []
+        for _ in range(shards):
+            chunk = self._make_chunk(uniq_name())
+            chunk.open()
+            self._active_chunks.append(chunk)
+        self._active_tags = {chunk.tag: chunk for chunk in self._active_chunks}
+
+    def _make_chunk(self, tag):
+        return Chunk(self._data_dir, tag)
 
     def close(self):
-        self._active_chunk.close()
+        for chunk in self._active_chunks:
+            chunk.close()
 
     def sieve(self, consumer, max_chunks=None):
         with self._consume_lock:
             for chunk_name in sorted(os.listdir(self._data_dir))[:max_chunks]:
-                if os.path.basename(chunk_name) != self._active_chunk.tag:
-                    chunk = Chunk(self._data_dir, chunk_name)
+                if os.path.basename(chunk_name) not in self._active_tags:
+                    chunk = self._make_chunk(chunk_name)
                     for x in chunk.consume(consumer):
                         yield x
 
     def sieve_current_chunk(self, consumer):
         with self._consume_lock:
-            for x in self._active_chunk.consume(consumer):
-                yield x
+            for chunk in self._active_chunks:
+                for x in chunk.consume(consumer):
+                    yield x
 
     def analyze(self, analyzer):
         with self._consume_lock:
             for chunk_name in sorted(os.listdir(self._data_dir)):
-                chunk = (
-                    Chunk(self._data_dir, chunk_name)
-                    if os.path.basename(chunk_name) != self._active_chunk.tag
-                    else self._active_chunk
-                )
+                chunk = self._active_tags.get(os.path.basename(chunk_name)) or self._make_chunk(chunk_name)
                 for x in chunk.analyze(analyzer):
                     yield x
 
-    def push(self, value):
-        self._active_chunk.add(value)
+    def push(self, value, shard=0):
+        self._active_chunks[shard].add(value)
 
     def flush(self):
-        self._active_chunk.flush()
+        for chunk in self._active_chunks:
+            chunk.flush()
 
     def strip(self, lines_filter):
         with self._consume_lock:
             for chunk_name in sorted(os.listdir(self._data_dir)):
-                chunk = (
-                    Chunk(self._data_dir, chunk_name)
-                    if os.path.basename(chunk_name) != self._active_chunk.tag
-                    else self._active_chunk
-                )
+                chunk = self._active_tags.get(os.path.basename(chunk_name)) or self._make_chunk(chunk_name)
                 chunk.consume_lines(lines_filter)
+
+
+class RecordQueue(Queue):
+    """Queue of fixed size binary records"""
+
+    def __init__(self, store_dir, record_size, shards=1):
+        self._record_size = record_size
+        super(RecordQueue, self).__init__(store_dir, shards)
+
+    def _make_chunk(self, tag):
+        return RecordChunk(self._data_dir, tag, self._record_size)
+
+    def put_chunk(self, tag, records):
+        """Atomically adds a complete chunk, e.g. converted from another format. Tag defines its place in the queue"""
+        chunk = self._make_chunk(tag)
+        # Outside of the data dir, otherwise a concurrent sieve may consume it
+        tmp_path = os.path.join(os.path.dirname(self._data_dir), '{}.{}.tmp'.format(tag, uniq_id.gen8()))
+        with open(tmp_path, 'wb') as f:
+            for record in records:
+                f.write(chunk._pack(record))
+        os.rename(tmp_path, os.path.join(self._data_dir, tag))
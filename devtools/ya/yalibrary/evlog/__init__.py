@@ -8,6 +8,7 @@ import threading
 import time
 
 import six
+import six.moves.queue as queue
 import zstandard as zstd
 
 import core.config
@@ -16,6 +17,8 @@ from exts import fs
 from exts import os2
 from exts import yjson
 
+from yalibrary.evlog import blocks
+
 _LOG_FILE_NAME_FMT = '%H-%M-%S'
 _LOG_DIR_NAME_FMT = '%Y-%m-%d'
 DAYS_TO_SAVE = 10
@@ -25,10 +28,12 @@ class EvlogSuffix:
     ZST = '.evlog.zst'
     ZSTD = '.evlog.zstd'
     JSON = '.evlog'
+    # Indexed container, see blocks.py
+    INDEXED = '.evlog.zblk'
 
     @classmethod
     def all(cls):
-        return cls.ZST, cls.ZSTD, cls.JSON
+        return cls.ZST, cls.ZSTD, cls.JSON, cls.INDEXED
 
 
 def _fix_non_utf8(data):
@@ -53,9 +58,14 @@ def is_compressed(filepath):
     return filepath.endswith(('.zstd', '.zst'))
 
 
+def is_indexed(filepath):
+    return filepath.endswith(EvlogSuffix.INDEXED)
+
+
 class EvlogReader:
     def __init__(self, filepath):
         self.filepath = filepath
+        self._indexed = blocks.is_indexed(filepath)
 
     @contextlib.contextmanager
     def _get_stream(self):
@@ -71,6 +81,11 @@ class EvlogReader:
                 yield afile
 
     def __iter__(self):
+        if self._indexed:
+            for record in blocks.BlockReader(self.filepath).query():
+                yield record
+            return
+
         with self._get_stream() as stream:
             for nline, line in enumerate(stream):
                 try:
@@ -79,6 +94,28 @@ class EvlogReader:
                     logging.warning("Skip broken entry at %s line", nline + 1)
                     continue
 
+    def query(self, namespaces=None, events=None, since=None, until=None):
+        """
+        Records of the given namespaces and events with timestamps in [since, until], None means any.
+        Indexed event logs read only blocks which may contain such records.
+        """
+        if self._indexed:
+            for record in blocks.BlockReader(self.filepath).query(namespaces, events, since, until):
+                yield record
+            return
+
+        namespaces = None if namespaces is None else frozenset(namespaces)
+        events = None if events is None else frozenset(events)
+        for record in self:
+            if namespaces is not None and record.get('namespace') not in namespaces:
+                continue
+            if events is not None and record.get('event') not in events:
+                continue
+            timestamp = record.get('timestamp')
+            if since is not None and timestamp < since or until is not None and timestamp > until:
+                continue
+            yield record
+
 
 class EmptyEvlogListException(Exception):
     mute = True
@@ -95,15 +132,62 @@ class DummyEvlog(object):
         return self
 
 
+class _ThreadBuffer(object):
+    __slots__ = ('lock', 'records', 'size', 'thread', 'handing_off')
+
+    def __init__(self, thread):
+        self.lock = threading.Lock()
+        self.records = []
+        self.size = 0
+        self.thread = thread
+        # The owner is putting a chunk into the queue, newer records must wait for it
+        self.handing_off = False
+
+    def take(self):
+        with self.lock:
+            if self.handing_off:
+                return []
+            records, self.records, self.size = self.records, [], 0
+        return records
+
+
 class EvlogWriter(object):
+    """
+    Records are serialized on the caller's thread into a per-thread buffer. Full buffers are handed
+    to the background thread which scrubs secrets and writes (compresses) them.
+    The handoff queue is bounded, so writers wait if the background thread can't keep up.
+
+    close() writes all records, but if the process dies without it, up to FLUSH_INTERVAL
+    of the last records (plus queued buffers) never reach the file. Writing after close() raises ValueError.
+    """
+
+    # Raw size of a thread buffer handed to the background thread
+    CHUNK_SIZE = 64 * 1024
+    MAX_QUEUED_CHUNKS = 64
+    # Not full buffers are written at least that often (seconds)
+    FLUSH_INTERVAL = 1.0
+    SECRET_STUB = "[SECRET]"
+
     def __init__(self, filepath, replacements=None):
         self.filepath = filepath
+        self._indexed = is_indexed(filepath)
         self._fileobj = self._open_file(filepath)
-        self._lock = threading.Lock()
-        self._replacements = self._get_replacements(replacements)
+        # The longest first, so a secret containing another one is replaced as a whole
+        self._replacements = sorted(set(self._get_replacements(replacements)), key=len, reverse=True)
+        self._local = threading.local()
+        self._buffers = []
+        self._buffers_lock = threading.Lock()
+        self._queue = queue.Queue(self.MAX_QUEUED_CHUNKS)
+        self._stopped = False
+        self._flusher = threading.Thread(target=self._flush_loop, name='evlog-writer')
+        self._flusher.daemon = True
+        self._flusher.start()
 
     @staticmethod
     def _open_file(filepath):
+        if is_indexed(filepath):
+            return blocks.BlockWriter(filepath)
+
         if is_compressed(filepath):
             if six.PY3:
                 return zstd.open(filepath, 'w', cctx=zstd.ZstdCompressor(level=1))
@@ -139,10 +223,19 @@ class EvlogWriter(object):
         return s not in frozenset(["true", "false", "null"])
 
     def _remove_secrets(self, s):
+        # Applied to whole batches: str.replace is much faster than a regex alternation
         for r in self._replacements:
-            s = s.replace(r, "[SECRET]")
+            s = s.replace(r, self.SECRET_STUB)
         return s
 
+    def _thread_buffer(self):
+        buf = getattr(self._local, 'buffer', None)
+        if buf is None:
+            buf = self._local.buffer = _ThreadBuffer(threading.current_thread())
+            with self._buffers_lock:
+                self._buffers.append(buf)
+        return buf
+
     def write(self, namespace, event, **kwargs):
         value = {
             'timestamp': time.time(),
@@ -156,21 +249,98 @@ class EvlogWriter(object):
         except (UnicodeDecodeError, OverflowError):
             s = yjson.dumps(_fix_non_utf8(value)) + '\n'
 
-        s = self._remove_secrets(s)
-
-        with self._lock:
-            try:
-                self._fileobj.write(s)
-            except IOError as e:
-                import errno
-
-                if e.errno == errno.ENOSPC:
-                    sys.stderr.write("No space left on device, clean up some files. Try running 'ya gc cache'\n")
-                    sys.stderr.write(s)
+        buf = self._thread_buffer()
+        with buf.lock:
+            if self._stopped:
+                raise ValueError('Event log {} is closed'.format(self.filepath))
+            buf.records.append((value['timestamp'], namespace, event, s))
+            buf.size += len(s)
+            if buf.size < self.CHUNK_SIZE:
+                return
+            chunk, buf.records, buf.size = buf.records, [], 0
+            buf.handing_off = True
+        try:
+            self._queue.put(chunk)
+        finally:
+            buf.handing_off = False
+
+    def _collect_buffers(self):
+        records = []
+        with self._buffers_lock:
+            buffers = list(self._buffers)
+        for buf in buffers:
+            records.extend(buf.take())
+            if not buf.thread.is_alive():
+                with self._buffers_lock:
+                    self._buffers.remove(buf)
+                # The thread might have written after take()
+                records.extend(buf.take())
+        return records
+
+    def _get_chunks(self, records, timeout=None):
+        """Moves queued records into records, returns True if the writer is closed"""
+        stopping = False
+        try:
+            chunk = self._queue.get(timeout=timeout) if timeout is not None else self._queue.get_nowait()
+            while True:
+                if chunk is None:
+                    stopping = True
                 else:
-                    raise e
+                    records.extend(chunk)
+                chunk = self._queue.get_nowait()
+        except queue.Empty:
+            pass
+        return stopping
+
+    def _flush_loop(self):
+        next_collect = time.time() + self.FLUSH_INTERVAL
+        stopping = False
+        while not stopping:
+            records = []
+            stopping = self._get_chunks(records, max(next_collect - time.time(), 0))
+
+            if stopping or time.time() >= next_collect:
+                collected = self._collect_buffers()
+                # Chunks queued before the collection hold older records of the same threads
+                stopping = self._get_chunks(records) or stopping
+                records.extend(collected)
+                next_collect = time.time() + self.FLUSH_INTERVAL
+
+            if records:
+                # Records of different threads go in order of their timestamps within a batch
+                records.sort(key=lambda r: r[0])
+                self._write_records(records)
+
+    def _write_records(self, records):
+        try:
+            if self._indexed:
+                for timestamp, namespace, event, s in records:
+                    self._fileobj.write_record(namespace, event, timestamp, self._remove_secrets(s))
+            else:
+                self._fileobj.write(self._remove_secrets(''.join(r[3] for r in records)))
+        except Exception as e:
+            import errno
+
+            if isinstance(e, (IOError, OSError)) and e.errno == errno.ENOSPC:
+                sys.stderr.write("No space left on device, clean up some files. Try running 'ya gc cache'\n")
+                sys.stderr.write(self._remove_secrets(''.join(r[3] for r in records)))
+            else:
+                logging.exception('Failed to write %d records into event log %s', len(records), self.filepath)
 
     def close(self):
+        if not self._stopped:
+            self._stopped = True
+            with self._buffers_lock:
+                buffers = list(self._buffers)
+            # Writers which got past the check are done with their buffers, the rest raise
+            for buf in buffers:
+                with buf.lock:
+                    pass
+            # Handed off chunks must be queued before the stop marker
+            while any(buf.handing_off for buf in buffers):
+                time.sleep(0.001)
+            self._queue.put(None)
+            self._flusher.join()
         self._fileobj.close()
 
     @property
@@ -203,11 +373,12 @@ class EvlogFileFinder(object):
 
 
 class EvlogFacade(object):
-    def __init__(self, evlog_dir, filename=None, replacements=None):
+    def __init__(self, evlog_dir, filename=None, replacements=None, indexed=False):
         fs.create_dirs(evlog_dir)
 
         self._evlog_dir = evlog_dir
         self._now_time = datetime.datetime.now()
+        self._suffix = EvlogSuffix.INDEXED if indexed else EvlogSuffix.ZST
 
         filepath = filename or self._gen_default_filepath()
         logging.debug('Event log file is %s', filepath)
@@ -241,7 +412,7 @@ class EvlogFacade(object):
 
     def _gen_default_filepath(self):
         run_uid = core.gsid.uid()
-        default_filename = self._now_time.strftime(_LOG_FILE_NAME_FMT) + '.' + run_uid + EvlogSuffix.ZST
+        default_filename = self._now_time.strftime(_LOG_FILE_NAME_FMT) + '.' + run_uid + self._suffix
         chunk_name = self._now_time.strftime(_LOG_DIR_NAME_FMT)
         fs.create_dirs(os.path.join(self._evlog_dir, chunk_name))
         return os.path.join(self._evlog_dir, chunk_name, default_filename)
@@ -263,7 +434,7 @@ class EvlogFacade(object):
 
 def with_evlog(params, evlog_dir, hide_token):
     filename = getattr(params, 'evlog_file', None)
-    evlog = EvlogFacade(evlog_dir, filename, hide_token)
+    evlog = EvlogFacade(evlog_dir, filename, hide_token, indexed=getattr(params, 'evlog_indexed', False))
     evlog.cleanup_old_dirs()
     evlog.write('init', 'init', args=sys.argv, env=os.environ.copy())
 
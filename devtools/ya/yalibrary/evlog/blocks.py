@@ -0,0 +1,274 @@
+"""
+Indexed event log container.
+
+Records are grouped into zstd compressed blocks, each block holds records of a single (namespace, event)
+in the order they were written. The footer is an index of all blocks with their timestamp ranges,
+so a reader decompresses only blocks matching the query. If the footer is missing (the writer was killed),
+the index is rebuilt by walking block headers, which doesn't need decompression either.
+
+    file   := MAGIC block* index TRAILER
+    block  := BLOCK_HEADER namespace event data
+    index  := zstd(json([[namespace, event, ts_min, ts_max, offset, count], ...]))
+"""
+
+import heapq
+import logging
+import os
+import struct
+
+import six
+import zstandard as zstd
+
+from exts import yjson
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'YAEVLOG1'
+BLOCK_MAGIC = b'EVB1'
+TRAILER_MAGIC = b'YAEVIDX1'
+# magic, data size, raw size, records count, min timestamp, max timestamp, namespace length, event length
+BLOCK_HEADER = struct.Struct('<4sIIIddHH')
+# index offset, index size, magic
+TRAILER = struct.Struct('<QQ8s')
+
+
+class IndexedEvlogError(Exception):
+    pass
+
+
+def is_indexed(filepath):
+    try:
+        with open(filepath, 'rb') as afile:
+            return afile.read(len(MAGIC)) == MAGIC
+    except (IOError, OSError):
+        return False
+
+
+class BlockInfo(object):
+    __slots__ = ('namespace', 'event', 'ts_min', 'ts_max', 'offset', 'count')
+
+    def __init__(self, namespace, event, ts_min, ts_max, offset, count):
+        self.namespace = namespace
+        self.event = event
+        self.ts_min = ts_min
+        self.ts_max = ts_max
+        self.offset = offset
+        self.count = count
+
+    def to_list(self):
+        return [self.namespace, self.event, self.ts_min, self.ts_max, self.offset, self.count]
+
+    def matches(self, namespaces=None, events=None, since=None, until=None):
+        if namespaces is not None and self.namespace not in namespaces:
+            return False
+        if events is not None and self.event not in events:
+            return False
+        if since is not None and self.ts_max < since:
+            return False
+        if until is not None and self.ts_min > until:
+            return False
+        return True
+
+
+class _Pending(object):
+    __slots__ = ('lines', 'size', 'ts_min', 'ts_max')
+
+    def __init__(self):
+        self.lines = []
+        self.size = 0
+        self.ts_min = None
+        self.ts_max = None
+
+    def add(self, timestamp, line):
+        self.lines.append(line)
+        self.size += len(line)
+        if self.ts_min is None or timestamp < self.ts_min:
+            self.ts_min = timestamp
+        if self.ts_max is None or timestamp > self.ts_max:
+            self.ts_max = timestamp
+
+
+class BlockWriter(object):
+    """Not thread safe, EvlogWriter serializes writes"""
+
+    # Raw size of a block
+    BLOCK_SIZE = 256 * 1024
+    # Raw size of all not yet written blocks, the largest one is written when it's exceeded
+    MAX_PENDING_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, filepath, level=1):
+        self.filepath = filepath
+        self._file = open(filepath, 'wb')
+        self._file.write(MAGIC)
+        self._cctx = zstd.ZstdCompressor(level=level)
+        self._pending = {}
+        self._pending_size = 0
+        self._index = []
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def write_record(self, namespace, event, timestamp, line):
+        """line is a serialized record terminated by a newline"""
+        key = (namespace, event)
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = _Pending()
+        line = six.ensure_binary(line)
+        pending.add(timestamp, line)
+        self._pending_size += len(line)
+
+        if pending.size >= self.BLOCK_SIZE:
+            self._write_block(key)
+        elif self._pending_size >= self.MAX_PENDING_SIZE:
+            self._write_block(max(self._pending, key=lambda k: self._pending[k].size))
+
+    def _write_block(self, key):
+        pending = self._pending.pop(key)
+        self._pending_size -= pending.size
+        raw = b''.join(pending.lines)
+        data = self._cctx.compress(raw)
+        namespace = six.ensure_binary(key[0])
+        event = six.ensure_binary(key[1])
+
+        offset = self._file.tell()
+        self._file.write(
+            BLOCK_HEADER.pack(
+                BLOCK_MAGIC,
+                len(data),
+                len(raw),
+                len(pending.lines),
+                pending.ts_min,
+                pending.ts_max,
+                len(namespace),
+                len(event),
+            )
+        )
+        self._file.write(namespace)
+        self._file.write(event)
+        self._file.write(data)
+        self._index.append(BlockInfo(key[0], key[1], pending.ts_min, pending.ts_max, offset, len(pending.lines)))
+
+    def flush(self):
+        for key in sorted(self._pending, key=lambda k: self._pending[k].ts_min):
+            self._write_block(key)
+        self._file.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.flush()
+            index_offset = self._file.tell()
+            index = self._cctx.compress(six.ensure_binary(yjson.dumps([info.to_list() for info in self._index])))
+            self._file.write(index)
+            self._file.write(TRAILER.pack(index_offset, len(index), TRAILER_MAGIC))
+        finally:
+            self._file.close()
+
+
+class BlockReader(object):
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._index = None
+
+    def index(self):
+        if self._index is None:
+            with open(self.filepath, 'rb') as afile:
+                if afile.read(len(MAGIC)) != MAGIC:
+                    raise IndexedEvlogError('{} is not an indexed event log'.format(self.filepath))
+                self._index = self._read_footer(afile)
+                if self._index is None:
+                    logger.debug('Index of %s is missing, scanning blocks', self.filepath)
+                    self._index = self._scan(afile)
+        return self._index
+
+    @staticmethod
+    def _read_footer(afile):
+        afile.seek(0, os.SEEK_END)
+        size = afile.tell()
+        if size < len(MAGIC) + TRAILER.size:
+            return None
+        afile.seek(size - TRAILER.size)
+        index_offset, index_size, magic = TRAILER.unpack(afile.read(TRAILER.size))
+        if magic != TRAILER_MAGIC or index_offset + index_size + TRAILER.size != size:
+            return None
+        afile.seek(index_offset)
+        try:
+            items = yjson.loads(zstd.ZstdDecompressor().decompress(afile.read(index_size)))
+        except Exception as e:
+            logger.debug('Broken index: %s', e)
+            return None
+        return [BlockInfo(*item) for item in items]
+
+    @staticmethod
+    def _scan(afile):
+        index = []
+        afile.seek(0, os.SEEK_END)
+        size = afile.tell()
+        offset = len(MAGIC)
+        while offset + BLOCK_HEADER.size <= size:
+            afile.seek(offset)
+            magic, data_size, _, count, ts_min, ts_max, ns_len, event_len = BLOCK_HEADER.unpack(
+                afile.read(BLOCK_HEADER.size)
+            )
+            end = offset + BLOCK_HEADER.size + ns_len + event_len + data_size
+            if magic != BLOCK_MAGIC or end > size:
+                break
+            namespace = six.ensure_str(afile.read(ns_len))
+            event = six.ensure_str(afile.read(event_len))
+            index.append(BlockInfo(namespace, event, ts_min, ts_max, offset, count))
+            offset = end
+        return index
+
+    def blocks(self, namespaces=None, events=None, since=None, until=None):
+        namespaces = None if namespaces is None else frozenset(namespaces)
+        events = None if events is None else frozenset(events)
+        return [info for info in self.index() if info.matches(namespaces, events, since, until)]
+
+    def read_block(self, afile, info):
+        """Serialized records of the block"""
+        afile.seek(info.offset)
+        magic, data_size, raw_size, _, _, _, ns_len, event_len = BLOCK_HEADER.unpack(afile.read(BLOCK_HEADER.size))
+        if magic != BLOCK_MAGIC:
+            raise IndexedEvlogError('No block at {} of {}'.format(info.offset, self.filepath))
+        afile.seek(ns_len + event_len, os.SEEK_CUR)
+        raw = zstd.ZstdDecompressor().decompress(afile.read(data_size), max_output_size=raw_size)
+        return raw.splitlines()
+
+    def _iter_block(self, afile, info, since, until):
+        for line in self.read_block(afile, info):
+            try:
+                record = yjson.loads(line)
+            except Exception:
+                logger.warning('Skip broken entry in block at %d of %s', info.offset, self.filepath)
+                continue
+            timestamp = record.get('timestamp')
+            if since is not None and timestamp < since or until is not None and timestamp > until:
+                continue
+            yield record
+
+    def query(self, namespaces=None, events=None, since=None, until=None, ordered=True):
+        """
+        Records of the given namespaces and events with timestamps in [since, until], None means any.
+        Records are ordered by timestamp if ordered is set, otherwise go block by block.
+        """
+        infos = self.blocks(namespaces, events, since, until)
+        with open(self.filepath, 'rb') as afile:
+            if not ordered:
+                for info in infos:
+                    for record in self._iter_block(afile, info, since, until):
+                        yield record
+                return
+
+            # Records of a block are in order of writing, which may differ from timestamps a bit
+            streams = [
+                sorted(
+                    (record['timestamp'], n, i, record)
+                    for i, record in enumerate(self._iter_block(afile, info, since, until))
+                )
+                for n, info in enumerate(infos)
+            ]
+            for item in heapq.merge(*streams):
+                yield item[-1]
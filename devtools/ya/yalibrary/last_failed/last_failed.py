@@ -16,6 +16,10 @@ import io
 logger = logging.getLogger(__name__)
 STATUS_STORE_SIZE = 10 * 1024 * 1024  # 10MB
 STATUS_STORE_TTL = 1  # last run
+DURATIONS_STORE_SIZE = 10 * 1024 * 1024  # 10MB
+DURATIONS_STORE_TTL = 14 * 24 * 60 * 60  # 2 weeks
+# Statuses of tests which did not really run
+NOT_RUN_STATUSES = ('skipped', 'not_launched', 'deselected')
 
 
 class SizeFilter(object):
@@ -84,6 +88,10 @@ def get_tests_restart_cache_dir(garbage_dir):
     return os.path.join(garbage_dir, 'cache', 'trc')
 
 
+def get_tests_durations_cache_dir(garbage_dir):
+    return os.path.join(garbage_dir, 'cache', 'tdc')
+
+
 def _get_trace_content(trace_path):
     res = {}
     with open(trace_path, 'r') as read_file:
@@ -159,3 +167,53 @@ def cache_test_statuses(res, tests, garbage_dir, last_failed_tests):
             res_info = _merge_statuses_info(old_statuses_info, new_info)
             status_storage.put(h, res_info)
     status_storage.flush()
+
+
+def _get_trace_durations(trace_path):
+    res = {}
+    with open(trace_path, 'r') as read_file:
+        for test_info in read_file:
+            test_info = json.loads(test_info)
+            value = test_info.get('value', {})
+            if test_info.get('name') == 'subtest-finished' and value.get('status') not in NOT_RUN_STATUSES:
+                res[value['class'] + '::' + value['subtest']] = value.get('time') or 0.0
+    return res
+
+
+def _get_suite_durations(res, suite):
+    durations = {}
+    for uid in suite.result_uids:
+        if uid not in res:
+            continue
+        trace_path = _get_trace_path(res[uid])
+        if trace_path and os.path.exists(trace_path):
+            durations.update(_get_trace_durations(trace_path))
+    return durations
+
+
+def _merge_durations(old_durations, new_durations):
+    # Average with the previous run to smooth out outliers
+    result = dict(old_durations or {})
+    for test_name, duration in iteritems(new_durations):
+        if test_name in result:
+            duration = (result[test_name] + duration) / 2.0
+        result[test_name] = duration
+    return result
+
+
+def cache_test_durations(res, tests, garbage_dir):
+    """Stores durations of the tests to balance chunks of the next runs"""
+    durations_storage = StatusStore(get_tests_durations_cache_dir(garbage_dir))
+    durations_storage.compact(DURATIONS_STORE_SIZE, DURATIONS_STORE_TTL)
+    for suite in tests:
+        new_durations = _get_suite_durations(res, suite)
+        if not new_durations:
+            continue
+        params_hash = suite.get_state_hash()
+        durations_storage.put(params_hash, _merge_durations(durations_storage.get(params_hash), new_durations))
+    durations_storage.flush()
+
+
+def get_test_durations(garbage_dir, suite):
+    """{'class::test': seconds} measured in previous runs of the suite"""
+    return StatusStore(get_tests_durations_cache_dir(garbage_dir)).get(suite.get_state_hash()) or {}
@@ -0,0 +1,128 @@
+import logging
+import mmap
+
+import six
+
+from devtools.libs.parse_number.python import parse_number
+from yalibrary.store import hash_map
+
+logger = logging.getLogger(__name__)
+
+
+class DurationHistory(object):
+    """stats_uid -> duration of the node in the last run (ms). Lossy like UsageMap"""
+
+    FILE_SIZE = 12 * 1003001
+
+    def __init__(self, fname):
+        self._f = hash_map.open_file(fname, self.FILE_SIZE)
+        self._mm = mmap.mmap(self._f.fileno(), 0)
+        self._hmap = hash_map.OpenHashMap(self._mm, 'I')
+
+    def close(self):
+        self._hmap.flush()
+        self._mm.close()
+        self._f.close()
+
+    def get(self, key):
+        """Duration in seconds, None if unknown"""
+        try:
+            return self._hmap[key][0] / 1000.0
+        except KeyError:
+            return None
+
+    def set(self, key, duration):
+        self._hmap[key] = (min(int(duration * 1000), 0xFFFFFFFF),)
+
+    def flush(self):
+        self._hmap.flush()
+
+
+class DurationEstimator(object):
+    """
+    Estimates how long a node runs: duration from the --stat data (min_reqs) if known,
+    otherwise the duration of the same node (by stats_uid) in the last run on this host.
+    """
+
+    # Unknown nodes and nodes restored from a cache
+    DEFAULT_DURATION = 1.0
+    RESTORE_DURATION = 0.05
+
+    def __init__(self, history=None, default=None):
+        self._history = history
+        self._default = default or self.DEFAULT_DURATION
+
+    @staticmethod
+    def _stat_duration(node):
+        duration = (node.min_reqs or {}).get('duration')
+        if not duration:
+            return None
+        try:
+            # Duration is like 1.2Ks, parse_human_readable_number expects the prefix only
+            return parse_number.parse_human_readable_number(duration[:-1])
+        except Exception as e:
+            logger.debug('Can not parse duration %r of %s: %r', duration, node.uid, e)
+            return None
+
+    def estimate(self, node):
+        duration = self._stat_duration(node)
+        if duration is None and self._history is not None and node.stats_uid:
+            duration = self._history.get(node.stats_uid)
+        return self._default if duration is None else duration
+
+
+def calc_remaining(nodes, duration):
+    """
+    Longest path from the start of each node to the end of the build: duration(node)
+    plus the longest remaining path among the nodes consuming its outputs. Nodes on a cycle get nothing.
+    """
+    consumers_left = dict((node, 0) for node in nodes)
+    for node in nodes:
+        for dep in node.dep_nodes():
+            consumers_left[dep] = consumers_left.get(dep, 0) + 1
+
+    remaining = {}
+    tail = {}
+    ready = [node for node, count in six.iteritems(consumers_left) if count == 0]
+    while ready:
+        node = ready.pop()
+        path = duration(node) + tail.get(node, 0)
+        remaining[node] = path
+        for dep in node.dep_nodes():
+            if tail.get(dep, 0) < path:
+                tail[dep] = path
+            consumers_left[dep] -= 1
+            if consumers_left[dep] == 0:
+                ready.append(dep)
+
+    if len(remaining) != len(consumers_left):
+        logger.debug('%d nodes are on dependency cycles', len(consumers_left) - len(remaining))
+    return remaining
+
+
+def set_priorities(nodes, estimator, cached=None):
+    """Sets node.critical_path (ms) used as scheduling priority. cached nodes are expected to be restored"""
+    cached = cached or frozenset()
+
+    def duration(node):
+        if node.uid in cached:
+            return estimator.RESTORE_DURATION
+        return estimator.estimate(node)
+
+    remaining = calc_remaining(nodes, duration)
+    for node in nodes:
+        node.critical_path = int(remaining.get(node, 0) * 1000)
+
+
+def record_durations(history, nodes, execution_log):
+    """
+    Saves durations of nodes that were run successfully in this build.
+    Nodes restored by content uid and failed ones don't tell how long the node builds, their history is kept.
+    """
+    for node in nodes:
+        info = execution_log.get(node.uid, {})
+        timing = info.get('timing')
+        if not node.stats_uid or not timing or info.get('exit_code') or info.get('dynamically_resolved_cache'):
+            continue
+        history.set(node.stats_uid, timing[1] - timing[0])
+    history.flush()
@@ -2,6 +2,7 @@ import collections
 import contextlib2
 import exts.yjson as json
 import fnmatch
+import functools
 import logging
 import os
 import re
@@ -27,14 +28,17 @@ from yalibrary import status_view
 from yalibrary.active_state import Cancelled
 from yalibrary.fetcher.resource_fetcher import fetch_resource_if_need
 from yalibrary.runner import build_root
+from yalibrary.runner import critical_path
 from yalibrary.runner import patterns as ptn
 from yalibrary.runner import runqueue
+from yalibrary.runner import script_workers
 from yalibrary.runner import statcalc
 from yalibrary.runner import worker_threads
 from yalibrary.runner import task_cache
 from yalibrary.runner.command_file.python import command_file as cf
 import yalibrary.runner.sandboxing as sandboxing
 from yalibrary.status_view.helpers import format_paths
+from yalibrary.store import tiered_store
 
 
 logger = logging.getLogger(__name__)
@@ -175,6 +179,23 @@ def _run(ctx, app_ctx, callback, exit_stack, output_replacements=None):
             return False
 
     workers = exit_stack.enter_context(WorkersContext())
+
+    write_behind = None
+    write_behind_size = getattr(ctx.opts, 'dist_store_write_behind_queue', 0)
+    if dist_cache and not dist_cache.readonly() and write_behind_size > 0 and not ctx.opts.use_distbuild:
+        # As many threads as upload slots, deferred uploads don't hold them
+        write_behind = tiered_store.WriteBehindQueue(net_threads, write_behind_size, name='dist-cache-write-behind')
+    tiered_cache = tiered_store.TieredStore(cache, dist_cache, write_behind, fill_local=ctx.opts.yt_store_wt)
+
+    class WriteBehindContext(object):
+        def __enter__(self):
+            return tiered_cache
+
+        def __exit__(self, *exc_details):
+            # Uploads are flushed after the graph execution, here are cancelled ones left after a failure
+            tiered_cache.flush(0)
+            return False
+
     # Workers expect stopped state
     state = exit_stack.enter_context(StateContext())
 
@@ -187,6 +208,8 @@ def _run(ctx, app_ctx, callback, exit_stack, output_replacements=None):
             validate_content=ctx.opts.validate_build_root_content,
         )
     )
+    # Exits before the build root set: its lock must be held till the uploads from the build roots are done
+    exit_stack.enter_context(WriteBehindContext())
     continue_on_fail = graph['conf'].get('keepon', False)
     os.environ['LC_ALL'] = 'C'
     os.environ['LANG'] = 'en'
@@ -258,8 +281,12 @@ def _run(ctx, app_ctx, callback, exit_stack, output_replacements=None):
             self.requirements = kwargs.get('requirements', {})
             self.cacheable = kwargs.get('cache', True)
             self.priority = kwargs.get('priority')
+            self.stats_uid = kwargs.get('stats_uid')
+            self.min_reqs = kwargs.get('min_reqs')
             self.target_properties = kwargs.get('target_properties', {})
             self.max_dist = 0
+            # Estimated time till the end of the build (ms), see critical_path.set_priorities
+            self.critical_path = None
             self.ignore_broken_dependencies = kwargs.get('ignore_broken_dependencies', False)
             self.refcount = 0
             self.stable_dir_outputs = kwargs.get('stable_dir_outputs', False)
@@ -296,6 +323,9 @@ def _run(ctx, app_ctx, callback, exit_stack, output_replacements=None):
         def prio(self):
             return self.priority or 0
 
+        def sched_prio(self):
+            return self.max_dist if self.critical_path is None else self.critical_path
+
         def __str__(self):
             lim = 6
             if len(self.outputs) < lim:
@@ -396,6 +426,15 @@ def _run(ctx, app_ctx, callback, exit_stack, output_replacements=None):
     build_errors = {}
     execution_log = {}
 
+    duration_history = None
+    if getattr(opts, 'critical_path_priority', False) and not opts.use_distbuild:
+        try:
+            duration_history = critical_path.DurationHistory(
+                os.path.join(core.config.misc_root(), 'runner', 'durations')
+            )
+        except (IOError, OSError) as e:
+            logger.debug('Cannot open history of node durations: %s', e)
+
     class TaskContext(object):
         def __init__(self):
             self.task_cache = task_cache.TaskCache(runq)
@@ -408,6 +447,10 @@ def _run(ctx, app_ctx, callback, exit_stack, output_replacements=None):
             self.state = state
             self.results = results
             self.fetchers_storage = fetchers_storage
+            self.tiered_cache = tiered_cache
+            self.duration_estimator = None
+            if getattr(opts, 'critical_path_priority', False):
+                self.duration_estimator = critical_path.DurationEstimator(duration_history)
 
             if not opts.use_distbuild:
                 import yalibrary.runner.tasks.run
@@ -424,6 +467,13 @@ def _run(ctx, app_ctx, callback, exit_stack, output_replacements=None):
                 else:
                     self.executor_type = yalibrary.runner.tasks.run.PopenExecutor
 
+                # Strict inputs give every node its own source root, workers wouldn't be reused
+                if getattr(opts, 'script_workers', False) and not opts.strict_inputs and script_workers.supported():
+                    pool = exit_stack.enter_context(script_workers.ScriptWorkerPool())
+                    self.executor_type = functools.partial(
+                        yalibrary.runner.tasks.run.ScriptWorkerExecutor, pool, self.executor_type
+                    )
+
             import yalibrary.runner.tasks.cache
 
             self.compact_cache_task = yalibrary.runner.tasks.cache.CompactCacheTask(cache, state, opts, execution_log)
@@ -547,7 +597,13 @@ def _run(ctx, app_ctx, callback, exit_stack, output_replacements=None):
             import yalibrary.runner.tasks.dist_cache
 
             return yalibrary.runner.tasks.dist_cache.PutInDistCacheTask(
-                node, build_root, dist_cache, opts.yt_store_codec, fmt_node, execution_log
+                node,
+                build_root,
+                tiered_cache,
+                opts.yt_store_codec,
+                fmt_node,
+                execution_log,
+                report=lambda task: self.runq.add(task, deps=[]),
             )
 
         def restore_from_cache(self, node):
@@ -557,8 +613,6 @@ def _run(ctx, app_ctx, callback, exit_stack, output_replacements=None):
                 node,
                 build_root_set.new(node.outputs, node.refcount, node.dir_outputs, compute_hash=node.hashable),
                 self,
-                cache,
-                dist_cache,
                 execution_log,
             )
 
@@ -577,7 +631,7 @@ def _run(ctx, app_ctx, callback, exit_stack, output_replacements=None):
         def write_through_caches(self, node, build_root):
             import yalibrary.runner.tasks.cache
 
-            return yalibrary.runner.tasks.cache.WriteThroughCachesTask(node, self, cache, dist_cache, build_root)
+            return yalibrary.runner.tasks.cache.WriteThroughCachesTask(node, self, build_root)
 
         def clear_uid(self, uid):
             cache.clear_uid(uid)
@@ -696,6 +750,9 @@ def _run(ctx, app_ctx, callback, exit_stack, output_replacements=None):
         else:
             process_queue()
 
+        # Build roots of deferred uploads must survive till they are done, nothing is reported by the uploads after it
+        tiered_cache.flush(getattr(opts, 'dist_store_flush_timeout', 0))
+
         runq.add(task_context.clean_build_task, deps=[])
         process_queue()
 
@@ -704,16 +761,23 @@ def _run(ctx, app_ctx, callback, exit_stack, output_replacements=None):
         pass
     finally:
         exit_stack.pop_all().close()
+        tiered_cache.drop_prefetched()
 
         if hasattr(cache, 'stats'):
             cache.stats(execution_log)
 
+        tiered_cache.stats(execution_log)
+
         if dist_cache and hasattr(dist_cache, 'stats'):
             dist_cache_evlog_writer = app_ctx.evlog.get_writer('yt_store') if getattr(app_ctx, 'evlog', None) else None
             dist_cache.stats(execution_log, dist_cache_evlog_writer)
 
     wall_time = time.time() - start_time
 
+    if duration_history:
+        critical_path.record_durations(duration_history, nodes, execution_log)
+        duration_history.close()
+
     if not opts.use_distbuild:
         for node in nodes:
             if node.uid not in execution_log:
@@ -0,0 +1,451 @@
+"""
+Persistent python workers for build scripts.
+
+Small build/scripts helpers run in huge numbers and spend most of their time in the interpreter startup and imports.
+A worker is a warm interpreter which imports top level imports of a script once and then runs the script
+as __main__ in a forked child for every command, with the command's argv, environment, cwd and output files.
+"""
+
+import collections
+import json
+import logging
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Scripts with a __main__ guard which neither replace std streams nor rely on being the only thing in the process
+SCRIPTS = frozenset(
+    [
+        'append_file.py',
+        'cat.py',
+        'configure_file.py',
+        'copy_files_to_dir.py',
+        'copy_to_dir.py',
+        'fs_tools.py',
+        'gen_py3_reg.py',
+        'gen_py_reg.py',
+        'gen_tasklet_reg.py',
+        'link_exe.py',
+        'mkver.py',
+        'move.py',
+        'rodata2asm.py',
+        'rodata2cpp.py',
+        'symlink.py',
+        'tar_directory.py',
+        'touch.py',
+        'writer.py',
+        'yield_line.py',
+    ]
+)
+
+# Variables which affect the interpreter startup, workers are not shared between different values of them
+_INTERPRETER_ENV = ('LANG', 'LANGUAGE', 'LC_ALL', 'LC_CTYPE')
+
+_HEADER = struct.Struct('<I')
+
+# Runs in the worker interpreter, so it must support both python 2 and 3 and use the standard library only.
+# The protocol goes through the original stdin and stdout, fds 0-2 are given to the scripts.
+WORKER_SOURCE = r'''
+import ast
+import json
+import os
+import runpy
+import struct
+import sys
+import traceback
+
+HEADER = struct.Struct('<I')
+
+
+def read_message(afile):
+    header = afile.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    return json.loads(afile.read(HEADER.unpack(header)[0]).decode('utf-8'))
+
+
+def write_message(afile, message):
+    data = json.dumps(message).encode('utf-8')
+    afile.write(HEADER.pack(len(data)) + data)
+    afile.flush()
+
+
+def warm_up(path):
+    try:
+        with open(path, 'rb') as afile:
+            tree = ast.parse(afile.read(), path)
+        tree.body = [node for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom))]
+        exec(compile(tree, path, 'exec'), {'__name__': '__ya_script_worker__'})
+    except BaseException:
+        pass
+
+
+def exit_code(code):
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    try:
+        sys.stderr.write('{}\n'.format(code))
+    except Exception:
+        pass
+    return 1
+
+
+def run_script(path):
+    try:
+        runpy.run_path(path, run_name='__main__')
+        code = 0
+    except SystemExit as e:
+        code = exit_code(e.code)
+    except BaseException:
+        etype, value, tb = sys.exc_info()
+        # Skip runpy frames, the traceback must look like the one of the script run by the interpreter
+        while tb is not None and tb.tb_frame.f_code.co_filename != path:
+            tb = tb.tb_next
+        traceback.print_exception(etype, value, tb)
+        code = 1
+
+    try:
+        if hasattr(sys, 'exitfunc'):
+            sys.exitfunc()
+        else:
+            import atexit
+
+            atexit._run_exitfuncs()
+    except BaseException:
+        pass
+    for stream in (sys.stdout, sys.stderr):
+        try:
+            stream.flush()
+        except Exception:
+            pass
+    return code
+
+
+def run_child(request):
+    code = 1
+    try:
+        for fd, path in ((1, request['stdout']), (2, request['stderr'])):
+            out = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 438)
+            os.dup2(out, fd)
+            os.close(out)
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update(request['env'])
+        if 'tempfile' in sys.modules:
+            sys.modules['tempfile'].tempdir = None
+        if request.get('nice'):
+            try:
+                os.nice(request['nice'])
+            except OSError:
+                pass
+        sys.argv = list(request['argv'])
+        code = run_script(sys.argv[0])
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        os._exit(code & 0xFF)
+
+
+def main():
+    sys.path[0] = sys.argv[1]
+    requests = os.fdopen(os.dup(0), 'rb')
+    responses = os.fdopen(os.dup(1), 'wb')
+    null = os.open(os.devnull, os.O_RDWR)
+    os.dup2(null, 0)
+    os.dup2(null, 1)
+    os.close(null)
+
+    warmed = set()
+    while True:
+        request = read_message(requests)
+        if request is None:
+            return
+        script = request['argv'][0]
+        if script not in warmed:
+            warmed.add(script)
+            warm_up(script)
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            requests.close()
+            responses.close()
+            run_child(request)
+        write_message(responses, {'pid': pid})
+        _, status = os.waitpid(pid, 0)
+        code = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        write_message(responses, {'exit_code': code})
+
+
+main()
+'''
+
+
+class WorkerError(Exception):
+    """The worker failed before the command is started, so it's safe to run the command in another way"""
+
+
+def supported():
+    return hasattr(os, 'fork')
+
+
+def _read_exactly(afile, size):
+    data = afile.read(size)
+    if len(data) != size:
+        raise IOError('script worker has exited')
+    return data
+
+
+class ScriptWorker(object):
+    def __init__(self, python, scripts_dir, env):
+        with open(os.devnull, 'wb') as devnull:
+            self._proc = subprocess.Popen(
+                [python, '-c', WORKER_SOURCE, scripts_dir],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=devnull,
+                cwd=scripts_dir,
+                env=env,
+                close_fds=True,
+            )
+
+    def _send(self, message):
+        data = json.dumps(message).encode('utf-8')
+        self._proc.stdin.write(_HEADER.pack(len(data)) + data)
+        self._proc.stdin.flush()
+
+    def _receive(self):
+        size = _HEADER.unpack(_read_exactly(self._proc.stdout, _HEADER.size))[0]
+        return json.loads(_read_exactly(self._proc.stdout, size).decode('utf-8'))
+
+    def run(self, request, on_start=None):
+        try:
+            self._send(request)
+            pid = self._receive()['pid']
+        except (IOError, OSError, ValueError) as e:
+            raise WorkerError(str(e))
+        if on_start:
+            on_start(pid)
+        return self._receive()['exit_code']
+
+    def alive(self):
+        return self._proc.poll() is None
+
+    def close(self, timeout=5):
+        try:
+            self._proc.stdin.close()
+        except (IOError, OSError):
+            pass
+        # python 2 Popen.wait has no timeout
+        timer = threading.Timer(timeout, self.kill)
+        timer.start()
+        try:
+            self._proc.wait()
+        finally:
+            timer.cancel()
+        self._proc.stdout.close()
+
+    def kill(self):
+        try:
+            self._proc.kill()
+        except OSError:
+            pass
+
+
+class ScriptWorkerPool(object):
+    """
+    Workers by interpreter, scripts directory and interpreter startup environment.
+    A worker runs one command at a time, so there are as many workers of a kind as concurrently running commands.
+    """
+
+    def __init__(self, scripts=SCRIPTS):
+        self._scripts = frozenset(scripts)
+        self._idle = collections.defaultdict(list)
+        self._workers = []
+        self._lock = threading.Lock()
+        self._closed = False
+        self._tmp_dir = tempfile.mkdtemp(prefix='script_workers')
+        self._stats = {'runs': 0, 'workers': 0, 'failures': 0}
+
+    def accepts(self, args, cwd):
+        return (
+            not self._closed
+            and len(args) >= 2
+            and os.path.basename(args[0]).startswith('python')
+            and os.path.basename(args[1]) in self._scripts
+            and os.path.isabs(args[1])
+            and os.path.isfile(args[1])
+            and os.path.isdir(cwd)
+        )
+
+    def _key(self, args, env):
+        return (
+            args[0],
+            os.path.dirname(os.path.realpath(args[1])),
+            tuple(sorted((k, v) for k, v in env.items() if k.startswith('PYTHON') or k in _INTERPRETER_ENV)),
+        )
+
+    def _acquire(self, key, env):
+        with self._lock:
+            if self._idle[key]:
+                return self._idle[key].pop()
+        worker = ScriptWorker(key[0], key[1], env)
+        with self._lock:
+            self._workers.append(worker)
+            self._stats['workers'] += 1
+        return worker
+
+    def _release(self, key, worker):
+        with self._lock:
+            if not self._closed and worker.alive():
+                self._idle[key].append(worker)
+                return
+        worker.close()
+
+    def run(self, args, env, cwd, stdout_path, nice=None, on_start=None):
+        """
+        Runs the script command, returns (exit code, stderr bytes).
+        Raises WorkerError if the command is not started.
+        """
+        key = self._key(args, env)
+        fd, stderr_path = tempfile.mkstemp(dir=self._tmp_dir)
+        os.close(fd)
+        worker = self._acquire(key, env)
+        try:
+            request = {
+                'argv': list(args[1:]),
+                'env': dict(env),
+                'cwd': cwd,
+                'stdout': stdout_path,
+                'stderr': stderr_path,
+                'nice': nice,
+            }
+            try:
+                exit_code = worker.run(request, on_start)
+            except Exception:
+                with self._lock:
+                    self._stats['failures'] += 1
+                worker.kill()
+                raise
+            with open(stderr_path, 'rb') as afile:
+                stderr = afile.read()
+        finally:
+            self._release(key, worker)
+            os.remove(stderr_path)
+
+        with self._lock:
+            self._stats['runs'] += 1
+        return exit_code, stderr
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            workers, self._workers = self._workers, []
+            self._idle.clear()
+        for worker in workers:
+            worker.close()
+        shutil.rmtree(self._tmp_dir, ignore_errors=True)
+        logger.debug('Script workers are closed: %s', self._stats)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_details):
+        self.close()
+        return False
+
+
+if __name__ == '__main__':
+    import concurrent.futures
+    import sys
+    import time
+
+    # Synthetic graph: layers of script nodes, every node reads the output of the one above it
+    layers = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    width = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    threads = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+
+    script = '\n'.join(
+        [
+            'import argparse, json, optparse, shutil, subprocess, tarfile, tempfile, textwrap',
+            'import sys',
+            'def main():',
+            '    src, dst, n = sys.argv[1], sys.argv[2], int(sys.argv[3])',
+            '    data = open(src).read() if src != "-" else ""',
+            '    open(dst, "w").write(data + str(n) + "\\n")',
+            '    print("node", n)',
+            '    sys.stderr.write("##status##node {}\\n".format(n))',
+            '    if n % 97 == 13:',
+            '        raise ValueError(n)',
+            '    if n % 31 == 5:',
+            '        sys.exit(n % 7)',
+            'if __name__ == "__main__":',
+            '    main()',
+        ]
+    )
+
+    def run_cold(args, env, cwd, stdout_path):
+        with open(stdout_path, 'w') as stdout:
+            proc = subprocess.Popen(args, stdout=stdout, stderr=subprocess.PIPE, env=env, cwd=cwd)
+            _, stderr = proc.communicate()
+        return proc.returncode, stderr
+
+    def run_graph(root, run):
+        results = {}
+        with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+            for layer in range(layers):
+                futures = {}
+                for i in range(width):
+                    n = layer * width + i
+                    src = os.path.join(root, 'out-{}-{}'.format(layer - 1, i)) if layer else '-'
+                    dst = os.path.join(root, 'out-{}-{}'.format(layer, i))
+                    args = [sys.executable, script_path, src, dst, str(n)]
+                    futures[n] = executor.submit(run, args, dict(os.environ), root, dst + '.stdout')
+                for n, future in futures.items():
+                    exit_code, stderr = future.result()
+                    results[n] = exit_code, stderr.replace(root.encode(), b'$ROOT')
+        outputs = {}
+        for name in os.listdir(root):
+            with open(os.path.join(root, name), 'rb') as afile:
+                outputs[name] = afile.read()
+        return results, outputs
+
+    base = tempfile.mkdtemp()
+    try:
+        script_path = os.path.join(base, 'bench_script.py')
+        with open(script_path, 'w') as afile:
+            afile.write(script)
+        nodes = layers * width
+
+        root = os.path.join(base, 'cold')
+        os.mkdir(root)
+        start = time.time()
+        cold = run_graph(root, run_cold)
+        cold_time = time.time() - start
+
+        root = os.path.join(base, 'warm')
+        os.mkdir(root)
+        with ScriptWorkerPool(scripts=['bench_script.py']) as pool:
+            start = time.time()
+            warm = run_graph(root, pool.run)
+            warm_time = time.time() - start
+            stats = pool.stats()
+
+        print('nodes: {}, threads: {}, workers: {}'.format(nodes, threads, stats['workers']))
+        print('cold per node (ms): {:.2f}'.format(1000.0 * cold_time / nodes))
+        print('warm per node (ms): {:.2f}'.format(1000.0 * warm_time / nodes))
+        print('identical results: {}'.format(cold == warm))
+    finally:
+        shutil.rmtree(base)
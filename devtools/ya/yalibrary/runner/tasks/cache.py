@@ -182,6 +182,8 @@ class PutInCacheTask(object):
                 self._cache.put(self._node.content_uid, self._build_root.path, file_list, codec)
             if hasattr(self._cache, 'put_dependencies'):
                 self._cache.put_dependencies(self._node.uid, self._node.deps)
+            if hasattr(self._cache, 'put_rebuild_cost'):
+                self._put_rebuild_cost()
         finally:
             self._build_root.dec()
         self._execution_log[str(self)] = {
@@ -190,6 +192,16 @@ class PutInCacheTask(object):
             'type': 'put into local cache, clean build dir',
         }
 
+    def _put_rebuild_cost(self):
+        # Nodes restored from the dist cache have no timing
+        timing = self._execution_log.get(self._node.uid, {}).get('timing')
+        if not timing:
+            return
+        cost = timing[1] - timing[0]
+        self._cache.put_rebuild_cost(self._node.uid, cost)
+        if self._node.content_uid is not None:
+            self._cache.put_rebuild_cost(self._node.content_uid, cost)
+
     def __str__(self):
         return 'PutInCache({})'.format(self._node.uid)
 
@@ -197,7 +209,7 @@ class PutInCacheTask(object):
         return worker_threads.ResInfo(io=1)
 
     def prio(self):
-        return self._node.max_dist
+        return self._node.sched_prio()
 
     def short_name(self):
         return 'put_in_cache[{}]'.format(self._node.kv.get('p', '??'))
@@ -209,12 +221,10 @@ class PutInCacheTask(object):
 class RestoreFromCacheTask(object):
     node_type = 'RestoreFromCache'
 
-    def __init__(self, node, build_root, ctx, cache, dist_cache, execution_log):
+    def __init__(self, node, build_root, ctx, execution_log):
         self._node = node
         self._build_root = build_root
         self._ctx = ctx
-        self._cache = cache
-        self._dist_cache = dist_cache
         self._execution_log = execution_log
 
     @property
@@ -226,18 +236,34 @@ class RestoreFromCacheTask(object):
         return self._node.uid
 
     def should_put_in_dist_cache(self):
-        return (
-            self._dist_cache
-            and not self._dist_cache.readonly()
-            and self._dist_cache.fits(self._node)
-            and not self._dist_cache.has(self._node.uid)
-        )
+        return self._ctx.tiered_cache.remote_writable(self._node)
+
+    def _fill_local_cache(self):
+        if self._ctx.tiered_cache.should_fill_local():
+            self._build_root.inc()
+            if self._ctx.opts.dir_outputs_test_mode and self._node.dir_outputs:
+                self._build_root.extract_dir_outputs()
+            self._ctx.runq.add(
+                self._ctx.put_in_cache(self._node, self._build_root),
+                deps=[],
+                inplace_execution=self._ctx.opts.eager_execution,
+            )
 
     def __call__(self, *args, **kwargs):
         start_time = time.time()
         self._build_root.create()
 
-        if self._cache.try_restore(self._node.uid, self._build_root.path):
+        tiered_cache = self._ctx.tiered_cache
+        # Results with links to the dist cache are restored by RestoreFromDistCacheTask only
+        tier = tiered_cache.try_restore(self._node, self._build_root.path, allow_remote=not self._ctx.save_links_regex)
+        if tier == tiered_cache.REMOTE:
+            if self._ctx.content_uids:
+                self._node.output_digests = self._build_root.read_output_digests(write_if_absent=True)
+            self._build_root.validate()
+            self._fill_local_cache()
+
+            self._ctx.eager_result(self)
+        elif tier == tiered_cache.LOCAL:
             if self._ctx.opts.dir_outputs_test_mode and self._ctx.opts.runner_dir_outputs:
                 self._build_root.propagate_dir_outputs()
             self._build_root.validate()
@@ -266,7 +292,7 @@ class RestoreFromCacheTask(object):
         return 'FromCache({})'.format(str(self._node))
 
     def prio(self):
-        return self._node.max_dist
+        return self._node.sched_prio()
 
     def res(self):
         return worker_threads.ResInfo(cpu=1)
@@ -278,15 +304,13 @@ class RestoreFromCacheTask(object):
 class WriteThroughCachesTask(object):
     node_type = 'WriteThroughCaches'
 
-    def __init__(self, node, ctx, cache, dist_cache, build_root):
+    def __init__(self, node, ctx, build_root):
         self._node = node
         self._ctx = ctx
-        self._cache = cache
-        self._dist_cache = dist_cache
         self._build_root = build_root
 
     def __call__(self, *args, **kwargs):
-        if self._ctx.opts.yt_store_wt or not self._dist_cache or self._dist_cache.readonly():
+        if self._ctx.tiered_cache.should_fill_local():
             self._ctx.runq.add(
                 self._ctx.put_in_cache(self._node, self._build_root),
                 deps=[],
@@ -295,12 +319,7 @@ class WriteThroughCachesTask(object):
         else:
             self._build_root.dec()
 
-        if (
-            self._dist_cache
-            and not self._dist_cache.readonly()
-            and self._dist_cache.fits(self._node)
-            and not self._dist_cache.has(self._node.uid)
-        ):
+        if self._ctx.tiered_cache.remote_writable(self._node):
             self._ctx.runq.add(
                 self._ctx.put_in_dist_cache(self._node, self._build_root),
                 deps=[],
@@ -316,7 +335,7 @@ class WriteThroughCachesTask(object):
         return worker_threads.ResInfo()
 
     def prio(self):
-        return self._node.max_dist
+        return self._node.sched_prio()
 
     def short_name(self):
         return 'write_through_caches[{}]'.format(self._node.kv.get('p', '??'))
@@ -12,23 +12,35 @@ def get_link_filename(filename):
 class PutInDistCacheTask(object):
     node_type = 'PutInDistCache'
 
-    def __init__(self, node, build_root, dist_cache, dist_cache_codec, fmt_node, execution_log):
+    def __init__(self, node, build_root, tiered_cache, dist_cache_codec, fmt_node, execution_log, report=None):
         self._node = node
         self._build_root = build_root
-        self._dist_cache = dist_cache
+        self._tiered_cache = tiered_cache
+        self._dist_cache = tiered_cache.remote
         self._dist_cache_codec = dist_cache_codec
         self._fmt_node = fmt_node
         self._ok = True
         self._skipped = False
+        # With write-behind the upload is finished after the task, its outcome is reported by a separate task
+        self._deferred = tiered_cache.write_behind is not None
+        self._report = report
         self._execution_log = execution_log
 
     def __call__(self, *args, **kwargs):
         start_time = time.time()
+        self._tiered_cache.put_remote(
+            self._node.uid,
+            self._build_root.path,
+            self._build_root.output,
+            codec=self._dist_cache_codec,
+            on_done=lambda status: self._on_done(status, start_time),
+        )
+
+    def _on_done(self, status, start_time):
         try:
-            status = self._dist_cache.put(
-                self._node.uid, self._build_root.path, list(self._build_root.output), codec=self._dist_cache_codec
-            )
-            if status.skipped:
+            if status is None:
+                self._ok = False
+            elif status.skipped:
                 self._skipped = True
             else:
                 self._ok = status.ok
@@ -39,28 +51,62 @@ class PutInDistCacheTask(object):
             'prepare': '',
             'type': 'put to dist cache',
         }
+        if self._deferred and self._report:
+            self._report(DistCacheUploadResultTask(self))
 
     def __str__(self):
         return 'PutInDistCache({})'.format(self._node.uid)
 
     def res(self):
+        if self._deferred:
+            # The task only queues the upload, uploads are bounded by the write-behind threads
+            return worker_threads.ResInfo()
         return worker_threads.ResInfo(upload=1)
 
     def prio(self):
-        return self._node.max_dist
+        return self._node.sched_prio()
 
     def short_name(self):
         return 'put_in_dist_cache[{}]'.format(self._node.kv.get('p', '??'))
 
-    def status(self):
+    def status(self, queued=None):
+        if queued is None:
+            queued = self._deferred
         tags = ['[[c:yellow]]{}_UPLOAD[[rst]]'.format(self._dist_cache.tag())]
-        if self._skipped:
+        if queued:
+            tags.append('[[unimp]]QUEUED[[rst]]')
+        elif self._skipped:
             tags.append('[[unimp]]SKIPPED[[rst]]')
         elif not self._ok:
             tags.append('[[bad]]FAILED[[rst]]')
         return self._fmt_node(self._node, tags)
 
 
+class DistCacheUploadResultTask(object):
+    node_type = 'DistCacheUploadResult'
+
+    def __init__(self, put_task):
+        self._put_task = put_task
+
+    def __call__(self, *args, **kwargs):
+        pass
+
+    def __str__(self):
+        return 'DistCacheUploadResult({})'.format(self._put_task._node.uid)
+
+    def res(self):
+        return worker_threads.ResInfo()
+
+    def prio(self):
+        return self._put_task.prio()
+
+    def short_name(self):
+        return 'dist_cache_upload_result[{}]'.format(self._put_task._node.kv.get('p', '??'))
+
+    def status(self):
+        return self._put_task.status(queued=False)
+
+
 class RestoreFromDistCacheTask(object):
     node_type = 'RestoreFromDistCache'
 
@@ -128,7 +174,7 @@ class RestoreFromDistCacheTask(object):
 
             self._build_root.validate()
             # if _dist_cache is not read-only, i.e. we are heating it, then do not pollute local cache
-            if self._ctx.opts.yt_store_wt or self._dist_cache.readonly():
+            if self._ctx.tiered_cache.should_fill_local():
                 self._build_root.inc()
                 if self._ctx.opts.dir_outputs_test_mode and self._node.dir_outputs:
                     self._build_root.extract_dir_outputs()
@@ -155,7 +201,7 @@ class RestoreFromDistCacheTask(object):
         return 'FromDistCache({})'.format(str(self._node))
 
     def prio(self):
-        return self._node.max_dist
+        return self._node.sched_prio()
 
     def res(self):
         return worker_threads.ResInfo(download=1)
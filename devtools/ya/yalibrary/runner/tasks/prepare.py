@@ -1,10 +1,10 @@
 import sys
 import logging
-import six.moves.queue as queue
 
 import core.error
 import exts.uniq_id
 import yalibrary.worker_threads as worker_threads
+from yalibrary.runner import critical_path
 from yalibrary.runner import topo
 
 from .resource import PrepareResource
@@ -35,17 +35,25 @@ class PrepareAllNodesTask(UniqueTask):
     def exit_code(self):
         return self._exit_code
 
+    def _probe_caches(self, nodes):
+        """
+        Resolves cache hits for the nodes of one BFS frontier at once.
+        Returns (local hits, dist hits), None stands for a cache without bulk probing support.
+        """
+        if self._ctx.opts.clear_build:
+            return set(), set()
+
+        return self._ctx.tiered_cache.probe(nodes, getattr(self._ctx.opts, 'dist_store_threads', None))
+
     def __call__(self, *args, **kwargs):
         self._ctx.signal_ready()
 
-        q = queue.Queue()
         tp = topo.Topo()
 
         touch_mode = not self._ctx.opts.clear_build and self._ctx.opts.strip_cache and hasattr(self._cache, 'compact')
         results = []
         for node in self._nodes:
             if node.is_result_node():
-                q.put(node)
                 tp.add_node(node)
                 results.append(node)
                 node.refcount += 1
@@ -54,54 +62,80 @@ class PrepareAllNodesTask(UniqueTask):
                 # touch node.uid for aggressive compaction
                 self._cache.has(node.uid)
 
-        while not q.empty():
-            node = q.get()
-
-            for x in node.dep_nodes():
-                x.max_dist = max(x.max_dist, node.max_dist + 1)
-
-            cacheable = not self._ctx.opts.clear_build and node.cacheable
-            local_cache_task = cacheable and self._cache.has(node.uid)
-            dist_cache_task = False
-            if cacheable and not local_cache_task and self._dist_cache and self._dist_cache.fits(node):
-                if self._dist_cache.has(node.uid):
-                    dist_cache_task = True
-                elif self._ctx.opts.yt_store_exclusive:
-                    logger.error("Failed to find {!s} in the distributed cache".format(node))
-                    self._exit_code = core.error.ExitCodes.YT_STORE_FETCH_ERROR
-                    self._ctx.fast_fail(fatal=True)
-                    return
-
-            if local_cache_task:
-                self._ctx.task_cache(node, self._ctx.restore_from_cache)
-                tp.schedule_node(node, when_ready=tp.notify_dependants)
-
-            elif dist_cache_task:
-                self._ctx.task_cache(node, self._ctx.restore_from_dist_cache)
-                tp.schedule_node(node, when_ready=tp.notify_dependants)
-
-            else:
+        estimator = getattr(self._ctx, 'duration_estimator', None)
+        if estimator is not None:
+            # Hits are not known before the walk, nodes are estimated as if all of them run
+            critical_path.set_priorities(self._nodes, estimator)
+
+        def add_run_node(node, *args, **kwargs):
+            deps = (
+                [self._ctx.task_cache(x) for x in node.dep_nodes()]
+                + [self._ctx.pattern_cache(x) for x in node.unresolved_patterns()]
+                + [
+                    self._ctx.resource_cache(tuple(sorted(x.items())), deps=PrepareResource.dep_resources(self._ctx, x))
+                    for x in node.resources
+                ]
+            )
+            self._ctx.task_cache(node, self._ctx.run_node, deps=deps)
+            tp.notify_dependants(node)
+
+        # Nodes are visited level by level, so only the nodes the build reaches are probed.
+        # Each level is scheduled as soon as it's probed, so restores and leaves start while the walk goes on.
+        visited = []
+        hits = set()
+        frontier = results
+        while frontier:
+            local_hits, dist_hits = self._probe_caches(frontier)
+            next_frontier = []
+
+            for node in frontier:
+                visited.append(node)
+
                 for x in node.dep_nodes():
-                    if x not in tp:
-                        q.put(x)
-                        tp.add_node(x)
-                    tp.add_deps(node, x)
-
-                def add_run_node(node, *args, **kwargs):
-                    deps = (
-                        [self._ctx.task_cache(x) for x in node.dep_nodes()]
-                        + [self._ctx.pattern_cache(x) for x in node.unresolved_patterns()]
-                        + [
-                            self._ctx.resource_cache(
-                                tuple(sorted(x.items())), deps=PrepareResource.dep_resources(self._ctx, x)
-                            )
-                            for x in node.resources
-                        ]
-                    )
-                    self._ctx.task_cache(node, self._ctx.run_node, deps=deps)
-                    tp.notify_dependants(node)
-
-                tp.schedule_node(node, when_ready=add_run_node)
+                    x.max_dist = max(x.max_dist, node.max_dist + 1)
+
+                cacheable = not self._ctx.opts.clear_build and node.cacheable
+                if local_hits is not None:
+                    local_cache_task = cacheable and node.uid in local_hits
+                else:
+                    local_cache_task = cacheable and self._cache.has(node.uid)
+                dist_cache_task = False
+                if cacheable and not local_cache_task and self._dist_cache and self._dist_cache.fits(node):
+                    if dist_hits is not None:
+                        found_in_dist_cache = node.uid in dist_hits
+                    else:
+                        found_in_dist_cache = self._dist_cache.has(node.uid)
+                    if found_in_dist_cache:
+                        dist_cache_task = True
+                    elif self._ctx.opts.yt_store_exclusive:
+                        logger.error("Failed to find {!s} in the distributed cache".format(node))
+                        self._exit_code = core.error.ExitCodes.YT_STORE_FETCH_ERROR
+                        self._ctx.fast_fail(fatal=True)
+                        return
+                if local_cache_task:
+                    hits.add(node.uid)
+                    self._ctx.task_cache(node, self._ctx.restore_from_cache)
+                    tp.schedule_node(node, when_ready=tp.notify_dependants)
+
+                elif dist_cache_task:
+                    hits.add(node.uid)
+                    self._ctx.task_cache(node, self._ctx.restore_from_dist_cache)
+                    tp.schedule_node(node, when_ready=tp.notify_dependants)
+
+                else:
+                    for x in node.dep_nodes():
+                        if x not in tp:
+                            next_frontier.append(x)
+                            tp.add_node(x)
+                        tp.add_deps(node, x)
+
+                    tp.schedule_node(node, when_ready=add_run_node)
+
+            frontier = next_frontier
+
+        if estimator is not None:
+            # Nodes waiting for their deps are dispatched later, they get the estimate knowing the hits
+            critical_path.set_priorities(visited, estimator, hits)
 
         # Sanity check
         unscheduled = tp.get_unscheduled()
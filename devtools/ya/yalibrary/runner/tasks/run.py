@@ -2,6 +2,7 @@ import errno
 import logging
 import math
 import os
+import signal
 import subprocess
 import threading
 import time
@@ -22,6 +23,7 @@ import exts.shlex2
 
 import yalibrary.runner
 from yalibrary import formatter
+from yalibrary.runner import script_workers
 import yalibrary.worker_threads as worker_threads
 from exts.fs import create_dirs, ensure_removed, hardlink_tree, remove_tree_with_perm_update
 from yalibrary.runner.build_root import BuildRootError
@@ -140,6 +142,19 @@ class ExecutorBase(object):
     def run(self, **kwargs):
         raise NotImplementedError()
 
+    def _process_stderr_line(self, line):
+        """Handles special tags, returns the rest of stderr"""
+        if line.startswith(self.status_prefix):
+            status = line[self.status_prefix_len :].rstrip(os.linesep)
+            self._set_status_func(status)
+        elif line.startswith(self.append_prefix):
+            self._append_tag_func(line[self.append_prefix_len :].strip())
+        elif line.startswith(self.prefix):
+            self._display_func(line[self.prefix_len :].replace("|n", "\n"))
+        else:
+            return line
+        return ''
+
 
 class PopenExecutor(ExecutorBase):
     def run(self, **kwargs):
@@ -201,15 +216,7 @@ class PopenExecutor(ExecutorBase):
                         if not line:
                             queue = None
 
-                        if line.startswith(self.status_prefix):
-                            status = line[self.status_prefix_len :].rstrip(os.linesep)
-                            self._set_status_func(status)
-                        elif line.startswith(self.append_prefix):
-                            self._append_tag_func(line[self.append_prefix_len :].strip())
-                        elif line.startswith(self.prefix):
-                            self._display_func(line[self.prefix_len :].replace("|n", "\n"))
-                        else:
-                            stderr += line
+                        stderr += self._process_stderr_line(line)
                     except Queue.Empty:
                         pass
                 elif proc.poll() is not None:
@@ -249,20 +256,52 @@ class LocalExecutor(ExecutorBase):
                 executor_address, args, stdout.name, cwd, env, requirements=requirements, **nice_arg
             ) as res:
                 for line in res.iter_stderr():
-                    if line.startswith(self.status_prefix):
-                        status = line[self.status_prefix_len :].rstrip(os.linesep)
-                        self._set_status_func(status)
-                    elif line.startswith(self.append_prefix):
-                        self._append_tag_func(line[self.append_prefix_len :].strip())
-                    elif line.startswith(self.prefix):
-                        self._display_func(line[self.prefix_len :].replace("|n", "\n"))
-                    else:
-                        stderr += line
+                    stderr += self._process_stderr_line(line)
                 return stderr, res.returncode
         except executor.ShutdownException:
             return stderr, 1
 
 
+class ScriptWorkerExecutor(ExecutorBase):
+    """Runs whitelisted build scripts in warm python workers and other commands by the fallback executor"""
+
+    def __init__(self, pool, fallback_type, state, display_func, set_status_func, append_tag_func):
+        super(ScriptWorkerExecutor, self).__init__(state, display_func, set_status_func, append_tag_func)
+        self._pool = pool
+        self._fallback = fallback_type(state, display_func, set_status_func, append_tag_func)
+
+    def run(self, **kwargs):
+        # Requirements (e.g. network isolation) are up to the executor
+        if not kwargs.get('requirements') and self._pool.accepts(kwargs['args'], kwargs['cwd']):
+            try:
+                return self._run_script(**kwargs)
+            except script_workers.WorkerError as e:
+                logger.debug('Script worker failed, running %s as a process: %s', kwargs['args'], e)
+        return self._fallback.run(**kwargs)
+
+    def _run_script(self, args, stdout, env, cwd, nice, **kwargs):
+        pids = []
+
+        def cancel_cb():
+            for pid in pids:
+                logger.debug('Terminating %s', pid)
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+
+        with self._state.with_finalizer(cancel_cb):
+            exit_code, raw_stderr = self._pool.run(args, env, cwd, stdout.name, nice=nice, on_start=pids.append)
+
+        stderr = ""
+        for line in six.BytesIO(raw_stderr):
+            stderr += self._process_stderr_line(six.ensure_str(line))
+
+        self._state.check_cancel_state()
+
+        return stderr, exit_code
+
+
 class RunNodeTask(object):
     node_type = 'RunNode'
 
@@ -572,6 +611,7 @@ class RunNodeTask(object):
             self._node.output_digests = self._build_root.read_output_digests(write_if_absent=True)
 
         self._execution_log[self._node.uid]['timing'] = timing
+        self._execution_log[self._node.uid]['exit_code'] = self._exit_code
         if self._exit_code and not have_broken:
             self._build_errors[self._node.uid] = self._stderr
 
@@ -602,7 +642,7 @@ class RunNodeTask(object):
         return self._detailed_timings.dump()
 
     def prio(self):
-        return self._node.max_dist
+        return self._node.sched_prio()
 
     def res(self):
         p = self._node.kv.get('p')
@@ -0,0 +1,53 @@
+import os
+
+import pytest
+
+from yalibrary.runner import critical_path
+
+
+class FakeNode(object):
+    def __init__(self, uid):
+        self.uid = uid
+        self.stats_uid = 'stats-' + uid
+
+
+@pytest.fixture
+def history(tmpdir):
+    history = critical_path.DurationHistory(os.path.join(str(tmpdir), 'durations'))
+    yield history
+    history.close()
+
+
+def test_record_durations_of_executed_nodes(history):
+    node = FakeNode('built')
+
+    critical_path.record_durations(history, [node], {node.uid: {'timing': (10.0, 25.0), 'exit_code': 0}})
+
+    assert history.get(node.stats_uid) == 15.0
+
+
+@pytest.mark.parametrize(
+    'info',
+    [
+        {'timing': (10.0, 10.1), 'exit_code': 0, 'dynamically_resolved_cache': True},
+        {'timing': (10.0, 11.0), 'exit_code': 1},
+        {'timing': None, 'exit_code': 1},
+        {'cached': True},
+    ],
+    ids=['restored-by-content-uid', 'failed', 'broken-by-deps', 'cached'],
+)
+def test_record_durations_keeps_history_of_not_executed_nodes(history, info):
+    node = FakeNode('restored')
+    history.set(node.stats_uid, 120.0)
+
+    critical_path.record_durations(history, [node], {node.uid: info})
+
+    assert history.get(node.stats_uid) == 120.0
+
+
+def test_record_durations_skips_unknown_nodes(history):
+    node = FakeNode('missing')
+
+    critical_path.record_durations(history, [node], {})
+
+    assert history.get(node.stats_uid) is None
@@ -6,10 +6,13 @@ import logging
 import os
 import os.path as os_path
 import threading
+import time
 
 from exts import hashing
+from exts.timer import AccumulateTime
 from six.moves.urllib import parse
 from yalibrary.store.dist_store import DistStore
+import exts.asyncthread as core_async
 import exts.func
 import library.python.retry as retry
 import requests
@@ -18,6 +21,11 @@ import requests.auth
 import zstandard as zstd
 
 DOWNLOAD_CHUNK_SIZE = 1 << 15
+UPLOAD_CHUNK_SIZE = 1 << 20
+# Smaller blobs are uploaded as is
+COMPRESS_MIN_SIZE = 1 << 12
+# Concurrent transfers of a single node
+NODE_TRANSFER_THREADS = 8
 META_VERSION = '1'
 SHA256_LENGTH = 64
 
@@ -139,6 +147,20 @@ class StreamWriter:
         return self._inner_writer.get_hexdigest()
 
 
+def iter_compressed(file_path, chunk_size=UPLOAD_CHUNK_SIZE):
+    """Streams zstd compressed file content without reading the whole file"""
+    compressor = zstd.ZstdCompressor().compressobj()
+    with open(file_path, 'rb') as afile:
+        while True:
+            data = afile.read(chunk_size)
+            if not data:
+                break
+            chunk = compressor.compress(data)
+            if chunk:
+                yield chunk
+    yield compressor.flush()
+
+
 class BazelStoreClient(object):
     def __init__(self, base_uri, username=None, password=None, max_connections=48, retry_policy=None):
         self.base_uri = base_uri
@@ -149,6 +171,16 @@ class BazelStoreClient(object):
         if username and password:
             self.session.auth = requests.auth.HTTPBasicAuth(username, password)
         self.retry_policy = retry_policy or DEFAULT_RETRY_POLICY
+        self.max_connections = max_connections
+        # All transfers of the client share the connection pool
+        self._transfer_slots = threading.BoundedSemaphore(max_connections)
+        self.compress_uploads = True
+        # Called with ('put' or 'get', size, duration) for every transferred file
+        self.on_file_transfer = None
+        # Digests which are known to be in CAS: uploaded or probed by this client.
+        # Digests of downloaded metadata are not trusted, CAS blobs are evicted independently of AC entries.
+        self._known_blobs = set()
+        self._known_blobs_lock = threading.Lock()
 
     def _retry_func(self, func, f_args=(), f_kwargs=None, conf=retry.DEFAULT_CONF):
         if f_kwargs is None:
@@ -188,33 +220,94 @@ class BazelStoreClient(object):
     def get_codec(self):
         return "zstd"
 
+    def _report_transfer(self, tag, size, start):
+        if self.on_file_transfer:
+            self.on_file_transfer(tag, size, time.time() - start)
+
+    def _transfer_many(self, func, items):
+        items = list(items)
+        if len(items) < 2:
+            return [func(item) for item in items]
+        return core_async.par_map(func, items, min(NODE_TRANSFER_THREADS, len(items)))
+
     def get_blob(self, hash, file_path):
         cas_url = self._cas_url(hash)
         dirname = os_path.dirname(file_path)
         if not os_path.exists(dirname):
-            os.makedirs(dirname)
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # Files of the same directory are downloaded concurrently
+                if not os_path.isdir(dirname):
+                    raise
         codec = self.get_codec()
         headers = {'Accept-Encoding': codec}
-        digest_got = self._retry_func(
-            self.install_data, f_args=(file_path, cas_url, codec, headers), conf=self.retry_policy.read_conf
-        )
+        start = time.time()
+        with self._transfer_slots:
+            digest_got = self._retry_func(
+                self.install_data, f_args=(file_path, cas_url, codec, headers), conf=self.retry_policy.read_conf
+            )
         if digest_got != hash:
             raise BazelStoreException(
                 'Digest mismatch got: %s expected: %s',
                 digest_got,
                 hash,
             )
-
-    def put_blob(self, file_path):
-        hashstr = hashing.file_hash(file_path, hashlib.sha256())
+        self._report_transfer('get', os.stat(file_path).st_size, start)
+
+    def _add_known_blobs(self, digests):
+        with self._known_blobs_lock:
+            self._known_blobs.update(digests)
+
+    def _head(self, url):
+        response = self._retry_func(self.session.head, f_args=(url,), conf=self.retry_policy.read_conf)
+        return response.status_code == 200
+
+    def _probe_many(self, make_url, keys, threads=None):
+        # HTTP API of bazel-remote has no batch probe (FindMissingBlobs is gRPC only),
+        # so requests are spread over the pooled keep-alive connections
+        keys = list(keys)
+        if not keys:
+            return set()
+        threads = min(threads or self.max_connections, len(keys))
+        found = core_async.par_map(lambda key: self._head(make_url(key)), keys, threads)
+        return set(key for key, res in zip(keys, found) if res)
+
+    def exists_many(self, uids, threads=None):
+        """Returns the set of uids which have AC entries"""
+        return self._probe_many(self._ac_url, uids, threads)
+
+    def missing_blobs(self, digests, threads=None):
+        """Returns the set of digests which are not in CAS"""
+        with self._known_blobs_lock:
+            unknown = set(digests) - self._known_blobs
+        present = self._probe_many(self._cas_url, unknown, threads)
+        self._add_known_blobs(present)
+        return unknown - present
+
+    def put_blob(self, file_path, hashstr=None):
+        if hashstr is None:
+            hashstr = hashing.file_hash(file_path, hashlib.sha256())
         size = os.stat(file_path).st_size
 
         cas_url = self._cas_url(hashstr)
-        if size == 0:
-            response = self.session.put(cas_url, b"")
-        else:
-            with open(file_path, 'rb') as afile:
-                response = self.session.put(cas_url, afile)
+        compress = self.compress_uploads and size >= COMPRESS_MIN_SIZE
+        start = time.time()
+        with self._transfer_slots:
+            if size == 0:
+                response = self.session.put(cas_url, b"")
+            elif compress:
+                headers = {'Content-Encoding': self.get_codec()}
+                response = self.session.put(cas_url, iter_compressed(file_path), headers=headers)
+            else:
+                with open(file_path, 'rb') as afile:
+                    response = self.session.put(cas_url, afile)
+
+        if compress and response.status_code in (400, 415):
+            # The next attempt goes uncompressed
+            logger.debug('Compressed upload is rejected with %d, disabling compression', response.status_code)
+            self.compress_uploads = False
+            raise BazelStoreException('Compressed upload of {} is rejected'.format(file_path))
 
         if response.status_code != 200:
             raise BazelStoreException(
@@ -222,6 +315,8 @@ class BazelStoreClient(object):
                 file_path,
                 response.status_code,
             )
+        self._add_known_blobs((hashstr,))
+        self._report_transfer('put', size, start)
         return hashstr
 
     def put_meta(self, uid, meta):
@@ -241,15 +336,32 @@ class BazelStoreClient(object):
 
     def put_data(self, files, root_dir, uid, name):
         result = {'files': {}, 'name': name}
+        digests = {}
         for file in sorted(files):
             if not file.startswith(root_dir):
                 raise AssertionError('File is outside of rootpath')
+            digests[file] = hashing.file_hash(os_path.abspath(file), hashlib.sha256())
+
+        # Only blobs the server doesn't have are uploaded
+        missing = self.missing_blobs(digests.values())
+        logger.debug('Put %s: %d of %d blobs are missing in CAS', name, len(missing), len(digests))
+
+        to_upload = {}
+        for file in sorted(files):
+            if digests[file] in missing:
+                to_upload.setdefault(digests[file], file)
 
+        def upload(item):
+            digest, file = item
+            self._retry_func(self.put_blob, f_args=(os_path.abspath(file), digest), conf=self.retry_policy.write_conf)
+
+        self._transfer_many(upload, sorted(to_upload.items()))
+
+        for file in sorted(files):
+            digest = digests[file]
             stat = os.stat(file)
             result['files'][os_path.relpath(file, root_dir)] = {
-                'hash': self._retry_func(
-                    self.put_blob, f_args=(os_path.abspath(file),), conf=self.retry_policy.write_conf
-                ),
+                'hash': digest,
                 'executable': os.access(file, os.X_OK),
                 'mode': stat.st_mode,
                 'size': stat.st_size,
@@ -266,18 +378,16 @@ class BazelStoreClient(object):
         if filter_func is None:
             filter_func = always_false
 
+        to_download = []
         for rel_path, file_data in meta['files'].items():
             file_path = os_path.join(root_dir, rel_path)
             if not filter_func(file_path, self._cas_url(file_data['hash'])):
-                self.download_file(file_path, file_data)
+                to_download.append((file_path, file_data))
+        self._transfer_many(lambda item: self.download_file(*item), to_download)
         return meta
 
     def exists(self, uid):
-        ac_url = self._ac_url(uid)
-        response = self._retry_func(self.session.head, f_args=(ac_url,), conf=self.retry_policy.read_conf)
-        if response.status_code == 200:
-            return True
-        return False
+        return self._head(self._ac_url(uid))
 
 
 class BazelStore(DistStore):
@@ -291,8 +401,11 @@ class BazelStore(DistStore):
             max_file_size=kwargs.pop('max_file_size', 0),
         )
         self._client = BazelStoreClient(*args, **kwargs)
+        self._client.on_file_transfer = self._inc_file_transfer
         self._disabled = False
         self._lock = threading.Lock()
+        # uid -> found, filled by has_many
+        self._probed = {}
 
     def _get_data_size(self, meta_info):
         return sum(x.get('size', 0) for x in meta_info['files'].values())
@@ -336,19 +449,50 @@ class BazelStore(DistStore):
         return True
 
     def load_meta(self, uids, heater_mode=False, refresh_on_read=False):
-        # Meta preloading is no required for bazel store
+        # Meta preloading is no required for bazel store, uids are probed when the runner asks about them
         return
 
+    def _probe(self, uids):
+        """Probes AC entries of all uids at once, so has() doesn't make a request per uid"""
+        if self._disabled:
+            return
+
+        uids = [uid for uid in set(uids) if uid not in self._probed]
+        if not uids:
+            return
+
+        with AccumulateTime(lambda x: self._inc_time(x, 'get-meta')):
+            try:
+                found = self._client.exists_many(uids)
+            except BazelStoreBrokenException as e:
+                self._disable_store(e)
+                return
+            except BazelStoreException as e:
+                logger.debug('Failed to probe Bazel-remote: %s', e)
+                self._count_failure('get-meta')
+                return
+
+        for uid in uids:
+            self._probed[uid] = uid in found
+        logger.debug('Bazel-remote probing: %d of %d uids found', len(found), len(uids))
+
+    def has_many(self, uids, threads=None):
+        uids = list(uids)
+        self._probe(uids)
+        return super(BazelStore, self).has_many(uids, threads)
+
     @exts.func.memoize(thread_safe=False)
     def _do_has(self, uid):
         if self._disabled:
             return False
 
-        try:
-            found = self._client.exists(uid)
-        except BazelStoreBrokenException as e:
-            self._disable_store(e)
-            found = False
+        found = self._probed.get(uid)
+        if found is None:
+            try:
+                found = self._client.exists(uid)
+            except BazelStoreBrokenException as e:
+                self._disable_store(e)
+                found = False
         logger.debug('Bazel-remote Probing %s => %s', uid, found)
         self._inc_cache_hit(found)
         return found
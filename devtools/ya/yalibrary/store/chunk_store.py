@@ -0,0 +1,292 @@
+from __future__ import print_function
+import contextlib
+import errno
+import hashlib
+import logging
+import os
+import re
+import shutil
+import threading
+
+import six
+
+from exts import filelock
+from exts import fs
+from exts import uniq_id
+
+import yalibrary.store.file_store as file_store
+import yalibrary.store.packed_index as packed_index
+
+logger = logging.getLogger(__name__)
+
+
+class ChunkStoreError(Exception):
+    pass
+
+
+class Chunker(object):
+    """
+    Content-defined chunking: a chunk ends right after the first anchor found past min_size bytes,
+    or at max_size bytes if there is no anchor. Boundaries depend only on the bytes since the previous one,
+    so an insertion or a change in the middle of a file alters only the chunks around it.
+
+    The anchor is a short byte pattern searched with a compiled regex, which scans in C
+    instead of updating a rolling hash in Python for every byte.
+    The anchor matches ~1/256K of random positions, so chunks are ~512K on average.
+    """
+
+    ANCHOR = re.compile(b'\\xd3\\x5b[\\x00-\\x3f]')
+    MIN_SIZE = 256 * 1024
+    MAX_SIZE = 4 * 1024 * 1024
+    READ_SIZE = 8 * 1024 * 1024
+
+    def __init__(self, min_size=None, max_size=None):
+        self._min_size = min_size or self.MIN_SIZE
+        self._max_size = max_size or self.MAX_SIZE
+
+    def _cut(self, buf, eof):
+        if len(buf) < self._min_size:
+            return len(buf) if eof and buf else None
+        m = self.ANCHOR.search(buf, self._min_size, min(len(buf), self._max_size))
+        if m:
+            return m.end()
+        if len(buf) >= self._max_size:
+            return self._max_size
+        return len(buf) if eof else None
+
+    def chunks(self, stream):
+        """Yields consecutive chunks of the stream as bytes"""
+        buf = bytearray()
+        eof = False
+        while not eof:
+            block = stream.read(self.READ_SIZE)
+            eof = not block
+            buf += block
+            while True:
+                cut = self._cut(buf, eof)
+                if not cut:
+                    break
+                yield bytes(buf[:cut])
+                del buf[:cut]
+
+
+class ChunkStore(object):
+    """
+    Blob store keeping large files as recipes, i.e. lists of content-defined chunks shared between blobs.
+    Has the same put_file/extract_file/remove interface as file_store.Store, blobs are keyed by the same
+    git-like hash of the whole content.
+
+    Every chunk has a reference counter in an mmap'd PackedIndex. Counters are updated under a file lock,
+    since the store is shared between concurrent builds. A chunk is removed when its counter drops to zero.
+    A counter which is lost (crash between chunk and recipe writes, full index) leaks a chunk until gc().
+    """
+
+    RECIPE_MAGIC = 'YACHUNKS1'
+
+    def __init__(self, store_path, chunker=None):
+        self._store_path = store_path
+        self._chunks_path = os.path.join(store_path, 'chunks')
+        self._recipes = file_store.Store(os.path.join(store_path, 'recipes'))
+        self._tray_path = os.path.join(store_path, 'tray')
+        self._refs_path = os.path.join(store_path, 'refs')
+        self._chunker = chunker or Chunker()
+
+        fs.create_dirs(self._chunks_path)
+        fs.create_dirs(self._tray_path)
+        self._refs = packed_index.PackedIndex(self._refs_path)
+        self._thread_lock = threading.Lock()
+        self._file_lock = filelock.FileLock(os.path.join(store_path, 'refs.lock'))
+
+    def _chunk_path(self, key):
+        return os.path.join(self._chunks_path, key[0], key[1], key)
+
+    def _gen_tmp_path(self):
+        return os.path.join(self._tray_path, uniq_id.gen32())
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # flock doesn't exclude threads sharing the descriptor
+        with self._thread_lock:
+            with self._file_lock:
+                yield
+
+    def _incref(self, key, size):
+        h = packed_index.PackedIndex.hash(key)
+        with self._locked():
+            found = self._refs.get(h)
+            refs = found[0] if found else 0
+            if not self._refs.set(h, refs + 1, size, evict=False):
+                raise ChunkStoreError('Chunk reference index is full')
+
+    def _decref(self, key):
+        h = packed_index.PackedIndex.hash(key)
+        with self._locked():
+            found = self._refs.get(h)
+            if found is None:
+                # Lost counter, leave the chunk to gc()
+                return
+            refs, size = found
+            if refs > 1:
+                self._refs.set(h, refs - 1, size)
+                return
+            self._refs.delete(h)
+            file_store.Store.remove_internal(self._chunk_path(key))
+
+    def _put_chunk(self, data):
+        key = hashlib.sha1(data).hexdigest()
+        # Reference first, so the chunk can't be removed by a concurrent _decref right after the check below
+        self._incref(key, len(data))
+        path = self._chunk_path(key)
+        if not os.path.exists(path):
+            tmp_path = self._gen_tmp_path()
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            fs.create_dirs(os.path.dirname(path))
+            os.rename(tmp_path, path)
+        return key
+
+    def _read_recipe(self, key):
+        lines = self._recipes.get(key).splitlines()
+        if not lines or lines[0] != self.RECIPE_MAGIC:
+            raise file_store.NotInCacheError('Broken recipe for key {}'.format(key))
+        chunks = []
+        for line in lines[1:]:
+            chunk_key, size = line.split()
+            chunks.append((chunk_key, int(size)))
+        return chunks
+
+    def has(self, key):
+        return self._recipes.has(key)
+
+    def path(self, key):
+        return self._recipes._discriminant(key)
+
+    def put_file(self, path):
+        """Returns the same (inner path, key, size) as file_store.Store.put_file"""
+        sha = hashlib.sha1()
+        chunks = []
+        try:
+            with open(path, 'rb') as f:
+                for data in self._chunker.chunks(f):
+                    sha.update(data)
+                    chunks.append((self._put_chunk(data), len(data)))
+        except Exception:
+            for chunk_key, _ in chunks:
+                self._decref(chunk_key)
+            raise
+
+        size = sum(s for _, s in chunks)
+        # Same as hashing.git_like_hash_with_size
+        sha.update(b'\0')
+        sha.update(six.ensure_binary(str(size)))
+        key = sha.hexdigest()
+
+        if self._recipes.has(key):
+            # Same content is already stored
+            for chunk_key, _ in chunks:
+                self._decref(chunk_key)
+        else:
+            recipe = [self.RECIPE_MAGIC] + ['{} {}'.format(chunk_key, s) for chunk_key, s in chunks]
+            self._recipes.put(key, '\n'.join(recipe) + '\n')
+        return self.path(key), key, size
+
+    def extract_file(self, key, into, mode=None):
+        try:
+            chunks = self._read_recipe(key)
+        except ValueError:
+            raise file_store.NotInCacheError('Broken recipe for key {}'.format(key))
+
+        into_dir = os.path.dirname(into)
+        if not os.path.exists(into_dir):
+            fs.create_dirs(into_dir)
+
+        try:
+            with open(into, 'wb') as out:
+                expected = 0
+                for chunk_key, size in chunks:
+                    with open(self._chunk_path(chunk_key), 'rb') as f:
+                        shutil.copyfileobj(f, out)
+                    expected += size
+                    if out.tell() != expected:
+                        raise file_store.NotInCacheError('Chunk {} of key {} is broken'.format(chunk_key, key))
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:
+                raise file_store.NotInCacheError('Cannot find chunk for key {}: {}'.format(key, e))
+            raise
+
+        if mode is not None:
+            os.chmod(into, mode)
+        return self.path(key)
+
+    def remove(self, key):
+        try:
+            chunks = self._read_recipe(key)
+        except (file_store.NotInCacheError, ValueError):
+            return False
+
+        if not self._recipes.remove(key):
+            # Removed concurrently
+            return False
+        for chunk_key, _ in chunks:
+            self._decref(chunk_key)
+        return True
+
+    def size(self):
+        """Total size of stored chunks"""
+        return self._refs.stats()[0]
+
+    def flush(self):
+        self._refs.flush()
+
+    # Only single-threaded context
+    def clear_tray(self):
+        self._recipes.clear_tray()
+        for file_name in os.listdir(self._tray_path):
+            file_store.Store.remove_internal(os.path.join(self._tray_path, file_name))
+
+    # Only single-threaded context
+    def gc(self, ids_to_retain):
+        """Removes recipes not in ids_to_retain, rebuilds reference counters and drops unreferenced chunks"""
+        self.clear_tray()
+        self._recipes.gc(ids_to_retain)
+
+        refs = {}
+        for path in self._recipes.iter_paths():
+            with open(path) as f:
+                lines = f.read().splitlines()
+            for line in lines[1:]:
+                chunk_key, size = line.split()
+                refs.setdefault(chunk_key, [0, int(size)])[0] += 1
+
+        self._refs.close()
+        fs.ensure_removed(self._refs_path)
+        self._refs = packed_index.PackedIndex(self._refs_path, buckets=packed_index.PackedIndex.buckets_for(len(refs)))
+        for chunk_key, (count, size) in six.iteritems(refs):
+            self._refs.set(packed_index.PackedIndex.hash(chunk_key), count, size)
+
+        for root, _, files in os.walk(self._chunks_path):
+            for chunk_key in files:
+                if chunk_key not in refs:
+                    file_store.Store.remove_internal(os.path.join(root, chunk_key))
+
+
+if __name__ == '__main__':
+    import sys
+    import tempfile
+    import time
+
+    # python chunk_store.py file1 file2 ... - shows deduplication ratio for the files
+    root = tempfile.mkdtemp()
+    try:
+        store = ChunkStore(root)
+        total = 0
+        t1 = time.time()
+        for path in sys.argv[1:]:
+            total += store.put_file(path)[2]
+        t2 = time.time()
+
+        print('input (bytes)', total)
+        print('stored (bytes)', store.size())
+        print('put (MB/s)', total / 1024.0 / 1024.0 / max(t2 - t1, 1e-6))
+    finally:
+        shutil.rmtree(root)
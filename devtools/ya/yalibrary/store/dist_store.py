@@ -1,10 +1,12 @@
 import enum
 import os
 import six
+import threading
 import time
 
 import humanfriendly
 from core import report
+import exts.asyncthread as core_async
 from exts.timer import AccumulateTime
 
 import logging
@@ -27,6 +29,8 @@ class Status(enum.Enum):
 
 
 class DistStore(object):
+    PROBE_THREADS = 16
+
     def __init__(self, name, stats_name, tag, readonly, max_file_size=0, fits_filter=None):
         self._readonly = readonly
         self._timers = {'has': 0, 'put': 0, 'get': 0, 'get-meta': 0}
@@ -35,6 +39,9 @@ class DistStore(object):
         self._failures = {'has': 0, 'put': 0, 'get': 0, 'get-meta': 0}
         self._data_size = {'put': 0, 'get': 0}
         self._cache_hit = {'requested': 0, 'found': 0}
+        # Per file transfers: count, bytes, seconds spent
+        self._file_transfers = {'put': [0, 0, 0.0], 'get': [0, 0, 0.0]}
+        self._file_transfers_lock = threading.Lock()
         self._meta = {}
         self._name = name
         self._stats_name = stats_name
@@ -54,6 +61,13 @@ class DistStore(object):
     def _inc_data_size(self, size, tag):
         self._data_size[tag] += size
 
+    def _inc_file_transfer(self, tag, size, duration):
+        with self._file_transfers_lock:
+            stat = self._file_transfers[tag]
+            stat[0] += 1
+            stat[1] += size
+            stat[2] += duration
+
     def _gen_exclude_filter(self, limit):
         if limit:
 
@@ -83,6 +97,18 @@ class DistStore(object):
         with AccumulateTime(lambda x: self._inc_time(x, 'has')):
             return self._do_has(*args, **kwargs)
 
+    def has_many(self, uids, threads=None):
+        """Probes uids in parallel, returns the set of found ones"""
+        uids = list(uids)
+        if not uids:
+            return set()
+
+        found = core_async.par_map(self.has, uids, threads or self.PROBE_THREADS)
+        return set(uid for uid, res in zip(uids, found) if res)
+
+    def prefetch(self, uids, threads=None):
+        return self.has_many(uids, threads)
+
     def _do_put(self, uid, root_dir, files, codec=None):
         raise NotImplementedError()
 
@@ -136,6 +162,19 @@ class DistStore(object):
             execution_log['$({}-{}-data-size)'.format(self._name, k)] = stat_dict
         execution_log['$({}-cache-hit)'.format(self._name)] = self._cache_hit
 
+        for k, (count, size, duration) in six.iteritems(self._file_transfers):
+            if not count:
+                continue
+            stat_dict = {
+                'count': count,
+                'data_size': size,
+                'transfer_time': duration,
+                'throughput': size / duration if duration else 0.0,
+                'type': self._name,
+            }
+            report.telemetry.report('{}-{}-file-throughput'.format(self._stats_name, k), stat_dict)
+            execution_log['$({}-{}-file-throughput)'.format(self._name, k)] = stat_dict
+
         for k, v in six.iteritems(self._timers):
             real_time = self._get_real_time(k)
 
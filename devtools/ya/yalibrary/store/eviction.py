@@ -0,0 +1,99 @@
+import mmap
+import time
+
+from yalibrary.store import hash_map
+
+
+class CacheItem(object):
+    def __init__(self, uid, timestamp, size, cost):
+        self.uid = uid
+        self.timestamp = timestamp
+        self.size = size
+        # Rebuild time in seconds, None if unknown
+        self.cost = cost
+
+
+class EvictionPolicy(object):
+    name = None
+
+    def order(self, items, now=None):
+        """Returns items in the order they should be evicted"""
+        raise NotImplementedError()
+
+
+class LruPolicy(EvictionPolicy):
+    name = 'lru'
+
+    def order(self, items, now=None):
+        return sorted(items, key=lambda item: item.timestamp)
+
+
+class GdsfPolicy(EvictionPolicy):
+    """
+    Greedy-Dual-Size-Frequency like policy: keeps items which are expensive to rebuild per byte of cache.
+    Priority is cost / size, decayed by age with the given half-life. Classic GDSF ages items by inflating
+    the priority of new ones, but priorities here are recomputed on every compaction, so age is explicit.
+    The lowest priority goes first.
+    """
+
+    name = 'gdsf'
+    HALF_LIFE = 24 * 60 * 60
+    # Rebuild cost of items built before costs were recorded or restored from the dist cache
+    DEFAULT_COST = 1.0
+
+    def __init__(self, half_life=None, default_cost=None):
+        self._half_life = half_life or self.HALF_LIFE
+        self._default_cost = default_cost or self.DEFAULT_COST
+
+    def priority(self, item, now):
+        cost = item.cost if item.cost is not None else self._default_cost
+        age = max(0, now - item.timestamp)
+        return cost / max(item.size, 1) * 0.5 ** (float(age) / self._half_life)
+
+    def order(self, items, now=None):
+        now = now or time.time()
+        return sorted(items, key=lambda item: self.priority(item, now))
+
+
+POLICIES = {policy.name: policy for policy in (LruPolicy, GdsfPolicy)}
+DEFAULT_POLICY = LruPolicy.name
+
+
+def get_policy(name):
+    try:
+        return POLICIES[name or DEFAULT_POLICY]()
+    except KeyError:
+        raise ValueError('Unknown eviction policy {}, expected one of {}'.format(name, ', '.join(sorted(POLICIES))))
+
+
+class RebuildCostMap(object):
+    """uid -> rebuild time in milliseconds. Lossy like UsageMap: a collision forgets the previous uid"""
+
+    FILE_SIZE = 12 * 1003001
+
+    def __init__(self, fname):
+        self._f = hash_map.open_file(fname, self.FILE_SIZE)
+        self._mm = mmap.mmap(self._f.fileno(), 0)
+        self._hmap = hash_map.OpenHashMap(self._mm, 'I')
+
+    def close(self):
+        self._hmap.flush()
+        self._mm.close()
+        self._f.close()
+
+    def set(self, uid, cost):
+        self._hmap[uid] = (min(int(cost * 1000), 0xFFFFFFFF),)
+
+    def get(self, uid):
+        try:
+            return self._hmap[uid][0] / 1000.0
+        except KeyError:
+            return None
+
+    def remove(self, uid):
+        # Deletion clears the bucket unconditionally, don't wipe a colliding uid
+        if self.get(uid) is not None:
+            del self._hmap[uid]
+
+    def flush(self):
+        self._hmap.flush()
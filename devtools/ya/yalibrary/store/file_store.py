@@ -114,7 +114,7 @@ class Store(object):
         os.rename(tmp_path, inner_path)
         return inner_path, key, size
 
-    def extract_file(self, key, into, codec=None, mode=None):
+    def extract_file(self, key, into, codec=None, mode=None, threads=1):
         inner_path = self._discriminant(key)
         into_dir = os.path.dirname(into)
 
@@ -124,7 +124,7 @@ class Store(object):
         def extract():
             in_mode = os.stat(inner_path).st_mode
             if codec:
-                compress.decompress(inner_path, into, codec)
+                compress.decompress(inner_path, into, codec, threads=threads)
                 os.chmod(into, mode)
             elif mode is None or (mode & in_mode) != mode:
                 logger.debug(
@@ -161,6 +161,13 @@ class Store(object):
                     if fhash not in hashed_to_retain:
                         self.remove_internal(os.path.join(self._data_store, fhash[0], fhash[1], fhash))
 
+    # Only single-threaded context
+    def iter_paths(self):
+        for x in self._HEX:
+            for y in self._HEX:
+                for fhash in os.listdir(os.path.join(self._data_store, x, y)):
+                    yield os.path.join(self._data_store, x, y, fhash)
+
 
 class FileStore(object):
     def __init__(self, store_path):
@@ -52,24 +52,31 @@ class OpenHashMap(object):
                 yield values[1:]
 
     def __setitem__(self, key, values):
-        h = self._hash(key)
-        offset = self._offset(h)
-        struct.pack_into(self._fmt, self._mm, offset, h, *values)
+        self.set_hashed(self._hash(key), values)
+
+    def set_hashed(self, h, values):
+        struct.pack_into(self._fmt, self._mm, self._offset(h), h, *values)
 
     def _get_from(self, offset):
         return struct.unpack_from(self._fmt, self._mm, offset)
 
     def __getitem__(self, key):
-        h0 = self._hash(key)
-        offset = self._offset(h0)
-        values = self._get_from(offset)
-        h, values = values[0], values[1:]
-        if h != h0:
+        values = self.get_hashed(self._hash(key))
+        if values is None:
             raise KeyError
         return values
 
+    def get_hashed(self, h0):
+        """Values by precomputed _hash of a key, None if absent"""
+        values = self._get_from(self._offset(h0))
+        if values[0] != h0:
+            return None
+        return values[1:]
+
     def __delitem__(self, key):
-        h = self._hash(key)
+        self.del_hashed(self._hash(key))
+
+    def del_hashed(self, h):
         offset = self._offset(h)
         self._mm[offset : offset + self._item_size] = b'\0' * self._item_size
 
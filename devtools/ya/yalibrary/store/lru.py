@@ -1,79 +1,146 @@
 from itertools import chain
+import hashlib
+import logging
 import os
-import time
+import struct
 import threading
+import time
+
+import six
 
+import yalibrary.store.file_store as file_store
+import yalibrary.store.packed_index as packed_index
 import yalibrary.store.usage_map as usage_map
 
 from yalibrary.chunked_queue import queue
 
+logger = logging.getLogger(__name__)
 
-class Series(object):
-    def __init__(self):
-        self._lock = threading.Lock()
-        self._id = 0
 
-    def next(self):
-        with self._lock:
-            self._id += 1
-            return self._id
+class LruQueue(object):
+    """
+    Last usages of keys in a sharded usage map plus a journal of touches in the order they happened.
+    The journal consists of fixed size binary records, a record older than the last usage of its key is skipped.
+    A key is journaled at most once per second, repeated touches within the same second are folded into one record.
+    Keys longer than KEY_SIZE are journaled by digest, the keys themselves are kept in a separate store.
+    """
 
+    KEY_SIZE = 55
+    RECORD_FMT = '<IIB{}s'.format(KEY_SIZE)  # stamp, id, key length (LONG_KEY for a digest), key
+    RECORD_SIZE = struct.calcsize(RECORD_FMT)
+    LONG_KEY = 0xFF
+    USAGE_SHARDS = 16
+    JOURNAL_SHARDS = 8
 
-class LruQueue(object):
     def __init__(self, store_path, updater=None):
-        self._usage = usage_map.UsageMap(os.path.join(store_path, 'usage'))
-        self._queue = queue.Queue(os.path.join(store_path, 'queue'))
+        self._store_path = store_path
+        self._long_keys_path = os.path.join(store_path, 'long_keys')
+        self._long_keys = None
+        self._long_keys_lock = threading.Lock()
+        self._usage = usage_map.ShardedUsageMap(os.path.join(store_path, 'usage'), self.USAGE_SHARDS)
+        journal_path = os.path.join(store_path, 'journal')
+        self._queue = queue.RecordQueue(journal_path, self.RECORD_SIZE, self.JOURNAL_SHARDS)
         self._updater = updater
         if self._updater:
             # Postponed updates
-            self._update_queue = queue.Queue(os.path.join(store_path, 'queue'))
-        self._series = Series()
+            self._update_queue = queue.RecordQueue(journal_path, self.RECORD_SIZE, self.JOURNAL_SHARDS)
+
+    def _get_long_keys(self, create):
+        if self._long_keys is None and (create or os.path.isdir(self._long_keys_path)):
+            with self._long_keys_lock:
+                if self._long_keys is None:
+                    self._long_keys = packed_index.PackedStore(self._long_keys_path)
+        return self._long_keys
+
+    @staticmethod
+    def _digest(key):
+        return hashlib.md5(key).hexdigest()
+
+    def _pack(self, key, stamp, id):
+        key = six.ensure_binary(key)
+        if len(key) <= self.KEY_SIZE:
+            return struct.pack(self.RECORD_FMT, stamp, id, len(key), key)
+
+        long_keys = self._get_long_keys(create=True)
+        digest = self._digest(key)
+        if not long_keys.has(digest):
+            long_keys.put(digest, key)
+        return struct.pack(self.RECORD_FMT, stamp, id, self.LONG_KEY, six.ensure_binary(digest))
+
+    def _unpack(self, record):
+        stamp, id, length, key = struct.unpack(self.RECORD_FMT, record)
+        if length == self.LONG_KEY:
+            digest = six.ensure_str(key.rstrip(b'\0'))
+            long_keys = self._get_long_keys(create=False)
+            if long_keys is not None:
+                try:
+                    return long_keys.get(digest), stamp, id
+                except file_store.NotInCacheError:
+                    pass
+            raise ValueError('Unknown long key digest {}'.format(digest))
+        return six.ensure_str(key[:length]), stamp, id
 
     def touch(self, key, update_queue=None):
         stamp = int(time.time())
-        id = self._series.next()
-        self._usage.touch(key, stamp=stamp, id=id)
-        self._queue.push(key + '|' + str(stamp) + '|' + str(id))
+        id, journal = self._usage.touch_once(key, stamp)
+        record = self._pack(key, stamp, id)
+        # Consecutive ids of a key land in different journal shards
+        shard = id % self.JOURNAL_SHARDS
+        if journal:
+            self._queue.push(record, shard)
         if update_queue and self._updater:
-            self._update_queue.push(key + '|' + str(stamp) + '|' + str(id))
+            self._update_queue.push(record, shard)
 
-    def __action(self, consumer, value):
-        """Wrapper for consumer to use in sieve, avoids double processing"""
+    def last_usage(self, key):
+        """Stamp of the last touch, None if unknown"""
+        return self._usage.last_usage(key)[0]
+
+    def __parse(self, record):
         try:
-            key, stamp, id = value.split('|')
-            stamp = int(stamp)
-            id = int(id)
-        except ValueError:
-            # TODO: logging
-            return
+            key, stamp, id = self._unpack(record)
+        except (struct.error, ValueError):
+            logger.debug('Broken LRU journal record %r', record)
+            return None
         last_usage, last_id = self._usage.last_usage(key)
         if last_usage is None or last_usage == stamp and last_id == id:
+            return key, stamp, id
+        return None
+
+    def __action(self, consumer, record):
+        """Wrapper for consumer to use in sieve, avoids double processing"""
+        parsed = self.__parse(record)
+        if parsed:
+            key, stamp, _ = parsed
             ret = consumer(stamp, key)
             yield key, stamp, ret
 
-    def __strip_action(self, line_to_retain, value):
+    def __erase_action(self, eraser, record):
+        """Same as __action, but forgets the key, so its next touch is journaled even within the same second"""
+        parsed = self.__parse(record)
+        if parsed:
+            key, stamp, id = parsed
+            ret = eraser(stamp, key)
+            self._usage.forget(key, stamp, id)
+            if len(six.ensure_binary(key)) > self.KEY_SIZE:
+                self._long_keys.remove(self._digest(six.ensure_binary(key)))
+            yield key, stamp, ret
+
+    def __strip_action(self, line_to_retain, record):
         """Wrapper for consumer to use in sieve, avoids double processing"""
-        try:
-            key, stamp, id = value.split('|')
-            stamp = int(stamp)
-            id = int(id)
-        except ValueError:
-            # TODO: logging
-            return
-        last_usage, last_id = self._usage.last_usage(key)
-        if last_usage is None or last_usage == stamp and last_id == id:
-            ret = line_to_retain(stamp, key)
-            if ret:
-                yield value
+        parsed = self.__parse(record)
+        if parsed:
+            key, stamp, _ = parsed
+            if line_to_retain(stamp, key):
+                yield record
 
     def sieve(self, eraser, max_chunks=None):
         if self._updater:
             return chain(
                 self._update_queue.sieve_current_chunk(lambda value: self.__action(self._updater, value)),
-                self._queue.sieve(lambda value: self.__action(eraser, value), max_chunks),
+                self._queue.sieve(lambda value: self.__erase_action(eraser, value), max_chunks),
             )
 
-        return self._queue.sieve(lambda value: self.__action(eraser, value), max_chunks)
+        return self._queue.sieve(lambda value: self.__erase_action(eraser, value), max_chunks)
 
     def analyze(self, analyzer):
         return self._queue.analyze(lambda value: self.__action(analyzer, value))
@@ -86,7 +153,12 @@ class LruQueue(object):
                 pass
         self._queue.flush()
         self._usage.flush()
+        if self._long_keys is not None:
+            self._long_keys.flush()
 
     # Should be synchronized externally
     def strip(self, uids_filter):
-        return self._queue.strip(lambda value: self.__strip_action(uids_filter, value))
+        stripped = self._queue.strip(lambda value: self.__strip_action(uids_filter, value))
+        if self._get_long_keys(create=False) is not None:
+            self._long_keys.clear_tray()
+        return stripped
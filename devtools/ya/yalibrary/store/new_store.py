@@ -8,23 +8,38 @@ else:
 import exts.yjson as json
 import os
 import logging
+import stat
+import threading
 import time
+from multiprocessing.pool import ThreadPool
 
 import core.report
+import exts.asyncthread as core_async
 from exts import fs
 from exts.timer import AccumulateTime
 
+import yalibrary.store.chunk_store as chunk_store
+import yalibrary.store.eviction as eviction
 import yalibrary.store.file_store as file_store
 import yalibrary.store.lru as lru
+import yalibrary.store.packed_index as packed_index
 import yalibrary.store.size_store as size_store
 
 logger = logging.getLogger(__name__)
 
+# Directory of the store in the cache root, changes with incompatible layouts.
+# Versions keeping uid manifests in separate files use '6'
+GENERATION = '8'
+
 
 class StopSieve(Exception):
     pass
 
 
+class IncorrectSizeError(Exception):
+    pass
+
+
 class ItemType(object):
     UID = 'U'
     HASH = 'H'
@@ -39,7 +54,24 @@ class NewStoreItemInfo(object):
 
 
 class NewStore(object):
-    def __init__(self, store_path):
+    PROBE_THREADS = 16
+    # Files of one uid are restored in parallel by a pool shared between all restores
+    RESTORE_THREADS = 8
+    PARALLEL_RESTORE_MIN_FILES = 4
+    # Codec'd blobs of at least this size are decompressed by several threads
+    LARGE_CODEC_BLOB_SIZE = 32 * 1024 * 1024
+    DECOMPRESS_THREADS = 4
+
+    _restore_pool = None
+    _restore_pool_lock = threading.Lock()
+
+    def __init__(self, store_path, chunked_min_size=None, eviction_policy=None):
+        """
+        chunked_min_size enables chunked blob mode: files of at least this size (except codec'd ones)
+        are split into content-defined chunks shared between blobs, see chunk_store.ChunkStore.
+        eviction_policy is a name from eviction.POLICIES used when the cache exceeds its size limit
+        """
+
         def touch_finalizer(stamp, key):
             """'touch'es HASHes left over from 'has'. See _get_file_info"""
 
@@ -57,10 +89,20 @@ class NewStore(object):
             return 'P' + key[0], key[1:]
 
         self._file_store = file_store.Store(os.path.join(store_path, 'blob'))
-        self._uid_store = file_store.Store(os.path.join(store_path, 'uid'))
+        self._uid_store = packed_index.PackedStore(os.path.join(store_path, 'uid'))
         self._lru = lru.LruQueue(os.path.join(store_path, 'lru'), touch_finalizer)
         self._size_store = size_store.SizeStore(os.path.join(store_path, 'size'))
+        self._chunked_min_size = chunked_min_size
+        self._chunk_store = None
+        chunks_path = os.path.join(store_path, 'chunked')
+        # Already chunked blobs should be restorable even if the mode is off
+        if chunked_min_size or os.path.isdir(chunks_path):
+            self._chunk_store = chunk_store.ChunkStore(chunks_path)
+        self._costs = eviction.RebuildCostMap(os.path.join(store_path, 'cost'))
+        self._eviction_policy = eviction.get_policy(eviction_policy)
         self._store_path = store_path
+        # uid -> manifest files of hits warmed up by prefetch, consumed by try_restore
+        self._prefetched = {}
         logger.debug('Initialized store in %s', self._store_path)
 
         self.timers = {'has': 0, 'put': 0, 'get': 0, 'remove': 0}
@@ -79,9 +121,15 @@ class NewStore(object):
             file_map = {}
             try:
                 for x in files:
+                    st = os.lstat(x)
                     mode = os.stat(x).st_mode
-                    x_new, h, size = self._file_store.put_file(x, codec)
+                    chunked = self._should_chunk(st, codec)
+                    if chunked:
+                        x_new, h, size = self._chunk_store.put_file(x)
+                    else:
+                        x_new, h, size = self._file_store.put_file(x, codec)
                     self._lru.touch(ItemType.HASH + h)
+                    # Chunks are accounted by the chunk store
                     fsize = self._get_fs_file_size(x_new)
                     self._size_store[h] = fsize
                     file_map[os.path.relpath(x, root_dir)] = {
@@ -91,6 +139,8 @@ class NewStore(object):
                         'mode': mode,
                         'fsize': fsize,
                     }
+                    if chunked:
+                        file_map[os.path.relpath(x, root_dir)]['chunked'] = True
 
                 content = json.dumps({'files': file_map, 'uid': uid})
                 self._lru.touch(ItemType.UID + uid)
@@ -100,6 +150,10 @@ class NewStore(object):
                 self._count_failure('put')
                 logger.exception('Error (%s) storing %s(%s, %s)', e, uid, list(files), file_map)
 
+    def put_rebuild_cost(self, uid, cost):
+        """Remembers how long uid took to build (seconds), used by cost-aware eviction"""
+        self._costs.set(uid, cost)
+
     def has(self, uid):
         with AccumulateTime(lambda x: self._inc_time(x, 'has')):
             res = False
@@ -114,6 +168,56 @@ class NewStore(object):
 
             return res
 
+    def _should_chunk(self, st, codec):
+        return bool(
+            self._chunked_min_size and not codec and stat.S_ISREG(st.st_mode) and st.st_size >= self._chunked_min_size
+        )
+
+    def _blob_path(self, file_info):
+        if file_info.get('chunked'):
+            if self._chunk_store is None:
+                raise file_store.NotInCacheError('Chunked blob {} without chunk store'.format(file_info['hash']))
+            return self._chunk_store.path(file_info['hash'])
+        return self._file_store._discriminant(file_info['hash'])
+
+    def has_many(self, uids, threads=None):
+        """Probes uids in parallel, returns the set of found ones"""
+        uids = list(uids)
+        if not uids:
+            return set()
+
+        found = core_async.par_map(self.has, uids, threads or self.PROBE_THREADS)
+        return set(uid for uid, res in zip(uids, found) if res)
+
+    def prefetch(self, uids, threads=None):
+        """
+        Same as has_many, but also reads manifests of found uids and stats their blobs,
+        so try_restore doesn't wait on cold disk. Uids with missing blobs are not reported as found.
+        """
+        threads = threads or self.PROBE_THREADS
+        hits = list(self.has_many(uids, threads))
+
+        def warm(uid):
+            try:
+                files = list(self._get_file_info(uid))
+                for rel_path, file_info in files:
+                    os.stat(self._blob_path(file_info))
+            except (file_store.NotInCacheError, OSError) as e:
+                logger.debug('Prefetch of %s failed: %s', uid, e)
+                return False
+            self._prefetched[uid] = files
+            return True
+
+        if not hits:
+            return set()
+        return set(uid for uid, ok in zip(hits, core_async.par_map(warm, hits, threads)) if ok)
+
+    def drop_prefetched(self):
+        """Forgets manifests warmed up by prefetch which are not consumed by try_restore"""
+        if self._prefetched:
+            logger.debug('Dropping %d unused prefetched manifests', len(self._prefetched))
+        self._prefetched.clear()
+
     @staticmethod
     def _rollback_if_need(uid, paths):
         if paths:
@@ -124,27 +228,67 @@ class NewStore(object):
                 except Exception as e:
                     logger.debug('Cannot remove %s: %s', path, e)
 
+    @classmethod
+    def _get_restore_pool(cls):
+        with cls._restore_pool_lock:
+            if cls._restore_pool is None:
+                cls._restore_pool = ThreadPool(cls.RESTORE_THREADS)
+            return cls._restore_pool
+
+    def _restore_file(self, into_dir, rel_path, file_info, restored):
+        self._lru.touch(ItemType.HASH + file_info['hash'])
+
+        path = os.path.join(into_dir, rel_path)
+        if file_info.get('chunked'):
+            if self._chunk_store is None:
+                raise file_store.NotInCacheError('Chunked blob {} without chunk store'.format(file_info['hash']))
+            # Chunk sizes are verified while reassembling
+            self._chunk_store.extract_file(file_info['hash'], path, mode=file_info['mode'])
+            restored.append(path)
+            return
+
+        threads = 1
+        if file_info['codec'] and file_info['size'] >= self.LARGE_CODEC_BLOB_SIZE:
+            threads = self.DECOMPRESS_THREADS
+        path_in_storage = self._file_store.extract_file(
+            file_info['hash'], path, file_info['codec'], mode=file_info['mode'], threads=threads
+        )
+        restored.append(path)
+        file_size = fs.get_file_size(path_in_storage)
+        if file_size != file_info['size']:
+            raise IncorrectSizeError('Incorrect file size in store, fname={}'.format(path))
+        if 'fsize' not in file_info:
+            self._size_store[file_info['hash']] = self._get_fs_file_size(path_in_storage)
+
+    def _restore_files(self, into_dir, files, restored):
+        if len(files) < self.PARALLEL_RESTORE_MIN_FILES:
+            for rel_path, file_info in files:
+                self._restore_file(into_dir, rel_path, file_info, restored)
+            return
+
+        pool = self._get_restore_pool()
+        results = [
+            pool.apply_async(self._restore_file, (into_dir, rel_path, file_info, restored))
+            for rel_path, file_info in files
+        ]
+        # Wait for every file before rollback, otherwise late ones would be left restored
+        for r in results:
+            r.wait()
+        for r in results:
+            r.get()
+
     def try_restore(self, uid, into_dir):
         with AccumulateTime(lambda x: self._inc_time(x, 'get')):
             to_clean = []
             try:
-                for rel_path, file_info in self._get_file_info(uid):
-                    self._lru.touch(ItemType.HASH + file_info['hash'])
-
-                    path = os.path.join(into_dir, rel_path)
-                    path_in_storage = self._file_store.extract_file(
-                        file_info['hash'], path, file_info['codec'], mode=file_info['mode']
-                    )
-                    to_clean.append(path)
-                    file_size = fs.get_file_size(path_in_storage)
-                    if file_size != file_info['size']:
-                        logger.debug('Incorrect file size in store, fname=%s', path)
-                        return False
-                    if 'fsize' not in file_info:
-                        self._size_store[file_info['hash']] = self._get_fs_file_size(path_in_storage)
+                files = list(self._prefetched.pop(uid, None) or self._get_file_info(uid))
+                self._restore_files(into_dir, files, to_clean)
 
                 logger.debug('Restoration of %s into %s succeed', uid, into_dir)
                 del to_clean[:]
+            except IncorrectSizeError as e:
+                logger.debug('%s', e)
+                return False
             except file_store.NotInCacheError:
                 self._count_failure('get')
                 return False
@@ -207,6 +351,8 @@ class NewStore(object):
                 logger.debug('Removed %s / %d from uid store', key[1:], stamp)
             elif key.startswith(ItemType.HASH):
                 self._file_store.remove(key[1:])
+                if self._chunk_store:
+                    self._chunk_store.remove(key[1:])
                 del self._size_store[key[1:]]
                 logger.debug('Removed %s / %d from file store', key[1:], stamp)
             else:
@@ -243,19 +389,73 @@ class NewStore(object):
             display.emit_message('{:10} {:5} - {}'.format(size, freq[name], name))
 
     def size(self):
+        if self._chunk_store:
+            return self._size_store.size() + self._chunk_store.size()
         return self._size_store.size()
 
     def compact(self, interval, max_cache_size, state):
         now = int(time.time())
+        by_lru = isinstance(self._eviction_policy, eviction.LruPolicy)
 
         def stopper(stamp):
             if stamp <= now - interval:
                 return False
-            if max_cache_size is not None and self._size_store.size() > max_cache_size:
+            if by_lru and max_cache_size is not None and self.size() > max_cache_size:
                 return False
             return True
 
-        return list(self.sieve(stopper, state))
+        removed = list(self.sieve(stopper, state))
+        if not by_lru and max_cache_size is not None and self.size() > max_cache_size:
+            removed += self.evict(max_cache_size, state)
+        return removed
+
+    def evict(self, max_cache_size, state=None):
+        """
+        Removes uids in the order of the eviction policy until the cache fits max_cache_size.
+        A blob is removed with the last uid referencing it.
+        """
+        start = int(time.time())
+        manifests = {}
+
+        def collector(stamp, key):
+            if key.startswith(ItemType.UID):
+                with contextlib.suppress(file_store.NotInCacheError):
+                    manifests[key[1:]] = (stamp, [file_info for _, file_info in self._get_file_stats(key[1:])])
+            return key[0], key[1:]
+
+        for _ in self._lru.analyze(collector):
+            if state:
+                state.check_cancel_state()
+
+        refs = collections.Counter()
+        items = []
+        for uid, (stamp, files) in six.iteritems(manifests):
+            refs.update(file_info['hash'] for file_info in files)
+            size = sum(file_info.get('fsize', file_info['size']) for file_info in files)
+            items.append(eviction.CacheItem(uid, stamp, size, self._costs.get(uid)))
+
+        removed = []
+        for item in self._eviction_policy.order(items, start):
+            if self.size() <= max_cache_size:
+                break
+            if state:
+                state.check_cancel_state()
+
+            self.clear_uid(item.uid)
+            self._costs.remove(item.uid)
+            removed.append((ItemType.UID + item.uid, item.timestamp, None))
+            for file_info in manifests[item.uid][1]:
+                h = file_info['hash']
+                refs[h] -= 1
+                # Blob may be just shared with a uid put by a concurrent build
+                if refs[h] > 0 or (self._lru.last_usage(ItemType.HASH + h) or 0) > start:
+                    continue
+                self._file_store.remove(h)
+                if self._chunk_store:
+                    self._chunk_store.remove(h)
+                del self._size_store[h]
+        logger.debug('Evicted %d uids by %s policy', len(removed), self._eviction_policy.name)
+        return removed
 
     def convert(self, converter, state):
         """
@@ -268,13 +468,16 @@ class NewStore(object):
                 try:
                     info = {}
                     codec = None
+                    chunked = False
                     for rel_path, file_info in self._get_file_info(key[1:]):
                         fhash = file_info['hash']
                         info[rel_path] = (self._file_store._discriminant(fhash), file_info['mode'], fhash)
                         del self._size_store[fhash]
                         codec = codec or file_info.get('codec')
+                        chunked = chunked or file_info.get('chunked', False)
 
-                    if not codec:
+                    # Only plain blobs may be moved
+                    if not codec and not chunked:
                         converter(key[1:], info)
                     self.clear_uid(key[1:])
                 except file_store.NotInCacheError:
@@ -289,8 +492,11 @@ class NewStore(object):
         self.flush()
         fs.remove_tree_safe(self._store_path)
 
+    # Need external synchronization
     def clear_tray(self):
         self._file_store.clear_tray()
+        if self._chunk_store:
+            self._chunk_store.clear_tray()
         self._uid_store.clear_tray()
 
     # Need external synchronization. Suitable for garbage collection.
@@ -341,18 +547,25 @@ class NewStore(object):
 
         logger.debug("Cleaning file store")
         self._file_store.gc(used_file_uids)
+        if self._chunk_store:
+            self._chunk_store.gc(used_file_uids)
 
         logger.debug("Cleaning uid store")
         self._uid_store.gc(used_uids)
 
     def flush(self):
         self._size_store.flush()
+        self._costs.flush()
         self._lru.flush()
+        self._uid_store.flush()
+        if self._chunk_store:
+            self._chunk_store.flush()
 
     def clear_uid(self, uid):
         with AccumulateTime(lambda x: self._inc_time(x, 'remove')):
             # lru is shared by both UIDs and HASHes.
             # HASHes should be collected separately in compact using _lru.
+            self._prefetched.pop(uid, None)
             self._uid_store.remove(uid)
 
     def stats(self, execution_log):
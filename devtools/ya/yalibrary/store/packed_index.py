@@ -0,0 +1,348 @@
+from __future__ import print_function
+import logging
+import mmap
+import os
+import struct
+import threading
+
+import six
+
+from exts import fs
+
+import yalibrary.store.file_store as file_store
+import yalibrary.store.hash_map as hash_map
+
+logger = logging.getLogger(__name__)
+
+
+class PackedIndex(object):
+    """
+    mmap'd open addressing map: 64-bit key hash -> (offset, length) of a record in the data file.
+    Collisions are resolved with bounded linear probing. When the probe window is exhausted
+    the home bucket is overwritten, so the map may forget entries, but never returns a wrong one.
+    Such overflows are counted, the owner is expected to rebuild the map with more buckets (see need_rehash()).
+    """
+
+    MAGIC = b'YAPIDX02'
+    HEADER_FMT = '<8sQQQ'  # magic, live bytes, live records, overflows
+    HEADER_SIZE = 64
+    BUCKET_FMT = '<QQI'  # key hash, offset, length
+    BUCKETS = 1 << 20
+    MAX_PROBES = 32
+    MAX_LOAD = 0.5
+
+    EMPTY = 0
+    DELETED = 1
+
+    def __init__(self, fname, buckets=None):
+        self._buckets = buckets or self.BUCKETS
+        self._bucket_size = struct.calcsize(self.BUCKET_FMT)
+        self._f = hash_map.open_file(fname, self.HEADER_SIZE + self._buckets * self._bucket_size)
+        self._mm = mmap.mmap(self._f.fileno(), 0)
+        self._buckets = (len(self._mm) - self.HEADER_SIZE) // self._bucket_size
+        self._lock = threading.Lock()
+
+        magic = struct.unpack_from(self.HEADER_FMT, self._mm, 0)[0]
+        if magic != self.MAGIC:
+            struct.pack_into(self.HEADER_FMT, self._mm, 0, self.MAGIC, 0, 0, 0)
+
+    @classmethod
+    def buckets_for(cls, records):
+        """Number of buckets to keep the load of the map with records entries under MAX_LOAD"""
+        buckets = cls.BUCKETS
+        while buckets * cls.MAX_LOAD < records:
+            buckets *= 2
+        return buckets
+
+    @staticmethod
+    def hash(key):
+        import cityhash
+
+        h = cityhash.hash64(six.ensure_binary(key))
+        # 0 and 1 mark empty and deleted buckets
+        return h if h > PackedIndex.DELETED else h + 2
+
+    def close(self):
+        self.flush()
+        self._mm.close()
+        self._f.close()
+
+    def flush(self):
+        self._mm.flush()
+
+    def _bucket_offset(self, i):
+        return self.HEADER_SIZE + i * self._bucket_size
+
+    def _probe(self, h):
+        for i in six.moves.xrange(self.MAX_PROBES):
+            yield self._bucket_offset((h + i) % self._buckets)
+
+    def _find(self, h):
+        for pos in self._probe(h):
+            bh, offset, length = struct.unpack_from(self.BUCKET_FMT, self._mm, pos)
+            if bh == h:
+                return pos, offset, length
+            if bh == self.EMPTY:
+                break
+        return None, None, None
+
+    def _update_stats(self, delta_bytes, delta_records, delta_overflows=0):
+        magic, live_bytes, live_records, overflows = struct.unpack_from(self.HEADER_FMT, self._mm, 0)
+        struct.pack_into(
+            self.HEADER_FMT,
+            self._mm,
+            0,
+            magic,
+            max(0, live_bytes + delta_bytes),
+            max(0, live_records + delta_records),
+            overflows + delta_overflows,
+        )
+
+    def stats(self):
+        """(live bytes, live records). Approximate when several processes share the index"""
+        _, live_bytes, live_records, _ = struct.unpack_from(self.HEADER_FMT, self._mm, 0)
+        return live_bytes, live_records
+
+    def overflows(self):
+        """Number of entries evicted since the map is created"""
+        return struct.unpack_from(self.HEADER_FMT, self._mm, 0)[3]
+
+    def need_rehash(self):
+        """Entries were evicted due to overflows or the map is too loaded to avoid them"""
+        _, live_records = self.stats()
+        return self.overflows() > 0 or live_records > self._buckets * self.MAX_LOAD
+
+    def rehashed_buckets(self, records):
+        """Number of buckets for a rebuilt map of records entries"""
+        buckets = self.buckets_for(records)
+        if self.overflows():
+            # Evicted entries would be back, grow at least twice
+            buckets = max(buckets, self._buckets * 2)
+        return buckets
+
+    def get(self, h):
+        _, offset, length = self._find(h)
+        if offset is None:
+            return None
+        return offset, length
+
+    def set(self, h, offset, length, evict=True):
+        """Returns False if the entry didn't fit into the probe window and eviction is not allowed"""
+        with self._lock:
+            free_pos = None
+            for pos in self._probe(h):
+                bh, _, old_length = struct.unpack_from(self.BUCKET_FMT, self._mm, pos)
+                if bh == h:
+                    struct.pack_into(self.BUCKET_FMT, self._mm, pos, h, offset, length)
+                    self._update_stats(length - old_length, 0)
+                    return True
+                if bh in (self.EMPTY, self.DELETED) and free_pos is None:
+                    free_pos = pos
+                if bh == self.EMPTY:
+                    break
+
+            if free_pos is None:
+                if not evict:
+                    return False
+                # Probe window is full, evict home bucket
+                free_pos = self._bucket_offset(h % self._buckets)
+                _, _, old_length = struct.unpack_from(self.BUCKET_FMT, self._mm, free_pos)
+                self._update_stats(-old_length, -1, 1)
+            struct.pack_into(self.BUCKET_FMT, self._mm, free_pos, h, offset, length)
+            self._update_stats(length, 1)
+            return True
+
+    def delete(self, h):
+        with self._lock:
+            pos, _, length = self._find(h)
+            if pos is None:
+                return False
+            struct.pack_into(self.BUCKET_FMT, self._mm, pos, self.DELETED, 0, 0)
+            self._update_stats(-length, -1)
+            return True
+
+    def __iter__(self):
+        """Yields (hash, offset, length) of live entries"""
+        for i in six.moves.xrange(self._buckets):
+            bh, offset, length = struct.unpack_from(self.BUCKET_FMT, self._mm, self._bucket_offset(i))
+            if bh > self.DELETED:
+                yield bh, offset, length
+
+
+class PackedStore(object):
+    """
+    Key-value store with the same has/get/put/remove interface as file_store.Store,
+    but keeping all values in a single append-only data file addressed by PackedIndex.
+    Probing is an mmap lookup and reading is a single pread, instead of a stat/open per key.
+
+    Appends are atomic between processes (O_APPEND), so concurrent builds may share the store.
+    Removal only drops the index entry, the space is reclaimed by compact() which
+    as well as gc() and clear_tray() needs exclusive access to the store.
+    The index is sized by compact() as well, it's grown if entries are evicted from it.
+    """
+
+    RECORD_FMT = '<IQ'  # payload length, key hash
+    # Compact when the data file is at least COMPACTION_MIN_SIZE and live data takes less than COMPACTION_RATIO of it
+    COMPACTION_MIN_SIZE = 64 * 1024 * 1024
+    COMPACTION_RATIO = 0.5
+
+    def __init__(self, store_path):
+        self._store_path = store_path
+        self._pack_path = os.path.join(store_path, 'pack')
+        self._index_path = os.path.join(self._pack_path, 'index')
+        self._data_path = os.path.join(self._pack_path, 'data')
+        self._record_size = struct.calcsize(self.RECORD_FMT)
+        self._append_lock = threading.Lock()
+        self._read_lock = threading.Lock()
+
+        fs.create_dirs(self._pack_path)
+        self._open()
+
+    def _open(self):
+        self._index = PackedIndex(self._index_path)
+        self._wfd = os.open(self._data_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._rfd = os.open(self._data_path, os.O_RDONLY)
+
+    def close(self):
+        self._index.close()
+        os.close(self._wfd)
+        os.close(self._rfd)
+
+    def flush(self):
+        self._index.flush()
+
+    def _pread(self, length, offset):
+        if hasattr(os, 'pread'):
+            return os.pread(self._rfd, length, offset)
+        with self._read_lock:
+            os.lseek(self._rfd, offset, os.SEEK_SET)
+            return os.read(self._rfd, length)
+
+    def _pack(self, h, key, value):
+        payload = six.ensure_binary(key) + b'\0' + six.ensure_binary(value)
+        return struct.pack(self.RECORD_FMT, len(payload), h) + payload
+
+    def _unpack(self, h, key, record):
+        if len(record) < self._record_size:
+            return None
+        length, rh = struct.unpack_from(self.RECORD_FMT, record, 0)
+        if rh != h or len(record) != self._record_size + length:
+            return None
+        rkey, _, value = record[self._record_size :].partition(b'\0')
+        if key is not None and rkey != six.ensure_binary(key):
+            return None
+        return rkey, value
+
+    def _append(self, record):
+        with self._append_lock:
+            written = os.write(self._wfd, record)
+            if written != len(record):
+                raise IOError('Short write into {}: {} of {}'.format(self._data_path, written, len(record)))
+            # With O_APPEND fd position is the end of just written record
+            return os.lseek(self._wfd, 0, os.SEEK_CUR) - len(record)
+
+    def _read(self, h, key=None):
+        loc = self._index.get(h)
+        if loc is None:
+            return None
+        offset, length = loc
+        return self._unpack(h, key, self._pread(length, offset))
+
+    def has(self, key):
+        return self._index.get(PackedIndex.hash(key)) is not None
+
+    def get(self, key):
+        item = self._read(PackedIndex.hash(key), key)
+        if item is not None:
+            return six.ensure_str(item[1])
+        raise file_store.NotInCacheError('Cannot find item by "key" {} (probing {})'.format(key, self._data_path))
+
+    def put(self, key, value):
+        h = PackedIndex.hash(key)
+        record = self._pack(h, key, value)
+        self._index.set(h, self._append(record), len(record))
+
+    def remove(self, key):
+        return self._index.delete(PackedIndex.hash(key))
+
+    def data_size(self):
+        return os.fstat(self._rfd).st_size
+
+    def need_compaction(self):
+        data_size = self.data_size()
+        live_bytes, _ = self._index.stats()
+        if self._index.need_rehash():
+            return True
+        return data_size >= self.COMPACTION_MIN_SIZE and live_bytes < data_size * self.COMPACTION_RATIO
+
+    # Only single-threaded context
+    def compact(self):
+        """Rewrite data file keeping only live records and rebuild the index sized for them"""
+        tmp_index_path = self._index_path + '.tmp'
+        tmp_data_path = self._data_path + '.tmp'
+        for path in (tmp_index_path, tmp_data_path):
+            fs.ensure_removed(path)
+
+        before = self.data_size()
+        live = list(self._index)
+        index = PackedIndex(tmp_index_path, buckets=self._index.rehashed_buckets(len(live)))
+        try:
+            with open(tmp_data_path, 'wb') as out:
+                for h, offset, length in live:
+                    record = self._pread(length, offset)
+                    if self._unpack(h, None, record) is None:
+                        logger.debug('Dropping corrupted record at %d in %s', offset, self._data_path)
+                        continue
+                    index.set(h, out.tell(), length)
+                    out.write(record)
+        finally:
+            index.close()
+
+        self.close()
+        os.rename(tmp_data_path, self._data_path)
+        os.rename(tmp_index_path, self._index_path)
+        self._open()
+        logger.debug('Compacted %s: %d -> %d bytes', self._data_path, before, self.data_size())
+
+    # Only single-threaded context
+    def clear_tray(self):
+        if self.need_compaction():
+            self.compact()
+
+    # Only single-threaded context
+    def gc(self, ids_to_retain):
+        hashed_to_retain = set(PackedIndex.hash(x) for x in ids_to_retain)
+        for h, _, _ in list(self._index):
+            if h not in hashed_to_retain:
+                self._index.delete(h)
+        self.compact()
+
+
+if __name__ == '__main__':
+    import shutil
+    import sys
+    import tempfile
+    import time
+
+    qty = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    value = '{"files": {"a/b/c.o": {"hash": "' + 'f' * 40 + '", "size": 1024, "mode": 33188}}, "uid": "%s"}'
+
+    root = tempfile.mkdtemp()
+    try:
+        store = PackedStore(root)
+        t1 = time.time()
+        for x in six.moves.xrange(qty):
+            store.put(str(x), value % x)
+        t2 = time.time()
+        for x in six.moves.xrange(qty):
+            assert store.has(str(x))
+        t3 = time.time()
+        for x in six.moves.xrange(qty):
+            store.get(str(x))
+        t4 = time.time()
+
+        print('per one put (ms)', 1000.0 * (t2 - t1) / qty)
+        print('per one has (ms)', 1000.0 * (t3 - t2) / qty)
+        print('per one get (ms)', 1000.0 * (t4 - t3) / qty)
+    finally:
+        shutil.rmtree(root)
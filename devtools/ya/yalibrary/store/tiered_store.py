@@ -0,0 +1,235 @@
+import logging
+import threading
+import time
+
+import six.moves.queue as queue
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindQueue(object):
+    """
+    Bounded queue of deferred writes drained by background threads.
+    submit() blocks while the queue is full, so producers can't run far ahead of the uploads.
+    """
+
+    def __init__(self, threads, max_size, name='write-behind'):
+        self._queue = queue.Queue(max_size)
+        self._closed = False
+        self._cancelled = False
+        self._lock = threading.Lock()
+        self._stats = {'done': 0, 'failed': 0, 'cancelled': 0, 'time': 0.0}
+        self._threads = []
+        for i in range(threads):
+            thread = threading.Thread(target=self._drain, name='{}-{}'.format(name, i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _count(self, key, value=1):
+        with self._lock:
+            self._stats[key] += value
+
+    def _drain(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                func, on_cancel = item
+                if self._cancelled:
+                    self._cancel(on_cancel)
+                    continue
+                start = time.time()
+                try:
+                    func()
+                    self._count('done')
+                except Exception:
+                    logger.exception('Deferred write failed')
+                    self._count('failed')
+                self._count('time', time.time() - start)
+            finally:
+                self._queue.task_done()
+
+    def _cancel(self, on_cancel):
+        self._count('cancelled')
+        if on_cancel:
+            try:
+                on_cancel()
+            except Exception:
+                logger.exception('Cancellation of deferred write failed')
+
+    def submit(self, func, on_cancel=None):
+        """func is called by a background thread, on_cancel instead of it if the queue is closed before"""
+        if self._closed:
+            self._cancel(on_cancel)
+            return
+        self._queue.put((func, on_cancel))
+
+    def close(self, timeout):
+        """Waits up to timeout seconds for queued writes, the rest are cancelled. Returns number of cancelled"""
+        self._closed = True
+        deadline = time.time() + timeout
+        stoppers = 0
+        try:
+            for _ in self._threads:
+                self._queue.put(None, timeout=max(deadline - time.time(), 0))
+                stoppers += 1
+        except queue.Full:
+            pass
+        for thread in self._threads:
+            thread.join(max(deadline - time.time(), 0))
+
+        if any(thread.is_alive() for thread in self._threads):
+            self._cancelled = True
+            # Running writes can't be interrupted, cancel the ones which are not started yet
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stoppers -= 1
+                else:
+                    self._cancel(item[1])
+                self._queue.task_done()
+            for _ in range(len(self._threads) - stoppers):
+                self._queue.put_nowait(None)
+        logger.debug('Write-behind queue is closed: %s', self._stats)
+        return self._stats['cancelled']
+
+    def running(self):
+        """Number of threads still busy with a write"""
+        return sum(1 for thread in self._threads if thread.is_alive())
+
+    def join(self):
+        """Waits for the threads of a closed queue, they only finish the writes they are running"""
+        assert self._closed
+        for thread in self._threads:
+            thread.join()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+class TieredStore(object):
+    """
+    Local store in front of a dist one: local hit, then dist hit with a fill of the local store, then build.
+    Blobs of the local store are content addressed, so a fill only adds blobs which are not there yet.
+    Dist puts go through the write-behind queue if it's given.
+    """
+
+    LOCAL = 'local'
+    REMOTE = 'remote'
+
+    def __init__(self, local, remote=None, write_behind=None, fill_local=True):
+        self.local = local
+        self.remote = remote
+        self.write_behind = write_behind
+        self._fill_local = fill_local
+        # Set once the flush times out: results of the late puts are not reported anymore
+        self._detached = False
+
+    def remote_fits(self, node):
+        return bool(self.remote and self.remote.fits(node))
+
+    def remote_writable(self, node):
+        return bool(
+            self.remote and not self.remote.readonly() and self.remote.fits(node) and not self.remote.has(node.uid)
+        )
+
+    def should_fill_local(self):
+        """Results go to the local store unless the dist store is being heated"""
+        return not self.remote or self._fill_local or self.remote.readonly()
+
+    def probe(self, nodes, threads=None):
+        """
+        Resolves hits of the cacheable nodes among the given ones at once.
+        Returns (local hits, dist hits), None stands for a store without bulk probing support.
+        """
+        uids = [node.uid for node in nodes if node.cacheable]
+
+        local_hits = None
+        if hasattr(self.local, 'prefetch'):
+            local_hits = self.local.prefetch(uids)
+            logger.debug('Prefetched %d of %d uids from local cache', len(local_hits), len(uids))
+
+        remote_hits = None
+        if self.remote and hasattr(self.remote, 'has_many'):
+            candidates = [
+                node.uid
+                for node in nodes
+                if node.cacheable and (local_hits is None or node.uid not in local_hits) and self.remote.fits(node)
+            ]
+            remote_hits = self.remote.has_many(candidates, threads)
+            logger.debug('Found %d of %d uids in dist cache', len(remote_hits), len(candidates))
+
+        return local_hits, remote_hits
+
+    def drop_prefetched(self):
+        """Forgets what probe() has warmed up for the nodes which are not restored"""
+        if hasattr(self.local, 'drop_prefetched'):
+            self.local.drop_prefetched()
+
+    def try_restore(self, node, into_dir, allow_remote=True):
+        """Restores from the first store having node, returns its tier (LOCAL or REMOTE) or None"""
+        if self.local.try_restore(node.uid, into_dir):
+            return self.LOCAL
+        if allow_remote and self.remote_fits(node) and self.remote.has(node.uid):
+            logger.debug('%s is not restored from local cache, trying dist cache', node.uid)
+            if self.remote.try_restore(node.uid, into_dir):
+                return self.REMOTE
+        return None
+
+    def put_remote(self, uid, root_dir, files, codec=None, on_done=None):
+        """
+        Puts into the dist store, asynchronously if there is a write-behind queue.
+        on_done(status) is called after the put, with None if it's failed or cancelled.
+        Returns the status of a synchronous put, None otherwise.
+        """
+        files = list(files)
+
+        def notify(status):
+            if on_done and not self._detached:
+                on_done(status)
+
+        def put():
+            status = None
+            try:
+                status = self.remote.put(uid, root_dir, files, codec=codec)
+            finally:
+                notify(status)
+            return status
+
+        if self.write_behind is None:
+            return put()
+
+        self.write_behind.submit(put, on_cancel=lambda: notify(None))
+        return None
+
+    def flush(self, timeout):
+        """
+        Waits for deferred puts, returns number of the cancelled ones.
+        Puts running after the timeout can't be interrupted: their on_done callbacks are detached
+        and the puts are waited for, so nothing touches the caller's state after the flush.
+        """
+        if self.write_behind is None or self.write_behind.closed:
+            return 0
+        cancelled = self.write_behind.close(timeout)
+        if cancelled:
+            logger.warning('%d uploads to the dist cache are cancelled after %s seconds timeout', cancelled, timeout)
+        running = self.write_behind.running()
+        if running:
+            logger.warning('Waiting for %d running uploads to the dist cache, their results are dropped', running)
+            self._detached = True
+            self.write_behind.join()
+        return cancelled
+
+    def stats(self, execution_log):
+        if self.write_behind is not None:
+            execution_log['$(dist-cache-write-behind)'] = self.write_behind.stats()
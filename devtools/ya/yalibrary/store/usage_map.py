@@ -1,4 +1,5 @@
 from __future__ import print_function
+import itertools
 import mmap
 import time
 import six
@@ -8,8 +9,8 @@ from yalibrary.store import hash_map
 class UsageMap(object):
     FILE_SIZE = 12 * 1003001
 
-    def __init__(self, fname):
-        self._f = hash_map.open_file(fname, self.FILE_SIZE)
+    def __init__(self, fname, file_size=None):
+        self._f = hash_map.open_file(fname, file_size or self.FILE_SIZE)
         self._mm = mmap.mmap(self._f.fileno(), 0)
         self._hmap = hash_map.OpenHashMap(self._mm, 'II')
 
@@ -20,7 +21,7 @@ class UsageMap(object):
 
     def touch(self, key, stamp=None, id=0):
         if stamp is None:
-            stamp = time.time()
+            stamp = int(time.time())
         self._hmap[key] = (
             stamp,
             id,
@@ -36,25 +37,126 @@ class UsageMap(object):
         self._hmap.flush()
 
 
+class ShardedUsageMap(object):
+    """
+    UsageMap split by key hash into shards with their own map files and id counters,
+    so concurrent touches of different keys share no state. Ids are unique within a shard, hence for a key.
+    """
+
+    SHARDS = 16
+
+    def __init__(self, fname, shards=None):
+        self.shards = shards or self.SHARDS
+        # Twice the capacity of a single UsageMap
+        file_size = UsageMap.FILE_SIZE * 2 // self.shards
+        self._maps = [UsageMap('{}.{}'.format(fname, i), file_size) for i in six.moves.xrange(self.shards)]
+        # next() on itertools.count is atomic under GIL
+        self._ids = [itertools.count(1) for _ in six.moves.xrange(self.shards)]
+
+    def close(self):
+        for m in self._maps:
+            m.close()
+
+    def _locate(self, key):
+        h = hash_map.OpenHashMap._hash(key)
+        # High bits: the low ones choose a bucket inside the shard
+        shard = (h >> 32) % self.shards
+        return h, shard, self._maps[shard]._hmap
+
+    def touch(self, key, stamp=None):
+        """Returns the id of the touch"""
+        h, shard, hmap = self._locate(key)
+        id = next(self._ids[shard])
+        hmap.set_hashed(h, (int(time.time()) if stamp is None else stamp, id))
+        return id
+
+    def touch_once(self, key, stamp):
+        """Same as touch, but keeps the last usage if it has the same stamp. Returns (id, touched)"""
+        h, shard, hmap = self._locate(key)
+        last = hmap.get_hashed(h)
+        if last is not None and last[0] == stamp:
+            return last[1], False
+        id = next(self._ids[shard])
+        hmap.set_hashed(h, (stamp, id))
+        return id, True
+
+    def last_usage(self, key):
+        h, _, hmap = self._locate(key)
+        return hmap.get_hashed(h) or (None, None)
+
+    def forget(self, key, stamp, id):
+        """Drops the key if it wasn't touched since (stamp, id)"""
+        h, _, hmap = self._locate(key)
+        # Deletion clears the bucket unconditionally, so check it still belongs to the key
+        if hmap.get_hashed(h) == (stamp, id):
+            hmap.del_hashed(h)
+
+    def flush(self):
+        for m in self._maps:
+            m.flush()
+
+
+def _bench_threads(mp, qty, threads):
+    import threading
+
+    def worker(n):
+        for x in six.moves.xrange(n, qty, threads):
+            mp.touch(str(x))
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in six.moves.xrange(threads)]
+    t1 = time.time()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return time.time() - t1
+
+
 if __name__ == '__main__':
     import contextlib
+    import os
+    import shutil
+    import sys
+    import tempfile
+
+    from yalibrary.store import lru
 
     qty = 1000000
+    # python usage_map.py [threads] - also measures multi-threaded touch throughput
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 8
 
-    with contextlib.closing(UsageMap('out')) as mp:
-        t1 = time.time()
+    root = tempfile.mkdtemp()
+    try:
+        with contextlib.closing(UsageMap(os.path.join(root, 'out'))) as mp:
+            t1 = time.time()
 
-        for x in six.moves.xrange(qty):
-            mp.touch(str(x))
+            for x in six.moves.xrange(qty):
+                mp.touch(str(x))
+
+            t2 = time.time()
+
+            washed_away = 0
+            for x in six.moves.xrange(qty):
+                washed_away += 1 if mp.last_usage(str(x)) == (None, None) else 0
+
+            t3 = time.time()
+
+            print('washed out (percent)', 100.0 * washed_away / qty)
+            print('per one touch (ms)', 1000.0 * (t2 - t1) / qty)
+            print('per one last_usage (ms)', 1000.0 * (t3 - t2) / qty)
 
-        t2 = time.time()
+        with contextlib.closing(ShardedUsageMap(os.path.join(root, 'sharded'))) as mp:
+            elapsed = _bench_threads(mp, qty, threads)
 
-        washed_away = 0
-        for x in six.moves.xrange(qty):
-            washed_away += 1 if mp.last_usage(str(x)) is None else 0
+            washed_away = 0
+            for x in six.moves.xrange(qty):
+                washed_away += 1 if mp.last_usage(str(x)) == (None, None) else 0
 
-        t3 = time.time()
+            print('sharded washed out (percent)', 100.0 * washed_away / qty)
+            print('sharded touches per second ({} threads)'.format(threads), qty / elapsed)
 
-        print('washed out (percent)', 100.0 * washed_away / qty)
-        print('per one touch (ms)', 1000.0 * (t2 - t1) / qty)
-        print('per one last_usage (ms)', 1000.0 * (t3 - t2) / qty)
+        queue = lru.LruQueue(os.path.join(root, 'lru'))
+        print('lru touches per second ({} threads)'.format(threads), qty / _bench_threads(queue, qty, threads))
+        queue.flush()
+    finally:
+        shutil.rmtree(root)
@@ -920,7 +920,9 @@ class ACCache(object):
         if r:
             self._set_stats(r)
 
-        new_store_path = os.path.join(os.path.dirname(self._store_path), '6')
+        from yalibrary.store import new_store
+
+        new_store_path = os.path.join(os.path.dirname(self._store_path), new_store.GENERATION)
         if not os.path.exists(new_store_path):
             return
 
@@ -955,8 +957,6 @@ class ACCache(object):
 
                 self._acccount_failure('put', r, metadata=metadata)
 
-            from yalibrary.store import new_store
-
             new_store.NewStore(new_store_path).convert(convert, state)
         except Exception as e:
             logger.debug("Did not complete conversion for %s", e)
@@ -1,9 +1,23 @@
+"""
+Compressed stream is a json header followed by length prefixed compressed blocks of up to BLOCK_SIZE bytes,
+an empty block and a zero length.
+
+Version 2 streams are followed by a block index and a trailer, so blocks can be read at random
+and decompressed in parallel. Readers of the first version stop at the zero length and don't see the index.
+
+    stream  := frame(header) frame(block)* frame(codec(b'')) ZERO index TRAILER
+    index   := json({'blocks': [[raw offset, offset, raw size, size, crc32 of raw data], ...]})
+"""
+
 from io import open
 
+import bisect
+import collections
 import struct
 import json
 import os
 import logging
+import zlib
 
 import library.python.par_apply as lpp
 import library.python.codecs as lpc
@@ -11,6 +25,15 @@ import library.python.codecs as lpc
 
 logger = logging.getLogger('compress')
 
+VERSION = 2
+BLOCK_SIZE = 16 * 1024 * 1024
+INDEX_MAGIC = b'YACIDX02'
+# index offset, index size, magic
+TRAILER = struct.Struct('<QQ8s')
+
+# offset and size are of the compressed data (without the length prefix)
+Block = collections.namedtuple('Block', ['raw_offset', 'offset', 'raw_size', 'size', 'checksum'])
+
 
 def list_all_codecs():
     return sorted(frozenset(lpc.list_all_codecs()))
@@ -38,6 +61,24 @@ def codec_for(path):
     raise Exception('unsupported file %s' % path)
 
 
+def _checksum(data):
+    return zlib.crc32(data) & 0xFFFFFFFF
+
+
+def _seekable(f):
+    try:
+        return f.seekable()
+    except AttributeError:
+        pass
+
+    try:
+        f.tell()
+
+        return True
+    except (IOError, OSError):
+        return False
+
+
 def compress(fr, to, codec=None, fopen=open, threads=1):
     if codec:
         codec = find_codec(codec)
@@ -49,7 +90,7 @@ def compress(fr, to, codec=None, fopen=open, threads=1):
     def iter_blocks():
         with fopen(fr, 'rb') as f:
             while True:
-                chunk = f.read(16 * 1024 * 1024)
+                chunk = f.read(BLOCK_SIZE)
 
                 if chunk:
                     yield chunk
@@ -58,90 +99,245 @@ def compress(fr, to, codec=None, fopen=open, threads=1):
 
                     return
 
+    def compress_block(chunk):
+        return len(chunk), _checksum(chunk), func(chunk)
+
     def iter_results():
         info = {
             'codec': codec['n'],
+            'version': VERSION,
         }
 
         if fr:
             info['size'] = os.path.getsize(fr)
 
-        yield json.dumps(info, sort_keys=True) + '\n'
+        yield 0, 0, json.dumps(info, sort_keys=True) + '\n'
 
-        for c in lpp.par_apply(iter_blocks(), func, threads):
+        for c in lpp.par_apply(iter_blocks(), compress_block, threads):
             yield c
 
+    blocks = []
+    offset = 0
+    raw_offset = 0
+
     with fopen(to, 'wb') as f:
-        for c in iter_results():
+        for raw_size, checksum, c in iter_results():
             logger.debug('complete %s', len(c))
             f.write(struct.pack('<I', len(c)))
 
             try:
                 f.write(c)
             except TypeError:
-                f.write(c.encode('utf-8'))
+                c = c.encode('utf-8')
+                f.write(c)
 
+            if raw_size:
+                blocks.append([raw_offset, offset + 4, raw_size, len(c), checksum])
 
-def decompress(fr, to, codec=None, fopen=open, threads=1):
-    def iter_chunks():
+            offset += 4 + len(c)
+            raw_offset += raw_size
+
+        f.write(struct.pack('<I', 0))
+        offset += 4
+
+        index = json.dumps({'blocks': blocks}).encode('utf-8')
+        f.write(index)
+        f.write(TRAILER.pack(offset, len(index), INDEX_MAGIC))
+
+
+def _iter_frames(f):
+    cnt = 0
+
+    while True:
+        ll = f.read(4)
+
+        if ll:
+            ll = struct.unpack('<I', ll)[0]
+
+        if ll:
+            if ll > 100000000:
+                raise Exception('broken stream')
+
+            yield f.read(ll)
+
+            cnt += ll
+        else:
+            if not cnt:
+                raise Exception('empty stream')
+
+            return
+
+
+def _resolve_codec(hdr, codec, fr):
+    if 'codec' in hdr:
+        return find_codec(hdr['codec'])
+
+    if codec:
+        return find_codec(codec)
+
+    return codec_for(fr)
+
+
+def read_index(fr, fopen=open):
+    """(header, blocks) of a version 2 stream, None if the stream has no (valid) index or can't be seeked"""
+    try:
         with fopen(fr, 'rb') as f:
-            cnt = 0
+            if not _seekable(f):
+                return None
 
-            while True:
-                ll = f.read(4)
+            hdr = json.loads(next(_iter_frames(f)))
 
-                if ll:
-                    ll = struct.unpack('<I', ll)[0]
+            if not isinstance(hdr, dict) or hdr.get('version', 1) < 2:
+                return None
 
-                if ll:
-                    if ll > 100000000:
-                        raise Exception('broken stream')
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
 
-                    yield f.read(ll)
+            if size < TRAILER.size:
+                return None
 
-                    cnt += ll
-                else:
-                    if not cnt:
-                        raise Exception('empty stream')
+            f.seek(size - TRAILER.size)
+            index_offset, index_size, magic = TRAILER.unpack(f.read(TRAILER.size))
 
-                    return
+            if magic != INDEX_MAGIC or index_offset + index_size + TRAILER.size != size:
+                return None
 
-    it = iter_chunks()
-    extra = []
+            f.seek(index_offset)
 
-    for chunk in it:
-        hdr = {}
+            return hdr, [Block(*x) for x in json.loads(f.read(index_size))['blocks']]
+    except Exception as e:
+        logger.debug('can not read index of %s: %s', fr, e)
 
-        try:
-            hdr = json.loads(chunk)
-        except Exception as e:
-            logger.info('can not parse header, suspect old format: %s', e)
-            extra.append(chunk)
+        return None
 
-        break
 
-    def resolve_codec():
-        if 'codec' in hdr:
-            return find_codec(hdr['codec'])
+def _iter_stream(fr, codec, fopen, threads):
+    """Decompressed blocks of a stream of any version, read sequentially"""
 
-        if codec:
-            return find_codec(codec)
+    with fopen(fr, 'rb') as f:
+        it = _iter_frames(f)
+        extra = []
 
-        return codec_for(fr)
+        for chunk in it:
+            hdr = {}
 
-    dc = resolve_codec()['d']
+            try:
+                hdr = json.loads(chunk)
+            except Exception as e:
+                logger.info('can not parse header, suspect old format: %s', e)
+                extra.append(chunk)
 
-    def iter_all_chunks():
-        for x in extra:
-            yield x
+            break
 
-        for x in it:
-            yield x
+        dc = _resolve_codec(hdr, codec, fr)['d']
+
+        def iter_all_chunks():
+            for x in extra:
+                yield x
+
+            for x in it:
+                yield x
 
-    with fopen(to, 'wb') as f:
         for c in lpp.par_apply(iter_all_chunks(), dc, threads):
             if c:
                 logger.debug('complete %s', len(c))
-                f.write(c)
+
+                yield c
             else:
-                break
+                return
+
+
+def _iter_indexed(fr, blocks, dc, fopen, threads, func=None):
+    """Applies func to decompressed and verified blocks, results are in the order of blocks"""
+
+    def iter_compressed():
+        with fopen(fr, 'rb') as f:
+            for block in blocks:
+                f.seek(block.offset)
+
+                yield block, f.read(block.size)
+
+    def process(item):
+        block, data = item
+        data = dc(data)
+
+        if len(data) != block.raw_size or _checksum(data) != block.checksum:
+            raise Exception('broken block at %s of %s' % (block.offset, fr))
+
+        if func:
+            return func(block, data)
+
+        return data
+
+    return lpp.par_apply(iter_compressed(), process, threads)
+
+
+def _pwrite(fd, data, offset):
+    view = memoryview(data)
+
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def decompress(fr, to, codec=None, fopen=open, threads=1):
+    index = read_index(fr, fopen) if fr else None
+
+    with fopen(to, 'wb') as f:
+        if index is None:
+            for c in _iter_stream(fr, codec, fopen, threads):
+                f.write(c)
+
+            return
+
+        hdr, blocks = index
+        dc = _resolve_codec(hdr, codec, fr)['d']
+
+        if threads > 1 and hasattr(os, 'pwrite') and _seekable(f):
+            # Blocks are written by the decompressing threads at their offsets, without reordering
+            f.flush()
+            fd = f.fileno()
+
+            def write(block, data):
+                _pwrite(fd, data, block.raw_offset)
+                logger.debug('complete %s', len(data))
+
+            for _ in _iter_indexed(fr, blocks, dc, fopen, threads, write):
+                pass
+        else:
+            for c in _iter_indexed(fr, blocks, dc, fopen, threads):
+                logger.debug('complete %s', len(c))
+                f.write(c)
+
+
+def read_range(fr, offset, size, codec=None, fopen=open, threads=1):
+    """
+    Decompressed bytes [offset, offset + size) of the stream, less if it ends before.
+    Only the blocks covering the range are read if the stream is indexed.
+    """
+    end = offset + size
+    index = read_index(fr, fopen)
+
+    if index is None:
+        chunks = _iter_stream(fr, codec, fopen, threads)
+        pos = 0
+    else:
+        hdr, blocks = index
+        first = max(bisect.bisect_right([b.raw_offset for b in blocks], offset) - 1, 0)
+        blocks = [b for b in blocks[first:] if b.raw_offset < end]
+        chunks = _iter_indexed(fr, blocks, _resolve_codec(hdr, codec, fr)['d'], fopen, threads)
+        pos = blocks[0].raw_offset if blocks else 0
+
+    result = []
+
+    for c in chunks:
+        if pos + len(c) > offset:
+            result.append(c[max(offset - pos, 0) : end - pos])
+
+        pos += len(c)
+
+        if pos >= end:
+            break
+
+    return b''.join(result)
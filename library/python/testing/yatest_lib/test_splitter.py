@@ -1,6 +1,7 @@
 # coding: utf-8
 
 import collections
+import heapq
 
 
 def flatten_tests(test_classes):
@@ -100,3 +101,65 @@ def filter_tests_by_modulo(test_classes, modulo, modulo_index, split_by_tests, p
     else:
         target_classes = get_splitted_tests(test_classes, modulo, modulo_index, partition_mode)
         return {class_name: test_classes[class_name] for class_name in target_classes}
+
+
+def get_balanced_chunks(test_durations, modulo):
+    """
+    Splits tests into modulo chunks with close total durations (longest processing time first bin packing).
+    test_durations is a list of (test, duration) pairs. Tests in the chunks are sorted.
+
+    >>> get_balanced_chunks([('a', 5), ('b', 4), ('c', 3), ('d', 3), ('e', 3)], 2)
+    [['a', 'd'], ['b', 'c', 'e']]
+    >>> get_balanced_chunks([('a', 1), ('b', 1)], 3)
+    [['a'], ['b'], []]
+    """
+    chunks = [[] for _ in range(modulo)]
+    loads = [(0.0, i) for i in range(modulo)]
+    for test, duration in sorted(test_durations, key=lambda x: (-x[1], x[0])):
+        load, index = heapq.heappop(loads)
+        chunks[index].append(test)
+        heapq.heappush(loads, (load + duration, index))
+    return [sorted(chunk) for chunk in chunks]
+
+
+def split_tests_by_durations(test_classes, modulo, split_by_tests, durations):
+    """
+    Splits tests into modulo chunks balanced by durations of the tests (durations is {'class::test': seconds}).
+    Tests with unknown duration are assumed to take the median of the known ones.
+    Returns chunks in the format of filter_tests_by_modulo, None if none of the durations is known.
+
+    >>> test_classes = {'A': ['a', 'b', 'c'], 'B': ['d']}
+    >>> durations = {'A::a': 10, 'A::b': 1, 'A::c': 1, 'B::d': 9}
+    >>> [sorted(c.items()) for c in split_tests_by_durations(test_classes, 2, True, durations)]
+    [[('A', ['a', 'c'])], [('A', ['b']), ('B', ['d'])]]
+    >>> [sorted(c.items()) for c in split_tests_by_durations(test_classes, 2, False, durations)]
+    [[('A', ['a', 'b', 'c'])], [('B', ['d'])]]
+    >>> split_tests_by_durations(test_classes, 2, True, {'C::e': 1}) is None
+    True
+    """
+    tests = flatten_tests(test_classes)
+    known = sorted(durations['{}::{}'.format(*t)] for t in tests if '{}::{}'.format(*t) in durations)
+    if not known:
+        return None
+    default = known[len(known) // 2]
+
+    def get_duration(class_name, test_name):
+        return durations.get('{}::{}'.format(class_name, test_name), default)
+
+    if split_by_tests:
+        chunks = []
+        for chunk in get_balanced_chunks([(t, get_duration(*t)) for t in tests], modulo):
+            classes = collections.defaultdict(list)
+            for class_name, test_name in chunk:
+                classes[class_name].append(test_name)
+            chunks.append(classes)
+        return chunks
+
+    class_durations = [
+        (class_name, sum(get_duration(class_name, t) for t in test_names))
+        for class_name, test_names in test_classes.items()
+    ]
+    return [
+        {class_name: test_classes[class_name] for class_name in chunk}
+        for chunk in get_balanced_chunks(class_durations, modulo)
+    ]
@@ -1,9 +1,9 @@
 from yt.common import YtError
 
 try:
-    from yt.packages.six import int2byte, indexbytes
+    from yt.packages.six import int2byte
 except ImportError:
-    from six import int2byte, indexbytes
+    from six import int2byte
 
 
 class YsonError(YtError):
@@ -16,10 +16,13 @@ def raise_yson_error(message, position_info):
 
 
 class StreamWrap(object):
+    """Stream with header and footer, like read1() of the underlying stream may return less than requested."""
+
     def __init__(self, stream, header, footer):
         self.stream = stream
         self.header = header
         self.footer = footer
+        self._read = getattr(stream, "read1", None) or stream.read
 
         self.pos = 0
         self.state = 0
@@ -28,20 +31,18 @@ class StreamWrap(object):
         if n == 0:
             return self.stream.read(0)
 
-        assert n == 1
-
         if self.state == 0:
             if self.pos == len(self.header):
                 self.state += 1
             else:
-                res = int2byte(indexbytes(self.header, self.pos))
-                self.pos += 1
+                res = self.header[self.pos:self.pos + n]
+                self.pos += len(res)
                 return res
 
         if self.state == 1:
-            sym = self.stream.read(1)
-            if sym:
-                return sym
+            data = self._read(n)
+            if data:
+                return data
             else:
                 self.state += 1
                 self.pos = 0
@@ -50,8 +51,8 @@ class StreamWrap(object):
             if self.pos == len(self.footer):
                 self.state += 1
             else:
-                res = int2byte(indexbytes(self.footer, self.pos))
-                self.pos += 1
+                res = self.footer[self.pos:self.pos + n]
+                self.pos += len(res)
                 return res
 
         if self.state == 3:
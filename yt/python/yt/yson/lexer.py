@@ -26,12 +26,11 @@ from .common import (
     FALSE_MARKER, TRUE_MARKER, UINT64_MARKER)
 
 try:
-    from yt.packages.six.moves import xrange
-    from yt.packages.six import int2byte, iterbytes
+    from yt.packages.six import int2byte, indexbytes, iterbytes
 except ImportError:
-    from six.moves import xrange
-    from six import int2byte, iterbytes
+    from six import int2byte, indexbytes, iterbytes
 
+import re
 import struct
 
 _SEEMS_INT64 = int2byte(0)
@@ -42,6 +41,47 @@ PERCENT_LITERALS = [b"true", b"false", b"nan", b"inf", b"-inf", b"+inf"]
 PERCENT_LITERAL_LENGTH = dict((s[0:1], len(s)) for s in PERCENT_LITERALS)
 assert len(PERCENT_LITERALS) == len(PERCENT_LITERAL_LENGTH)
 
+# Input is read by blocks of this size, tokens are scanned within the block.
+_BLOCK_SIZE = 64 * 1024
+
+_MAX_UINT64 = 2 ** 64 - 1
+
+_WHITESPACES_RE = re.compile(b"[ \t\n\r\x0b\x0c]*")
+_UNQUOTED_STRING_RE = re.compile(b"[A-Za-z0-9_%.\\-]*")
+_NUMERIC_RE = re.compile(b"[0-9+\\-.eEu]*")
+# Quoted string body: anything but quotes and backslashes, backslash escapes the next char.
+_QUOTED_STRING_BODY_RE = re.compile(b'[^"\\\\]*(?:\\\\.[^"\\\\]*)*', re.DOTALL)
+
+_START_STATES = {
+    b"#": TOKEN_HASH,
+    b"(": TOKEN_LEFT_PARENTHESIS,
+    b")": TOKEN_RIGHT_PARENTHESIS,
+    b",": TOKEN_COMMA,
+    b":": TOKEN_COLON,
+    b";": TOKEN_SEMICOLON,
+    b"<": TOKEN_LEFT_ANGLE,
+    b"=": TOKEN_EQUALS,
+    b">": TOKEN_RIGHT_ANGLE,
+    b"[": TOKEN_LEFT_BRACKET,
+    b"]": TOKEN_RIGHT_BRACKET,
+    b"{": TOKEN_LEFT_BRACE,
+    b"}": TOKEN_RIGHT_BRACE,
+}
+
+# Single char tokens, "#" is an entity and is parsed separately.
+_PUNCTUATION = dict((ch, state) for ch, state in _START_STATES.items() if ch != b"#")
+
+# Whitespaces and a text token, binary tokens and percent literals are left to YsonLexer._read_token.
+_TOKEN_RE = re.compile(
+    br'[ \t\n\r\x0b\x0c]*(?:'
+    br'([;=\[\]{}<>(),:])|'  # punctuation
+    br'"([^"\\]*(?:\\.[^"\\]*)*)"|'  # quoted string
+    br'([A-Za-z_][A-Za-z0-9_%.\-]*)|'  # unquoted string
+    br'([+\-0-9][0-9+\-.eEu]*)|'  # numeric
+    br'(#))',  # entity
+    re.DOTALL)
+_PUNCTUATION_GROUP, _QUOTED_STRING_GROUP, _UNQUOTED_STRING_GROUP, _NUMERIC_GROUP, _ENTITY_GROUP = range(1, 6)
+
 
 def _get_numeric_type(string):
     for code in iterbytes(string):
@@ -58,46 +98,84 @@ def _zig_zag_decode(value):
 
 
 class YsonLexer(object):
+    """
+    Reads the stream by blocks (see _BLOCK_SIZE), so it may read beyond the end of the parsed value.
+    Line and position are counted and the output buffer is filled lazily, by consumed ranges of the block.
+    """
+
     def __init__(self, stream, encoding=None, output_buffer=None):
         assert (encoding is _ENCODING_SENTINEL) != (output_buffer is None), \
             "Exactly one of encoding and output_buffer parameters must be specified"
 
         self._line_index = 1
         self._position = 1
-        self._offset = 0
         self._stream = stream
-        self._lookahead = None
+        # read1 doesn't wait for the whole block, so rows of a pipe are parsed as soon as they arrive.
+        self._read = getattr(stream, "read1", None) or stream.read
+        self._buffer = b""
+        self._buffer_position = 0
+        # Size of the blocks dropped from the buffer.
+        self._buffer_offset = 0
+        # Buffer positions up to which line and position are counted and the output buffer is filled.
+        self._counted_position = 0
+        self._output_position = 0
+        self._eof = False
         self._encoding = encoding
         self._output_buffer = output_buffer
+        # Tokens are immutable, so single char ones are shared.
+        self._punctuation_tokens = dict(
+            (ch, YsonToken(value=self._maybe_value(ch), type=state)) for ch, state in _PUNCTUATION.items())
 
     def _get_start_state(self, ch):
-        tokens = {
-            b"#": TOKEN_HASH,
-            b"(": TOKEN_LEFT_PARENTHESIS,
-            b")": TOKEN_RIGHT_PARENTHESIS,
-            b",": TOKEN_COMMA,
-            b":": TOKEN_COLON,
-            b";": TOKEN_SEMICOLON,
-            b"<": TOKEN_LEFT_ANGLE,
-            b"=": TOKEN_EQUALS,
-            b">": TOKEN_RIGHT_ANGLE,
-            b"[": TOKEN_LEFT_BRACKET,
-            b"]": TOKEN_RIGHT_BRACKET,
-            b"{": TOKEN_LEFT_BRACE,
-            b"}": TOKEN_RIGHT_BRACE,
-        }
-        return tokens.get(ch)
+        return _START_STATES.get(ch)
 
     def get_next_token(self):
+        match = _TOKEN_RE.match(self._buffer, self._buffer_position)
+        # A token at the end of the block may continue in the next one.
+        if match is not None and match.end() < len(self._buffer):
+            self._buffer_position = match.end()
+            group = match.lastindex
+            if group == _PUNCTUATION_GROUP:
+                token = self._punctuation_tokens[match.group(group)]
+            elif group == _QUOTED_STRING_GROUP:
+                value = None
+                if self._output_buffer is None:
+                    value = self._decode_string(self._unescape(match.group(group)))
+                token = YsonToken(value=value, type=TOKEN_STRING)
+            elif group == _UNQUOTED_STRING_GROUP:
+                value = None
+                if self._output_buffer is None:
+                    value = self._decode_string(match.group(group))
+                token = YsonToken(value=value, type=TOKEN_STRING)
+            elif group == _NUMERIC_GROUP:
+                value, token_type = self._convert_numeric(match.group(group))
+                token = YsonToken(value=self._maybe_value(value), type=token_type)
+            else:
+                token = YsonToken(value=None, type=TOKEN_HASH)
+        else:
+            token = self._read_token()
+        if self._output_buffer is not None:
+            self._flush_output()
+        return token
+
+    def _read_token(self):
         self._skip_whitespaces()
-        ch = self._peek_char()
+        ch = self._buffer[self._buffer_position:self._buffer_position + 1]
         if not ch:
             return YsonToken()
 
-        if ch == STRING_MARKER:
-            return YsonToken(value=self._parse_string(), type=TOKEN_STRING)
+        token = self._punctuation_tokens.get(ch)
+        if token is not None:
+            self._buffer_position += 1
+            return token
 
-        elif ch == b"_" or ch == b'"' or ch.isalpha():
+        if ch == b'"':
+            return YsonToken(value=self._read_quoted_string(), type=TOKEN_STRING)
+
+        elif ch == STRING_MARKER:
+            return YsonToken(value=self._read_binary_string(), type=TOKEN_STRING)
+
+        elif ch == b"_" or ch.isalpha():
             return YsonToken(value=self._parse_string(), type=TOKEN_STRING)
         elif ch == INT64_MARKER:
             return YsonToken(value=self._parse_binary_int64(), type=TOKEN_INT64)
@@ -132,58 +210,103 @@ class YsonLexer(object):
         return YsonToken(value=self._maybe_value(ch), type=state)
 
     def get_position_info(self):
-        return self._line_index, self._position, self._offset
+        self._count_lines(self._buffer_position)
+        return self._line_index, self._position, self._buffer_offset + self._buffer_position
 
     def _maybe_value(self, value):
         if self._output_buffer is None:
             return value
         return None
 
-    def _read_char(self, binary_input=False):
-        if self._lookahead is None:
-            result = self._stream.read(1)
-        else:
-            result = self._lookahead
-        self._lookahead = None
-
-        self._offset += 1
-        if not binary_input and result == b"\n":
-            self._line_index += 1
-            self._position = 1
+    def _count_lines(self, end):
+        start = self._counted_position
+        if end <= start:
+            return
+        newline = self._buffer.rfind(b"\n", start, end)
+        if newline == -1:
+            self._position += end - start
         else:
-            self._position += 1
-
+            self._line_index += self._buffer.count(b"\n", start, end)
+            self._position = end - newline
+        self._counted_position = end
+
+    def _flush_output(self):
+        if self._buffer_position > self._output_position:
+            self._output_buffer += self._buffer[self._output_position:self._buffer_position]
+            self._output_position = self._buffer_position
+
+    def _fill(self):
+        """Reads the next block dropping the consumed part of the buffer, returns False at the end of stream."""
+        if self._eof:
+            return False
+        data = self._read(_BLOCK_SIZE)
+        if not data:
+            self._eof = True
+            return False
+
+        self._count_lines(self._buffer_position)
         if self._output_buffer is not None:
-            self._output_buffer.append(ord(result))
-
+            self._flush_output()
+        if self._buffer_position < len(self._buffer):
+            self._buffer = self._buffer[self._buffer_position:] + data
+        else:
+            self._buffer = data
+        self._buffer_offset += self._buffer_position
+        self._buffer_position = 0
+        self._counted_position = 0
+        self._output_position = 0
+        return True
+
+    def _read_matching(self, regex):
+        """Consumes the longest prefix matching the regex, which must be a repetition of a char class."""
+        parts = []
+        while True:
+            start = self._buffer_position
+            end = regex.match(self._buffer, start).end()
+            self._buffer_position = end
+            part = self._buffer[start:end]
+            if end < len(self._buffer) or not self._fill():
+                if not parts:
+                    return part
+                parts.append(part)
+                return b"".join(parts)
+            parts.append(part)
+
+    def _read_char(self):
+        result = self._peek_char()
+        if result:
+            self._buffer_position += 1
         return result
 
     def _peek_char(self):
-        if self._lookahead is not None:
-            return self._lookahead
-        self._lookahead = self._stream.read(1)
-        return self._lookahead
+        if self._buffer_position >= len(self._buffer) and not self._fill():
+            return b""
+        return self._buffer[self._buffer_position:self._buffer_position + 1]
 
-    def _read_binary_chars(self, char_count):
-        if self._output_buffer is not None:
-            string = self._stream.read(char_count)
-            self._position += len(string)
-            if len(string) != char_count:
-                raise_yson_error(
-                    "Premature end-of-stream while reading byte {0} out of {1}".format(len(string) + 1, char_count),
-                    self.get_position_info())
-            self._output_buffer += string
-            return string
+    def _skip_binary_chars(self, end):
+        # Newlines of binary data don't start new lines.
+        self._count_lines(self._buffer_position)
+        self._position += end - self._buffer_position
+        self._counted_position = end
+        self._buffer_position = end
 
-        result = []
-        for i in xrange(char_count):
-            ch = self._read_char(True)
-            if not ch:
+    def _read_binary_chars(self, char_count):
+        parts = []
+        # Negative length of a broken binary string reads nothing
+        remaining = max(char_count, 0)
+        while True:
+            start = self._buffer_position
+            end = min(start + remaining, len(self._buffer))
+            parts.append(self._buffer[start:end])
+            remaining -= end - start
+            self._skip_binary_chars(end)
+            if not remaining:
+                return parts[0] if len(parts) == 1 else b"".join(parts)
+            if not self._fill():
                 raise_yson_error(
-                    "Premature end-of-stream while reading byte {0} out of {1}".format(i + 1, char_count),
+                    "Premature end-of-stream while reading byte {0} out of {1}".format(
+                        char_count - remaining + 1, char_count),
                     self.get_position_info())
-            result.append(ch)
-        return b"".join(result)
 
     def _expect_char(self, expected_ch):
         read_ch = self._read_char()
@@ -197,8 +320,10 @@ class YsonLexer(object):
                 self.get_position_info())
 
     def _skip_whitespaces(self):
-        while self._peek_char().isspace():
-            self._read_char()
+        while True:
+            self._buffer_position = _WHITESPACES_RE.match(self._buffer, self._buffer_position).end()
+            if self._buffer_position < len(self._buffer) or not self._fill():
+                return
 
     def _read_string(self):
         ch = self._peek_char()
@@ -224,18 +349,24 @@ class YsonLexer(object):
             return self._decode_string(string)
 
     def _read_varint(self):
+        if self._buffer_position < len(self._buffer):
+            byte = indexbytes(self._buffer, self._buffer_position)
+            if not byte & 0x80:
+                self._buffer_position += 1
+                return yson_types._YsonIntegerBase(byte)
+
         count = 0
         result = 0
         read_next = True
         while read_next:
-            ch = self._read_char()
-            if not ch:
+            if self._buffer_position >= len(self._buffer) and not self._fill():
                 raise_yson_error(
                     "Premature end-of-stream while reading varinteger in Yson",
                     self.get_position_info())
-            byte = ord(ch)
+            byte = indexbytes(self._buffer, self._buffer_position)
+            self._buffer_position += 1
             result |= (byte & 0x7F) << (7 * count)
-            if result > 2 ** 64 - 1:
+            if result > _MAX_UINT64:
                 raise_yson_error(
                     "Varinteger is too large for Int64 in Yson",
                     self.get_position_info())
@@ -246,27 +377,28 @@ class YsonLexer(object):
 
     def _read_quoted_string(self):
         self._expect_char(b'"')
-        if self._output_buffer is None:
-            result = []
-        pending_next_char = False
+        parts = []
         while True:
-            ch = self._read_char()
-            if not ch:
+            start = self._buffer_position
+            end = _QUOTED_STRING_BODY_RE.match(self._buffer, start).end()
+            if self._output_buffer is None:
+                parts.append(self._buffer[start:end])
+            if self._buffer[end:end + 1] == b'"':
+                self._buffer_position = end + 1
+                break
+            # End of the block, the body may also stop at a backslash escaping the first char of the next one.
+            self._buffer_position = end
+            if not self._fill():
+                self._buffer_position = len(self._buffer)
                 raise_yson_error(
                     "Premature end-of-stream while reading string literal in Yson",
                     self.get_position_info())
-            if ch == b'"' and not pending_next_char:
-                break
-            if self._output_buffer is None:
-                result.append(ch)
-            if pending_next_char:
-                pending_next_char = False
-            elif ch == b"\\":
-                pending_next_char = True
         if self._output_buffer is None:
-            return self._decode_string(self._unescape(b"".join(result)))
+            return self._decode_string(self._unescape(b"".join(parts)))
 
     def _unescape(self, string):
+        if b"\\" not in string:
+            return string
         return string.decode("unicode_escape").encode("latin1")
 
     def _decode_string(self, string):
@@ -282,32 +414,17 @@ class YsonLexer(object):
             return string
 
     def _read_unquoted_string(self):
+        string = self._read_matching(_UNQUOTED_STRING_RE)
         if self._output_buffer is None:
-            result = []
-        while True:
-            ch = self._peek_char()
-            if ch and (ch.isalpha() or ch.isdigit() or ch in b"_%-."):
-                self._read_char()
-                if self._output_buffer is None:
-                    result.append(ch)
-            else:
-                break
-        if self._output_buffer is None:
-            return self._decode_string(b"".join(result))
+            return self._decode_string(string)
 
     def _read_numeric(self):
-        result = []
-        while True:
-            ch = self._peek_char()
-            if not ch or not (ch.isdigit() or ch in b"+-.eEu"):
-                break
-            self._read_char()
-            result.append(ch)
+        result = self._read_matching(_NUMERIC_RE)
         if not result:
             raise_yson_error(
                 "Premature end-of-stream while parsing numeric literal in Yson",
                 self.get_position_info())
-        return b"".join(result)
+        return result
 
     def _parse_percent_literal(self):
         def raise_unexpected(string):
@@ -355,7 +472,9 @@ class YsonLexer(object):
             return struct.unpack(b"<d", bytes_)[0]
 
     def _parse_numeric(self):
-        string = self._read_numeric()
+        return self._convert_numeric(self._read_numeric())
+
+    def _convert_numeric(self, string):
         numeric_type = _get_numeric_type(string)
         if numeric_type == _SEEMS_INT64:
             try:
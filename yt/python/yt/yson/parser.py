@@ -157,6 +157,33 @@ class YsonParser(object):
         self._tokenizer.get_current_token().expect_type(TOKEN_END_OF_STREAM)
         return result
 
+    def parse_list_fragment(self):
+        """Yields items of the list fragment one by one."""
+        self._tokenizer.parse_next()
+        while self._tokenizer.get_current_type() != TOKEN_END_OF_STREAM:
+            yield self._parse_any()
+            self._tokenizer.parse_next()
+            if self._tokenizer.get_current_type() == TOKEN_END_OF_STREAM:
+                break
+            self._tokenizer.get_current_token().expect_type(TOKEN_SEMICOLON)
+            self._tokenizer.parse_next()
+
+    def parse_map_fragment(self):
+        """Yields (key, value) pairs of the map fragment one by one, repeated keys are not detected."""
+        self._tokenizer.parse_next()
+        while self._tokenizer.get_current_type() != TOKEN_END_OF_STREAM:
+            self._tokenizer.get_current_token().expect_type(TOKEN_STRING)
+            key = self._tokenizer.get_current_token().get_value()
+            self._tokenizer.parse_next()
+            self._tokenizer.get_current_token().expect_type(TOKEN_EQUALS)
+            self._tokenizer.parse_next()
+            yield key, self._parse_any()
+            self._tokenizer.parse_next()
+            if self._tokenizer.get_current_type() == TOKEN_END_OF_STREAM:
+                break
+            self._tokenizer.get_current_token().expect_type(TOKEN_SEMICOLON)
+            self._tokenizer.parse_next()
+
 
 class RawYsonParser(object):
     def __init__(self, stream):
@@ -241,20 +268,40 @@ class RawYsonParser(object):
             yield self._flush_buffer()
             self._tokenizer.parse_next()
 
+    def parse_map_fragment(self):
+        """Yields "key=value;" items of the map fragment one by one."""
+        self._tokenizer.parse_next()
+        while self._tokenizer.get_current_type() != TOKEN_END_OF_STREAM:
+            self._tokenizer.get_current_token().expect_type(TOKEN_STRING)
+            self._tokenizer.parse_next()
+            self._tokenizer.get_current_token().expect_type(TOKEN_EQUALS)
+            self._tokenizer.parse_next()
+            self._parse_any()
+            self._tokenizer.parse_next()
+            self._tokenizer.get_current_token().expect_type(TOKEN_SEMICOLON)
+            yield self._flush_buffer()
+            self._tokenizer.parse_next()
+
 
 def load(stream, yson_type=None, always_create_attributes=True, raw=None,
          encoding=_ENCODING_SENTINEL, lazy=False):
     """Deserializes object from YSON formatted stream `stream`.
 
     :param str yson_type: type of YSON, one of ["node", "list_fragment", "map_fragment"].
+    :param bool raw: return an iterator over serialized items of the fragment terminated by ";"
+        (rows of the list or "key=value" pairs of the map).
+    :param bool lazy: return an iterator over items of the fragment parsed as it advances
+        (rows of the list or (key, value) pairs of the map).
     """
-    if lazy:
-        raise YsonError("Lazy parsing is not supported in python parser")
-
     if raw:
-        if yson_type != "list_fragment":
-            raise YsonError("Raw mode is only supported for list fragments")
-        return RawYsonParser(stream).parse()
+        if yson_type == "list_fragment":
+            return RawYsonParser(stream).parse()
+        if yson_type == "map_fragment":
+            return RawYsonParser(stream).parse_map_fragment()
+        raise YsonError("Raw mode is only supported for list and map fragments")
+
+    if lazy and yson_type not in ("list_fragment", "map_fragment"):
+        raise YsonError("Lazy parsing is only supported for list and map fragments in python parser")
 
     if not PY3 and encoding is not _ENCODING_SENTINEL and encoding is not None:
         raise YsonError("Encoding parameter is not supported for Python 2")
@@ -265,6 +312,12 @@ def load(stream, yson_type=None, always_create_attributes=True, raw=None,
         else:
             encoding = None
 
+    if lazy:
+        parser = YsonParser(stream, encoding, always_create_attributes)
+        if yson_type == "list_fragment":
+            return parser.parse_list_fragment()
+        return parser.parse_map_fragment()
+
     if yson_type == "list_fragment":
         stream = StreamWrap(stream, b"[", b"]")
     elif yson_type == "map_fragment":
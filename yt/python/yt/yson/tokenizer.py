@@ -15,7 +15,7 @@ class YsonTokenizer(object):
         return self._token
 
     def get_current_type(self):
-        return self.get_current_token().get_type()
+        return self._token._type
 
     def get_position_info(self):
         return self._lexer.get_position_info()
@@ -46,13 +46,14 @@ from . import yson_types
 try:
     from yt.packages.six.moves import map as imap
     from yt.packages.six import (integer_types, text_type, binary_type,
-                                 iteritems, iterkeys, iterbytes, PY3)
+                                 iteritems, iterkeys, PY3)
 except ImportError:
     from six.moves import map as imap
     from six import (integer_types, text_type, binary_type,
-                     iteritems, iterkeys, iterbytes, PY3)
+                     iteritems, iterkeys, PY3)
 
 import math
+import re
 import struct
 # Python3 compatibility
 try:
@@ -92,18 +93,29 @@ def _escape_byte(c, nxt, r):
         r += '\\{:03o}'.format(c).encode("ascii")
 
 
+# A byte to escape and the next one, which affects the escape sequence.
+_ESCAPED_BYTE_RE = re.compile(b'(["\\\\]|[^ -~])(?=(.?))', re.DOTALL)
+_ESCAPE_SEQUENCES = {}
+
+
+def _escape_match(match):
+    key = match.group(0, 2)
+    result = _ESCAPE_SEQUENCES.get(key)
+    if result is None:
+        res = bytearray()
+        _escape_byte(ord(key[0]), ord(key[1]) if key[1] else ord(b" "), res)
+        result = _ESCAPE_SEQUENCES[key] = bytes(res)
+    return result
+
+
 def _escape_bytes(obj):
-    if len(obj) == 0:
-        return b""
+    # Runs of printable chars are copied as is.
+    return _ESCAPED_BYTE_RE.sub(_escape_match, obj)
+
 
-    res = bytearray()
-    iterator = iterbytes(obj)
-    cur = next(iterator)
-    for nxt in iterator:
-        _escape_byte(cur, nxt, res)
-        cur = nxt
-    _escape_byte(cur, ord(b" "), res)
-    return bytes(res)
+_PLAIN_CONTAINER_TYPES = (dict, list, tuple)
+# Serialized keys of plain maps are cached, but not too many of them.
+_MAX_CACHED_KEYS = 1024
 
 
 def dump(object, stream, yson_format=None, yson_type=None, indent=None,
@@ -208,6 +220,11 @@ class Dumper(object):
         self._is_text = is_text
         self._ignore_inner_attributes = ignore_inner_attributes
 
+        # Plain containers are written by the fast path unless the output is pretty.
+        self._write_plain = not indent
+        self._binary_keys = {}
+        self._text_keys = {}
+
     def _has_attributes(self, obj):
         if hasattr(obj, "has_attributes"):
             return obj.has_attributes()
@@ -216,6 +233,10 @@ class Dumper(object):
     def dumps(self, obj, context):
         if hasattr(obj, "to_yson_type") and callable(obj.to_yson_type):
             return self.dumps(obj.to_yson_type(), context)
+        if self._write_plain and type(obj) in _PLAIN_CONTAINER_TYPES:
+            result = bytearray()
+            self._write_plain_container(obj, result, context)
+            return bytes(result)
         self._level += 1
         attributes = b""
         if self._has_attributes(obj) and (not self._ignore_inner_attributes or self._level == 0):
@@ -391,6 +412,95 @@ class Dumper(object):
         result += [self._format.prefix(self._level), b">"]
         return b"".join(result)
 
+    def _write_plain_container(self, obj, result, context):
+        """
+        Writes dict, list or tuple without attributes to result.
+        Values of other types are dumped as usual, including the ones which fail to dump,
+        so errors are the same.
+        """
+        self._level += 1
+        if type(obj) is dict:
+            is_stream = self.yson_type == "map_fragment" and self._level == -1
+            if not is_stream:
+                result += b"{"
+            for k, v in self._format.mapping_iter(obj):
+                if type(k) is binary_type:
+                    key = self._binary_keys.get(k)
+                    if key is None:
+                        key = self._dump_string(k, context) + b"="
+                        if len(self._binary_keys) < _MAX_CACHED_KEYS:
+                            self._binary_keys[k] = key
+                elif type(k) is text_type and self._encoding is not None:
+                    key = self._text_keys.get(k)
+                    if key is None:
+                        key = self._dump_string(k, context) + b"="
+                        if len(self._text_keys) < _MAX_CACHED_KEYS:
+                            self._text_keys[k] = key
+                elif isinstance(k, (text_type, binary_type, yson_types.YsonStringProxy)):
+                    context.push(k)
+                    key = self._dump_string(k, context) + b"="
+                    context.pop()
+                else:
+                    _raise_error_with_context("Only string can be Yson map key. Key: {0!r}".format(k), context)
+                result += key
+                self._write_plain_value(v, result, context, k, True)
+                result += b";\n" if is_stream else b";"
+            if not is_stream:
+                result += b"}"
+        else:
+            is_stream = self.yson_type == "list_fragment" and self._level == -1
+            if not is_stream:
+                result += b"["
+            for index, v in enumerate(obj):
+                if is_stream:
+                    context.row_index = index
+                self._write_plain_value(v, result, context, index, not is_stream)
+                result += b";\n" if is_stream else b";"
+            if not is_stream:
+                result += b"]"
+        self._level -= 1
+
+    def _write_plain_value(self, obj, result, context, key, push):
+        obj_type = type(obj)
+        if obj_type is binary_type or obj_type is text_type and self._encoding is not None:
+            if obj_type is text_type:
+                obj = obj.encode(self._encoding)
+            if self._is_text:
+                result += b'"'
+                result += _escape_bytes(obj)
+                result += b'"'
+            else:
+                result += STRING_MARKER
+                result += _dump_varint(_zig_zag_encode(len(obj)))
+                result += obj
+        elif obj_type in integer_types and -2 ** 63 <= obj < 2 ** 64:
+            result += self._dump_integer(obj, obj >= 2 ** 63)
+        elif obj_type is float:
+            result += self._dump_float(obj)
+        elif obj_type is bool:
+            if self._is_text:
+                result += b"%true" if obj else b"%false"
+            else:
+                result += TRUE_MARKER if obj else FALSE_MARKER
+        elif obj is None:
+            result += b"#"
+        else:
+            if self._seen_objects is not None:
+                obj_id = id(obj)
+                if obj_id in self._seen_objects:
+                    raise YsonError("Circular reference detected. Object: {0!r}".format(obj))
+                self._seen_objects[obj_id] = obj
+            if push:
+                context.push(key)
+            if obj_type in _PLAIN_CONTAINER_TYPES:
+                self._write_plain_container(obj, result, context)
+            else:
+                result += self.dumps(obj, context)
+            if push:
+                context.pop()
+            if self._seen_objects is not None:
+                del self._seen_objects[obj_id]
+
     def _circular_check(self, obj):
         def decorator(fn):
             def wrapper(*args, **kwargs):
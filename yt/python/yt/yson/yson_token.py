@@ -138,6 +138,8 @@ class YsonToken(object):
 
     def expect_type(self, type_or_types):
         token_type = self.get_type()
+        if token_type == type_or_types or type(type_or_types) is tuple and token_type in type_or_types:
+            return
         expected_types = flatten(type_or_types)
         if token_type is None:
             raise YsonError('Unexpected "{0}" while parsing node'.format(decode_token_value(self.get_value())))